@@ -0,0 +1,7 @@
+
+import time
+
+def handle_working(data):
+    return {'success': True, 'version': 'good'}
+
+COMMAND_HANDLERS = {'working': handle_working}
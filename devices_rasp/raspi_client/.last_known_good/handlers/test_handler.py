@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""Test handler for update system testing"""
+
+import time
+
+def handle_test_command(data):
+    """Test command handler"""
+    return {
+        'success': True,
+        'message': 'Test handler working!',
+        'version': 'v1.0',
+        'timestamp': time.time()
+    }
+
+COMMAND_HANDLERS = {
+    'test_command': handle_test_command
+}
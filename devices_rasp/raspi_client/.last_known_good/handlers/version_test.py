@@ -0,0 +1,5 @@
+
+def handle_v2(data):
+    return {'success': True, 'version': 2}
+
+COMMAND_HANDLERS = {'version_test': handle_v2}
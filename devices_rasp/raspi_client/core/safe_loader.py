@@ -138,6 +138,15 @@ class SafeHandlerLoader:
                     'loaded_at': time.time()
                 }
                 
+                # One-time setup (resume background work); the module must
+                # make it idempotent, since it runs again after every reload
+                init_handler = getattr(module, 'init_handler', None)
+                if callable(init_handler):
+                    try:
+                        init_handler()
+                    except Exception as e:
+                        print(f"⚠️ {module_name}.init_handler failed: {e}")
+                
                 # Initialize stats
                 if module_name not in self.handler_stats:
                     self.handler_stats[module_name] = {
@@ -0,0 +1,40 @@
+"""
+Process-wide Background Services
+
+Handler modules are executed more than once per process: the validator
+test-imports every update into a throwaway module and SafeHandlerLoader
+reloads the live one. Anything a handler owns that runs a thread or writes
+a state file (encode/upload queues, hotplug monitor, child process
+supervisor) must exist once per process, so handlers keep it here. Core
+modules are never reloaded.
+
+A service keeps the code it was created with until the client restarts.
+"""
+
+import threading
+
+_services = {}
+_lock = threading.RLock()
+
+
+def get_or_create(name, factory):
+    """
+    Get the service registered as name, creating it on first use
+    
+    Args:
+        name: Unique key (prefix with the handler module, e.g. 'camera.encode_queue')
+        factory: Called without arguments to create the service
+    
+    Returns:
+        The service object
+    """
+    with _lock:
+        if name not in _services:
+            _services[name] = factory()
+        return _services[name]
+
+
+def get(name):
+    """Get the service registered as name, or None if it was never created"""
+    with _lock:
+        return _services.get(name)
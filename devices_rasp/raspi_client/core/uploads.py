@@ -0,0 +1,995 @@
+"""
+Video Uploads to the Server
+
+Chunked, resumable uploads over pooled keep-alive connections (sendfile
+bodies, checksums from the encoders' manifests), bandwidth limiting and the
+persistent background upload queue. The camera handlers own the command
+side; this module knows nothing about cameras: the event stream, capture
+state and upload callable are passed in.
+"""
+
+import functools
+import hashlib
+import http.client
+import json
+import os
+import select
+import socket
+import threading
+import time
+
+
+# Chunked, resumable uploads (server: /api/upload-chunk/<upload id> in HW_VIDEO_UPLOAD.js)
+UPLOAD_DEFAULTS = {
+    'chunk_size': 4 * 1024 * 1024,
+    'connect_timeout': 5.0,   # seconds
+    'read_timeout': 30.0,     # seconds without a server reply
+    'max_retries': 8,         # Consecutive failures before giving up
+    'backoff_initial': 0.5,   # seconds, doubled after each consecutive failure
+    'backoff_max': 30.0,
+    'zero_copy': True         # sendfile() bodies and manifest checksums (False: read, hash and send each chunk)
+}
+
+
+class UploadCancelled(Exception):
+    """The upload was paused or cancelled through its UploadControl"""
+
+
+class UploadControl:
+    """
+    Cancellation handle for a running upload
+    
+    Checked between chunks and between the blocks of a request body, so a
+    pause or cancel takes effect within one block. reason says which.
+    """
+    
+    def __init__(self):
+        self.cancelled = False
+        self.reason = None
+    
+    def cancel(self, reason='cancelled'):
+        self.reason = reason
+        self.cancelled = True
+    
+    def check(self):
+        if self.cancelled:
+            raise UploadCancelled(self.reason)
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by queued uploads
+    
+    rate_fn returns the current cap in MB/s each time bytes are sent: None
+    for no cap, 0 to hold the upload (e.g. while a capture is running).
+    """
+    
+    def __init__(self, rate_fn, burst_seconds=0.25):
+        self.rate_fn = rate_fn
+        self.burst_seconds = burst_seconds
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def consume(self, nbytes, control=None):
+        """Block until nbytes may be sent under the current cap"""
+        while True:
+            if control:
+                control.check()
+            rate = self.rate_fn()
+            if rate is None:
+                return
+            if rate <= 0:
+                time.sleep(0.2)
+                continue
+            rate_bytes = rate * 1024 * 1024
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.tokens + (now - self.updated) * rate_bytes, rate_bytes * self.burst_seconds)
+                self.updated = now
+                if self.tokens >= 0:
+                    self.tokens -= nbytes
+                    return
+                wait = -self.tokens / rate_bytes
+            time.sleep(min(wait, 0.2))
+
+
+UPLOAD_SEND_BLOCK = 256 * 1024  # Bytes per sendfile() call: granularity of bandwidth caps and cancellation
+UPLOAD_POOL_IDLE_TIMEOUT = 4.0   # seconds; below the server's keep-alive timeout (Node default 5s)
+UPLOAD_POOL_MAX_IDLE = 4         # Idle connections kept per server
+CHECKSUM_MANIFEST_VERSION = 1
+
+
+def get_checksum_manifest_path(video_path):
+    """Per-chunk SHA-256 manifest stored next to the file (<file>.sha256.json)"""
+    return video_path + '.sha256.json'
+
+
+class ChunkHasher:
+    """
+    SHA-256 of every upload chunk of a file, fed with the bytes as they are written
+    
+    Lets whoever writes a file sequentially produce the checksums the
+    chunked upload sends, so the upload never reads the file to hash it.
+    """
+    
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or UPLOAD_DEFAULTS['chunk_size']
+        self.chunks = []
+        self.size = 0
+        self.current = hashlib.sha256()
+        self.filled = 0
+    
+    def update(self, data):
+        view = memoryview(data).cast('B')
+        while len(view):
+            take = min(len(view), self.chunk_size - self.filled)
+            self.current.update(view[:take])
+            self.filled += take
+            self.size += take
+            view = view[take:]
+            if self.filled == self.chunk_size:
+                self.chunks.append(self.current.hexdigest())
+                self.current = hashlib.sha256()
+                self.filled = 0
+    
+    def save(self, video_path):
+        """Write the manifest for the finished file (call once its last byte is written)"""
+        chunks = self.chunks + ([self.current.hexdigest()] if self.filled else [])
+        stat = os.stat(video_path)
+        if stat.st_size != self.size:
+            raise ValueError(f'Hashed {self.size} bytes, file has {stat.st_size}')
+        with open(get_checksum_manifest_path(video_path), 'w') as f:
+            json.dump({
+                'version': CHECKSUM_MANIFEST_VERSION,
+                'chunk_size': self.chunk_size,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'chunks': chunks
+            }, f)
+
+
+class HashingWriter:
+    """File wrapper that feeds everything written through a ChunkHasher"""
+    
+    def __init__(self, file, hasher):
+        self.file = file
+        self.hasher = hasher
+    
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file.write(data)
+
+
+def write_checksum_manifest(video_path, chunk_size=None):
+    """
+    Hash a file its encoder just finished into its checksum manifest
+    
+    For files written by ffmpeg, whose muxer patches headers after the
+    fact: called by the encode step right after ffmpeg exits, while the
+    file is still in the page cache. A failure only costs the upload a
+    hashing pass, so it is reported and ignored.
+    """
+    try:
+        hasher = ChunkHasher(chunk_size)
+        with open(video_path, 'rb') as f:
+            for block in iter(lambda: f.read(hasher.chunk_size), b''):
+                hasher.update(block)
+        hasher.save(video_path)
+    except Exception as e:
+        print(f"⚠️ No checksum manifest for {video_path}: {e}")
+
+
+def load_checksum_manifest(video_path, chunk_size):
+    """
+    Chunk checksums of a file from its manifest
+    
+    Returns:
+        List of hex digests, or None if there is no manifest, it was made for
+        another chunk size or the file changed since
+    """
+    try:
+        with open(get_checksum_manifest_path(video_path)) as f:
+            manifest = json.load(f)
+        stat = os.stat(video_path)
+    except (OSError, ValueError):
+        return None
+    if (manifest.get('version') != CHECKSUM_MANIFEST_VERSION or manifest.get('chunk_size') != chunk_size
+            or manifest.get('size') != stat.st_size or manifest.get('mtime_ns') != stat.st_mtime_ns):
+        return None
+    return manifest['chunks']
+
+
+class UploadTransportError(Exception):
+    """Connection failure, timeout or unexpected server reply (the request may be retried)"""
+
+
+class UploadConnectionPool:
+    """
+    Keep-alive HTTP connections to the upload server
+    
+    Chunks, offset queries and whole uploads reuse one connection instead of
+    a TCP handshake per request. Request bodies are sent from the file with
+    socket.sendfile(), so file data goes from the page cache to the socket
+    without being copied through Python. Idle connections are dropped before
+    the server's keep-alive timeout, and a connection the server has closed
+    is detected before it is reused.
+    """
+    
+    def __init__(self, idle_timeout=UPLOAD_POOL_IDLE_TIMEOUT, max_idle=UPLOAD_POOL_MAX_IDLE):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.idle = {}  # (host, port) -> [(connection, idle since)]
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+    
+    def _acquire(self, host, port, settings):
+        with self.lock:
+            idle = self.idle.get((host, port), [])
+            while idle:
+                conn, since = idle.pop()
+                # Readable while idle means the server closed it (EOF) or sent garbage
+                if time.monotonic() - since < self.idle_timeout and not select.select([conn.sock], [], [], 0)[0]:
+                    conn.sock.settimeout(settings['read_timeout'])
+                    self.reused += 1
+                    return conn
+                conn.close()
+        conn = http.client.HTTPConnection(host, port, timeout=settings['connect_timeout'])
+        conn.connect()
+        conn.sock.settimeout(settings['read_timeout'])
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.opened += 1
+        return conn
+    
+    def _release(self, host, port, conn):
+        with self.lock:
+            idle = self.idle.setdefault((host, port), [])
+            idle.append((conn, time.monotonic()))
+            while len(idle) > self.max_idle:
+                idle.pop(0)[0].close()
+    
+    def close(self):
+        """Close every idle connection"""
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self.idle = {}
+    
+    def request(self, method, host, port, path, headers, body=None, settings=None, limiter=None, control=None):
+        """
+        Send one request on a pooled connection
+        
+        Args:
+            body: None, bytes, or (file, offset, length) to send that range of
+                  an open file
+            settings: UPLOAD_DEFAULTS (timeouts, zero_copy)
+            limiter: Optional BandwidthLimiter, consulted per UPLOAD_SEND_BLOCK
+            control: Optional UploadControl, checked per UPLOAD_SEND_BLOCK
+        
+        Returns:
+            (HTTP status, response body bytes)
+        
+        Raises:
+            UploadTransportError on connection failures and timeouts,
+            UploadCancelled if control was cancelled mid-request
+        """
+        settings = settings or UPLOAD_DEFAULTS
+        if isinstance(body, tuple):
+            length = body[2]
+        else:
+            length = len(body) if body else 0
+        try:
+            conn = self._acquire(host, port, settings)
+        except OSError as e:
+            raise UploadTransportError(f'Cannot connect to server at {host}:{port} ({e})') from e
+        
+        try:
+            conn.putrequest(method, path, skip_accept_encoding=True)
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            if body is not None:
+                conn.putheader('Content-Length', str(length))
+            conn.endheaders()
+            if isinstance(body, tuple):
+                send_file_range(conn.sock, *body, settings['zero_copy'], limiter, control)
+            elif body:
+                if limiter:
+                    limiter.consume(length, control)
+                conn.sock.sendall(body)
+            response = conn.getresponse()
+            payload = response.read()
+        except UploadCancelled:
+            conn.close()
+            raise
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise UploadTransportError(f'{method} {path} failed: {e!r}') from e
+        
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(host, port, conn)
+        return response.status, payload
+
+
+def send_file_range(sock, video_file, offset, length, zero_copy=True, limiter=None, control=None):
+    """
+    Send length bytes of an open file starting at offset
+    
+    zero_copy uses socket.sendfile() (the kernel moves the data from the
+    page cache); otherwise each block is read into memory and sent.
+    """
+    sent = 0
+    while sent < length:
+        if control:
+            control.check()
+        block = min(UPLOAD_SEND_BLOCK, length - sent)
+        if limiter:
+            limiter.consume(block, control)
+        if zero_copy:
+            count = sock.sendfile(video_file, offset + sent, block)
+            if count != block:
+                raise ConnectionError(f'sendfile sent {count} of {block} bytes (file truncated?)')
+        else:
+            video_file.seek(offset + sent)
+            data = video_file.read(block)
+            if len(data) != block:
+                raise ConnectionError(f'Read {len(data)} of {block} bytes (file truncated?)')
+            sock.sendall(data)
+        sent += block
+
+
+upload_connections = UploadConnectionPool()
+
+
+class ChunkedUploadUnsupported(Exception):
+    """The server has no chunked upload endpoint (fall back to a single POST)"""
+
+
+class ChunkedUploadRejected(Exception):
+    """The server refused the upload (retrying will not help)"""
+
+
+class ChunkedUpload:
+    """
+    One file sent to the server in fixed-size chunks
+    
+    Every chunk carries its byte offset and SHA-256; the server appends it
+    only if the offset is the next one it expects and the checksum matches,
+    and answers with the new offset. After a failure (timeout, dropped
+    connection, server error) the client backs off, asks the server for the
+    last acknowledged offset and resumes from there, so a blip at 95% only
+    re-sends one chunk. The upload id is derived from the file, so a
+    restarted client resumes too.
+    
+    Requests go over upload_connections (keep-alive, sendfile). Checksums
+    come from the file's manifest when its encoder wrote one; otherwise
+    each chunk is read and hashed before it is sent.
+    
+    Progress is published on events, an event stream with publish(obj, event)
+    (the camera handlers pass the process supervisor's, so uploads appear as
+    kind 'upload' next to capture and encode progress).
+    """
+    
+    def __init__(self, video_path, server_ip, headers, settings=None, limiter=None, control=None, events=None):
+        self.video_path = video_path
+        self.server_ip = server_ip
+        self.headers = headers
+        self.settings = {**UPLOAD_DEFAULTS, **(settings or {})}
+        self.limiter = limiter
+        self.control = control
+        self.events = events
+        stat = os.stat(video_path)
+        self.size = stat.st_size
+        key = f"{headers.get('X-Raspi-ID')}:{headers.get('X-Video-Variant')}:{os.path.abspath(video_path)}:" \
+              f"{stat.st_size}:{stat.st_mtime_ns}"
+        self.id = hashlib.sha256(key.encode()).hexdigest()[:32]
+        self.path = f'/api/upload-chunk/{self.id}'
+        self.url = f'http://{server_ip}:3001{self.path}'
+        self.chunk_hashes = None
+        if self.settings['zero_copy']:
+            self.chunk_hashes = load_checksum_manifest(video_path, self.settings['chunk_size'])
+        self.checksum_source = 'manifest' if self.chunk_hashes else 'computed'
+        self.kind = 'upload'
+        self.status = 'running'
+        self.progress = {}
+        self.retries = 0
+        self.started_at = None
+    
+    def _request(self, method, headers, body=None):
+        """Pooled request to the chunk endpoint; returns (status, decoded JSON reply)"""
+        status, payload = upload_connections.request(method, self.server_ip, 3001, self.path, headers, body,
+                                                     self.settings, self.limiter, self.control)
+        try:
+            reply = json.loads(payload) if payload else {}
+        except ValueError:
+            reply = {}
+        return status, reply
+    
+    def _server_offset(self):
+        """Offset the server has acknowledged so far"""
+        status, reply = self._request('GET', self.headers)
+        if status == 404:
+            raise ChunkedUploadUnsupported(self.url)
+        if status != 200:
+            raise UploadTransportError(f'Offset query failed with status {status}')
+        return int(reply.get('offset', 0))
+    
+    def _publish(self, offset, resumed_from):
+        elapsed = time.time() - self.started_at
+        rate = (offset - resumed_from) / elapsed if elapsed > 0 else 0
+        self.progress = {
+            'bytes': offset,
+            'total_bytes': self.size,
+            'percent': round(offset / self.size * 100, 1) if self.size else 100.0,
+            'mb_per_s': round(rate / (1024 * 1024), 2),
+            'eta_s': round((self.size - offset) / rate, 2) if rate > 0 else None,
+            'retries': self.retries,
+            'file': os.path.basename(self.video_path)
+        }
+        self._emit('progress')
+    
+    def _emit(self, event):
+        if self.events:
+            self.events.publish(self, event)
+    
+    def _send_chunk(self, video_file, offset):
+        """POST the chunk at offset; returns the server's reply (409 = resync offset)"""
+        chunk_size = self.settings['chunk_size']
+        length = min(chunk_size, self.size - offset)
+        if self.chunk_hashes and offset % chunk_size == 0:
+            checksum = self.chunk_hashes[offset // chunk_size]
+            body = (video_file, offset, length)
+        elif self.settings['zero_copy']:
+            # Page cache is warm after hashing, sendfile still saves the copy out
+            video_file.seek(offset)
+            checksum = hashlib.sha256(video_file.read(length)).hexdigest()
+            body = (video_file, offset, length)
+        else:
+            video_file.seek(offset)
+            body = video_file.read(length)
+            checksum = hashlib.sha256(body).hexdigest()
+        status, reply = self._request('POST', {
+            **self.headers,
+            'Content-Type': 'application/octet-stream',
+            'X-Upload-Type': self.headers.get('Content-Type', 'video/mp4'),
+            'X-Chunk-Offset': str(offset),
+            'X-Chunk-SHA256': checksum,
+            'X-Total-Size': str(self.size)
+        }, body)
+        if status == 409:
+            return {'offset': int(reply['offset']), 'resync': True}
+        if status == 413:
+            raise ChunkedUploadRejected('File too large (max 500MB)')
+        if status != 200:
+            raise UploadTransportError(f'Chunk at {offset} failed with status {status}')
+        return reply
+    
+    def run(self):
+        """
+        Upload the file, resuming after failures
+        
+        Returns:
+            Server reply to the final chunk plus 'resumed_from', 'retries' and
+            'checksum_source' ('manifest' or 'computed')
+        
+        Raises:
+            ChunkedUploadUnsupported if the server has no chunk endpoint,
+            ChunkedUploadRejected if the server refuses the file, or the last
+            error once max_retries consecutive attempts failed
+        """
+        self.started_at = time.time()
+        failures = 0
+        try:
+            with open(self.video_path, 'rb') as video_file:
+                offset = resumed_from = self._server_offset()
+                if offset:
+                    print(f"⏯️ Resuming upload of {os.path.basename(self.video_path)} at "
+                          f"{offset / (1024 * 1024):.1f} MB")
+                while True:
+                    try:
+                        if self.control:
+                            self.control.check()
+                        if failures:
+                            offset = self._server_offset()
+                        reply = self._send_chunk(video_file, offset)
+                    except UploadTransportError as e:
+                        failures += 1
+                        self.retries += 1
+                        if failures > self.settings['max_retries']:
+                            raise
+                        delay = min(self.settings['backoff_initial'] * 2 ** (failures - 1),
+                                    self.settings['backoff_max'])
+                        print(f"⚠️ Upload chunk at {offset} failed ({e}), retry {failures} in {delay:.1f}s")
+                        time.sleep(delay)
+                        continue
+                    except UploadCancelled:
+                        self.status = self.control.reason
+                        self._emit('exit')
+                        raise
+                    
+                    failures = 0
+                    offset = int(reply['offset'])
+                    if reply.get('resync'):
+                        continue  # An earlier ack was lost: carry on where the server is
+                    self._publish(offset, resumed_from)
+                    if reply.get('complete'):
+                        break
+        except UploadCancelled:
+            raise
+        except Exception:
+            self.status = 'failed'
+            self._emit('exit')
+            raise
+        
+        self.status = 'finished'
+        self._emit('exit')
+        reply['resumed_from'] = resumed_from
+        reply['retries'] = self.retries
+        reply['checksum_source'] = self.checksum_source
+        return reply
+
+
+def get_recording_id(video_path):
+    """Recording a file belongs to: its base name without extension or _preview suffix"""
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    return name[:-len('_preview')] if name.endswith('_preview') else name
+
+
+def detect_raspi_id():
+    """Raspi id from the hostname ('raspi_sensor', 'raspi_main' or 'raspi_unknown'), when none is given"""
+    hostname = socket.gethostname().lower()
+    if 'sensor' in hostname:
+        raspi_id = 'raspi_sensor'
+    elif 'main' in hostname:
+        raspi_id = 'raspi_main'
+    else:
+        raspi_id = 'raspi_unknown'
+    print(f"⚠️ No raspi_id provided, using hostname-based: {raspi_id}")
+    return raspi_id
+
+
+def upload_video_to_server(video_path, server_ip='192.168.1.2', raspi_id=None, camera_model=None, variant='full',
+                           segment=None, chunked=True, settings=None, limiter=None, control=None, events=None):
+    """
+    Upload video file to server via raw HTTP binary transfer
+    
+    Args:
+        video_path: Path to video file
+        server_ip: Server IP address
+        raspi_id: Raspberry Pi identifier
+        camera_model: Camera model name (for server identification)
+        variant: 'full', 'preview' (a preview never replaces a full video), 'segment' or
+                 'master' (MJPEG master the server transcodes)
+        segment: dict with 'recording' and 'index' for variant 'segment'
+        chunked: Resumable chunked upload (ChunkedUpload); servers without the
+                 chunk endpoint get a single POST
+        settings: Overrides for UPLOAD_DEFAULTS (chunk size, timeouts, retries, zero_copy)
+        limiter: Optional BandwidthLimiter (upload queue bandwidth caps)
+        control: Optional UploadControl; pausing/cancelling raises UploadCancelled
+        events: Optional event stream for chunked upload progress (see ChunkedUpload)
+    
+    Returns:
+        dict with upload result (upload_seconds on success, for link throughput)
+    """
+    if not os.path.exists(video_path):
+        return {
+            'success': False,
+            'error': 'Video file not found',
+            'path': video_path
+        }
+    
+    try:
+        # Auto-detect raspi_id if not provided
+        if not raspi_id:
+            raspi_id = detect_raspi_id()
+        
+        url = f'http://{server_ip}:3001/api/upload-video'
+        headers = {
+            'X-Raspi-ID': raspi_id,
+            'X-Camera-Model': camera_model or 'unknown',
+            'X-Video-Variant': variant,
+            'Content-Type': 'video/x-matroska' if video_path.endswith('.mkv') else 'video/mp4'
+        }
+        if segment:
+            headers['X-Recording-ID'] = segment['recording']
+            headers['X-Segment-Index'] = str(segment['index'])
+        else:
+            # Lets the server drop this recording's preview once its full video is in
+            headers['X-Recording-ID'] = get_recording_id(video_path)
+        
+        file_size = os.path.getsize(video_path)
+        print(f"📦 Upload details:")
+        print(f"   📁 File: {video_path}")
+        print(f"   📊 Size: {file_size / (1024*1024):.2f} MB")
+        print(f"   🌐 URL: {url}")
+        print(f"   📋 Headers: {headers}")
+        
+        upload_start = time.time()
+        settings = {**UPLOAD_DEFAULTS, **(settings or {})}
+        if chunked:
+            try:
+                result = ChunkedUpload(video_path, server_ip, headers, settings, limiter, control, events).run()
+                return {
+                    'success': True,
+                    'message': result.get('message', 'Upload successful'),
+                    'queue_position': result.get('queuePosition', 0),
+                    'file_size': result.get('fileSize', file_size),
+                    'chunked': True,
+                    'resumed_from': result['resumed_from'],
+                    'retries': result['retries'],
+                    'checksum_source': result['checksum_source'],
+                    'upload_seconds': time.time() - upload_start
+                }
+            except ChunkedUploadUnsupported:
+                print("⚠️ Server has no chunked upload endpoint, sending the file in one request")
+            except ChunkedUploadRejected as e:
+                return {
+                    'success': False,
+                    'error': str(e),
+                    'file_size': file_size
+                }
+        
+        with open(video_path, 'rb') as video_file:
+            status, payload = upload_connections.request('POST', server_ip, 3001, '/api/upload-video', headers,
+                                                         (video_file, 0, file_size), settings, limiter, control)
+        upload_seconds = time.time() - upload_start
+        
+        if status == 200:
+            result = json.loads(payload)
+            return {
+                'success': True,
+                'message': result.get('message', 'Upload successful'),
+                'queue_position': result.get('queuePosition', 0),
+                'file_size': result.get('fileSize', file_size),
+                'upload_seconds': upload_seconds
+            }
+        elif status == 413:
+            return {
+                'success': False,
+                'error': 'File too large (max 500MB)',
+                'file_size': file_size
+            }
+        else:
+            return {
+                'success': False,
+                'error': f'Upload failed with status {status}',
+                'response': payload.decode(errors='replace')
+            }
+    
+    
+    except UploadCancelled:
+        raise
+    
+    except UploadTransportError as e:
+        return {
+            'success': False,
+            'error': str(e)
+        }
+    
+    except Exception as e:
+        return {
+            'success': False,
+            'error': f'Upload failed: {str(e)}'
+        }
+
+
+# Background upload queue, persisted to <recording_path>/upload_queue.json
+UPLOAD_QUEUE_DEFAULTS = {
+    'max_mb_per_s': None,        # Cap for queued uploads (None = as fast as the link allows)
+    'recording_mb_per_s': 2.0,   # Cap while a capture is running (0 = hold uploads until it ends)
+    'max_attempts': 5,           # Per item; each attempt resumes where the last one stopped
+    'retry_delay': 30.0,         # seconds before the second attempt, doubled after each failure
+    'retry_delay_max': 900.0,
+    'auto_upload': False,        # Queue every finished encode
+    'server_ip': '192.168.1.2',
+    'raspi_id': None
+}
+UPLOAD_PRIORITY_CURRENT = 10  # Recordings that just finished encoding
+UPLOAD_PRIORITY_BACKLOG = 0
+UPLOAD_QUEUE_HISTORY = 50     # Finished items kept for status
+
+
+class UploadQueue:
+    """
+    Persistent, prioritised background upload queue with one upload thread
+    
+    Items upload highest priority first, newest first within a priority
+    (like EncodeQueue). A failed attempt is retried after an exponential
+    delay until the item's max_attempts; chunked uploads resume from the
+    server's offset, so retries never re-send acknowledged bytes. All
+    uploads share a BandwidthLimiter whose cap drops to recording_mb_per_s
+    while a capture is running, so the control channel and the capture's
+    USB/network bandwidth are not starved.
+    
+    Args:
+        queue_file: JSON file the queue and its settings persist to
+        upload: Called like upload_video_to_server for each attempt (default: it,
+                publishing progress on events)
+        events: Event stream with publish()/subscribe() (status shows progress)
+        is_recording: Returns True while a capture is running
+    """
+    
+    def __init__(self, queue_file, upload=None, events=None, is_recording=None):
+        self.queue_file = queue_file
+        self.upload = upload or functools.partial(upload_video_to_server, events=events)
+        self.events = events
+        self.is_recording = is_recording or (lambda: False)
+        self.items = []
+        self.config = dict(UPLOAD_QUEUE_DEFAULTS)
+        self.paused = False
+        self.controls = {}  # item id -> UploadControl of the running upload
+        self.thread = None
+        self.condition = threading.Condition()
+        self.limiter = BandwidthLimiter(self.current_rate)
+        self.load()
+    
+    def load(self):
+        """Load persisted items and settings, re-queueing interrupted uploads"""
+        if not os.path.exists(self.queue_file):
+            return
+        try:
+            with open(self.queue_file) as f:
+                saved = json.load(f)
+            self.items = saved.get('items', [])
+            self.config.update(saved.get('config', {}))
+            self.paused = saved.get('paused', False)
+        except Exception as e:
+            print(f"⚠️ Failed to load upload queue: {e}")
+            self.items = []
+        for item in self.items:
+            if item['status'] == 'running':
+                item['status'] = 'queued'
+        print(f"📋 Upload queue loaded: {len(self.pending())} pending upload(s)")
+    
+    def save(self):
+        """Persist the queue (atomic replace); call with the condition held"""
+        finished = [item for item in self.items if item['status'] in ('done', 'failed', 'cancelled')]
+        for item in finished[:-UPLOAD_QUEUE_HISTORY]:
+            self.items.remove(item)
+        try:
+            os.makedirs(os.path.dirname(self.queue_file), exist_ok=True)
+            tmp_file = self.queue_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({'config': self.config, 'paused': self.paused, 'items': self.items}, f, indent=2)
+            os.replace(tmp_file, self.queue_file)
+        except Exception as e:
+            print(f"⚠️ Failed to save upload queue: {e}")
+    
+    def current_rate(self):
+        """Bandwidth cap in MB/s right now (see BandwidthLimiter)"""
+        if self.is_recording() and self.config['recording_mb_per_s'] is not None:
+            if self.config['max_mb_per_s'] is None:
+                return self.config['recording_mb_per_s']
+            return min(self.config['recording_mb_per_s'], self.config['max_mb_per_s'])
+        return self.config['max_mb_per_s']
+    
+    def pending(self):
+        return [item for item in self.items if item['status'] in ('queued', 'paused')]
+    
+    def find(self, item_id):
+        return next((item for item in self.items if item['id'] == item_id), None)
+    
+    def enqueue(self, video_path, camera_model=None, variant='full', priority=UPLOAD_PRIORITY_CURRENT,
+                server_ip=None, raspi_id=None, max_attempts=None, settings=None):
+        """
+        Add an upload and wake the upload thread
+        
+        Args:
+            video_path: File to upload
+            server_ip, raspi_id: Default from the queue config
+            max_attempts: Retry policy for this item (default from the queue config)
+            settings: UPLOAD_DEFAULTS overrides for this item (chunk size, timeouts)
+        
+        Returns:
+            Copy of the item dict
+        """
+        with self.condition:
+            item = {
+                'id': f"upl_{int(time.time() * 1000)}_{len(self.items)}",
+                'file': video_path,
+                'camera_model': camera_model,
+                'variant': variant,
+                'server_ip': server_ip or self.config['server_ip'],
+                'raspi_id': raspi_id or self.config['raspi_id'],
+                'priority': priority,
+                'max_attempts': max_attempts or self.config['max_attempts'],
+                'settings': settings or {},
+                'status': 'queued',
+                'attempts': 0,
+                'next_attempt': 0,
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'bytes': os.path.getsize(video_path) if os.path.exists(video_path) else 0,
+                'error': None,
+                'result': None
+            }
+            self.items.append(item)
+            self.save()
+            queued = dict(item)
+            self.condition.notify_all()
+        
+        self.start()
+        print(f"📋 Upload queued: {item['id']} ({os.path.basename(video_path)}, priority {priority})")
+        return queued
+    
+    def _control(self, item_id, status):
+        """Pause or cancel an item; a running upload stops at its next block"""
+        with self.condition:
+            item = self.find(item_id)
+            if not item or item['status'] not in ('queued', 'paused', 'running'):
+                return None
+            if item['status'] == 'running':
+                self.controls[item_id].cancel(status)  # Upload thread records the result
+            else:
+                item['status'] = status
+                if status == 'cancelled':
+                    item['finished'] = time.time()
+            self.save()
+            return dict(item)
+    
+    def cancel(self, item_id):
+        return self._control(item_id, 'cancelled')
+    
+    def pause(self, item_id=None):
+        """Pause one item, or the whole queue (the running upload is paused too)"""
+        if item_id:
+            return self._control(item_id, 'paused')
+        with self.condition:
+            self.paused = True
+            running = [item['id'] for item in self.items if item['status'] == 'running']
+            self.save()
+        for running_id in running:
+            self._control(running_id, 'paused')
+        return True
+    
+    def resume(self, item_id=None):
+        """Resume one paused item, or the whole queue"""
+        with self.condition:
+            if item_id:
+                item = self.find(item_id)
+                if not item or item['status'] != 'paused':
+                    return None
+                item['status'] = 'queued'
+                item['next_attempt'] = 0
+            else:
+                self.paused = False
+                for item in self.items:
+                    if item['status'] == 'paused':
+                        item['status'] = 'queued'
+            self.save()
+            self.condition.notify_all()
+        self.start()
+        return dict(item) if item_id else True
+    
+    def prioritise(self, item_id, priority=None):
+        """Set an item's priority (default: ahead of everything pending)"""
+        with self.condition:
+            item = self.find(item_id)
+            if not item or item['status'] not in ('queued', 'paused'):
+                return None
+            if priority is None:
+                priority = max(other['priority'] for other in self.pending()) + 1
+            item['priority'] = priority
+            item['next_attempt'] = 0
+            self.save()
+            self.condition.notify_all()
+            return dict(item)
+    
+    def configure(self, **settings):
+        """Update UPLOAD_QUEUE_DEFAULTS keys (bandwidth caps, retry policy, auto_upload)"""
+        unknown = set(settings) - set(UPLOAD_QUEUE_DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown upload queue setting(s): {', '.join(sorted(unknown))}")
+        with self.condition:
+            self.config.update(settings)
+            self.save()
+            self.condition.notify_all()
+        return dict(self.config)
+    
+    def start(self):
+        """Start the upload thread if it is not running"""
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker, name='upload-worker', daemon=True)
+                self.thread.start()
+    
+    def _next_item(self):
+        """(item to upload now, seconds until the next retry is due)"""
+        if self.paused:
+            return None, None
+        now = time.time()
+        queued = [item for item in self.items if item['status'] == 'queued']
+        ready = [item for item in queued if item['next_attempt'] <= now]
+        if ready:
+            return max(ready, key=lambda item: (item['priority'], item['created'])), None
+        if queued:
+            return None, min(item['next_attempt'] for item in queued) - now
+        return None, None
+    
+    def _worker(self):
+        while True:
+            with self.condition:
+                item, wait = self._next_item()
+                while item is None:
+                    self.condition.wait(wait)
+                    item, wait = self._next_item()
+                
+                control = UploadControl()
+                self.controls[item['id']] = control
+                item['status'] = 'running'
+                item['attempts'] += 1
+                item['started'] = time.time()
+                self.save()
+            
+            print(f"📤 Upload {item['id']} attempt {item['attempts']}/{item['max_attempts']}: {item['file']}")
+            if not os.path.exists(item['file']):
+                result = {'success': False, 'error': 'Video file not found', 'permanent': True}
+            else:
+                try:
+                    result = self.upload(item['file'], item['server_ip'], item['raspi_id'],
+                                         item['camera_model'], item['variant'],
+                                         settings=item['settings'], limiter=self.limiter, control=control)
+                except UploadCancelled:
+                    result = None
+                except Exception as e:
+                    # Anything unexpected fails this attempt only; the worker must outlive it
+                    result = {'success': False, 'error': f'Upload crashed: {e!r}'}
+            
+            with self.condition:
+                del self.controls[item['id']]
+                if control.cancelled:
+                    item['status'] = control.reason
+                    if control.reason == 'cancelled':
+                        item['finished'] = time.time()
+                elif result.get('success'):
+                    item['status'] = 'done'
+                    item['finished'] = time.time()
+                    item['result'] = result
+                    item['error'] = None
+                elif result.get('permanent') or item['attempts'] >= item['max_attempts']:
+                    item['status'] = 'failed'
+                    item['finished'] = time.time()
+                    item['error'] = result.get('error')
+                else:
+                    delay = min(self.config['retry_delay'] * 2 ** (item['attempts'] - 1),
+                                self.config['retry_delay_max'])
+                    item['status'] = 'queued'
+                    item['next_attempt'] = time.time() + delay
+                    item['error'] = result.get('error')
+                    print(f"⚠️ Upload {item['id']} failed ({item['error']}), retrying in {delay:.1f}s")
+                self.save()
+            print(f"📋 Upload {item['id']} {item['status']}")
+    
+    def status(self):
+        """Items by state, bandwidth caps and settings"""
+        with self.condition:
+            counts = {}
+            for item in self.items:
+                counts[item['status']] = counts.get(item['status'], 0) + 1
+            pending = sorted(self.pending(), key=lambda item: (item['priority'], item['created']), reverse=True)
+            return {
+                'depth': len(pending),
+                'paused': self.paused,
+                'running': [dict(item, progress=self._progress(item)) for item in self.items
+                            if item['status'] == 'running'],
+                'queued': [dict(item) for item in pending],
+                'recent': [dict(item) for item in self.items if item['status'] in ('done', 'failed', 'cancelled')],
+                'counts': counts,
+                'current_mb_per_s_cap': self.current_rate(),
+                'config': dict(self.config)
+            }
+    
+    def _progress(self, item):
+        """Latest upload progress event of a running item"""
+        if not self.events:
+            return None
+        events, _ = self.events.subscribe()
+        name = os.path.basename(item['file'])
+        progress = [event['progress'] for event in events
+                    if event['kind'] == 'upload' and event['progress'].get('file') == name]
+        return progress[-1] if progress else None
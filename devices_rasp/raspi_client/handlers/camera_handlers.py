@@ -9,12 +9,32 @@ import time
 import subprocess
 import os
 import re
+import json
+import gc
+import atexit
+import base64
+import ctypes
+import fcntl
+import mmap
+import select
+import shutil
+import socket
+import struct
+import itertools
 import threading
+import types
+import tempfile
 import numpy as np
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+from core import services
+from core import uploads
+from core.uploads import (UPLOAD_DEFAULTS, UPLOAD_QUEUE_DEFAULTS, UPLOAD_PRIORITY_CURRENT, UPLOAD_PRIORITY_BACKLOG,
+                          ChunkHasher, HashingWriter, UploadQueue, detect_raspi_id, write_checksum_manifest)
+
 try:
     import cv2
     CV2_AVAILABLE = True
@@ -46,25 +66,1152 @@ camera_state = {
     'daheng_frame_buffer': None,
     'daheng_ts_buffer': None,
     'daheng_id_buffer': None,
+    'daheng_dev_ts_buffer': None,
+    'daheng_tick_hz': 1e9,
     'daheng_head': 0,
     'daheng_frame_count': 0,
     'daheng_capture_thread': None,
     'daheng_stop_flag': False,
+    'daheng_mode_stats': {},
+    'capture_profile_stats': {},
+    'realtime_cpu': None,  # Core reserved by the real-time capture profile
+    'last_encode_stats': None,
+    'encoder_probe': None,   # probe_encoder_backends() results
+    'encoder_choice': None,  # Cached encoder_benchmark result for this device
+    'daheng_live_encoder': None,  # DahengLiveEncoder when encoding while capturing
+    'daheng_recording_name': None,  # File name base shared by every file of the current recording
+    'daheng_session': {
+        'cam': None,
+        'settings': {},
+        'streaming': False,
+        'opened_at': None
+    },
     
     # ELP IMX577 state
     'elp_ffmpeg_process': None,
     'elp_raw_file': None,
-    'elp_encoded_file': None
+    'elp_encoded_file': None,
+    'elp_background_encode': False,
+    'elp_output_profile': 'default',
+    'elp_single_pass': False,
+    'elp_segment_uploader': None,  # ElpSegmentUploader for segmented recordings
+    'elp_v4l2_capture': None,      # ElpV4L2Capture for native (no ffmpeg) captures
+    'elp_v4l2_options': None,
+    'last_mjpeg_file': None,       # Most recent indexed MJPEG master (read_frame default)
+    'elp_delivery': None,          # Delivery options of the running ELP recording
+    'delivery_stats': {}           # Measured encode speed / link throughput (estimate_elp_delivery)
+}
+
+
+# Camera simulation (HW_CAMERA_SIM=1, or the camera_simulation command)
+# Stands in for gxipy and the ELP /dev/videoN so capture, encode and upload
+# can be exercised and benchmarked on any Linux box.
+camera_sim_config = {
+    'enabled': False,
+    'daheng': False,
+    'elp': False,
+    'fps': float(os.environ.get('HW_SIM_FPS', 220)),
+    'drop_rate': float(os.environ.get('HW_SIM_DROP_RATE', 0.0)),
+    'queue_frames': 16,  # Frames the simulated driver buffers before dropping
+    'motion_period': 5.0  # Seconds between simulated cars crossing the frame
 }
 
+_real_gx = gx if GX_AVAILABLE else None
+_real_gx_available = GX_AVAILABLE
+
+
+class SimulatedFeature:
+    """Stand-in for a gxipy feature (is_implemented / is_writable / get / set)"""
+    
+    def __init__(self, value, writable=True, on_set=None, value_range=None):
+        self.value = value
+        self.writable = writable
+        self.on_set = on_set
+        self.value_range = value_range
+    
+    def is_implemented(self):
+        return True
+    
+    def is_writable(self):
+        return self.writable
+    
+    def get(self):
+        return self.value
+    
+    def get_range(self):
+        if self.value_range is None:
+            raise RuntimeError('Feature has no range')
+        return self.value_range()
+    
+    def set(self, value):
+        if not self.writable:
+            raise RuntimeError('Feature is not writable')
+        self.value = value
+        if self.on_set:
+            self.on_set(value)
+
+
+class SimulatedRawImage:
+    """Stand-in for gxipy RawImage"""
+    
+    def __init__(self, numpy_image, frame_id, timestamp):
+        self.numpy_image = numpy_image
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+    
+    def get_numpy_array(self):
+        return self.numpy_image
+    
+    def get_frame_id(self):
+        return self.frame_id
+    
+    def get_timestamp(self):
+        return self.timestamp
+
+
+def make_synthetic_frame(height, width, frame_time, period, base=None):
+    """
+    Build a synthetic BG Bayer frame with a bright "car" crossing the track
+    
+    The car is only in view for the middle fifth of each period so the
+    footage has quiet and active stretches, like a real race.
+    """
+    if base is None:
+        rows = np.arange(height, dtype=np.uint16)[:, None]
+        cols = np.arange(width, dtype=np.uint16)[None, :]
+        base = (40 + (rows // 8 + cols // 8) % 2 * 20).astype(np.uint8)
+    frame = base.copy()
+    
+    phase = (frame_time % period) / period
+    if 0.4 <= phase < 0.6:
+        car_w = max(width // 8, 2)
+        car_h = max(height // 6, 2)
+        x = int((phase - 0.4) / 0.2 * (width + car_w)) - car_w
+        y = (height - car_h) // 2
+        frame[y:y + car_h, max(x, 0):max(x + car_w, 0)] = 220
+    return frame
+
+
+class SimulatedDataStream:
+    """
+    Stand-in for gxipy data_stream[0]
+    
+    Frames are produced on a free-running clock at the simulated frame rate.
+    A slow consumer loses frames once more than queue_frames are pending, and
+    drop_rate randomly discards frames on the "wire"; both show up as frame ID
+    gaps exactly like on the real camera.
+    """
+    
+    def __init__(self, device):
+        self.device = device
+        self.start = None
+        self.next_index = 0
+        self.rng = np.random.default_rng()
+        self.base = None
+    
+    def on(self):
+        self.start = time.monotonic()
+        self.next_index = 0
+        self.base = None
+    
+    def flush_queue(self):
+        if self.start is not None:
+            self.next_index = int((time.monotonic() - self.start) * self.device.fps)
+    
+    def get_image(self, timeout=1000):
+        if self.start is None:
+            time.sleep(timeout / 1000.0)
+            return None
+        
+        fps = self.device.fps
+        queue_frames = camera_sim_config['queue_frames']
+        drop_rate = camera_sim_config['drop_rate']
+        
+        # Driver queue overflow: oldest frames are lost
+        due = int((time.monotonic() - self.start) * fps)
+        if due - self.next_index > queue_frames:
+            self.next_index = due - queue_frames
+        
+        index = self.next_index
+        while drop_rate > 0 and self.rng.random() < drop_rate:
+            index += 1
+        self.next_index = index + 1
+        
+        frame_time = index / fps
+        wait = self.start + frame_time - time.monotonic()
+        if wait > timeout / 1000.0:
+            time.sleep(timeout / 1000.0)
+            return None
+        if wait > 0:
+            time.sleep(wait)
+        
+        height, width = self.device.frame_shape()
+        if self.base is None or self.base.shape != (height, width):
+            self.base = make_synthetic_frame(height, width, 0, 1.0)
+        frame = make_synthetic_frame(height, width, frame_time,
+                                     camera_sim_config['motion_period'], self.base)
+        # Device clock counts nanoseconds since the camera was opened
+        device_time = self.start - self.device.opened_at + frame_time
+        return SimulatedRawImage(frame, index + 1, int(device_time * 1e9))
+
+
+class SimulatedDahengDevice:
+    """Stand-in for a gxipy Device (MER2-160-227U3C)"""
+    
+    SENSOR_WIDTH = 1440
+    SENSOR_HEIGHT = 1080
+    
+    def __init__(self):
+        self.opened_at = time.monotonic()
+        self.fps = camera_sim_config['fps']
+        self.TriggerMode = SimulatedFeature(0)
+        self.ExposureTime = SimulatedFeature(1000.0)
+        self.Gain = SimulatedFeature(0.0)
+        self.GammaEnable = SimulatedFeature(False)
+        self.Gamma = SimulatedFeature(1.0)
+        self.ContrastParam = SimulatedFeature(0)
+        self.AcquisitionFrameRateMode = SimulatedFeature(0)
+        self.requested_fps = self.fps
+        self.AcquisitionFrameRate = SimulatedFeature(self.fps, on_set=self._set_fps)
+        self.CurrentAcquisitionFrameRate = SimulatedFeature(self.fps, writable=False)
+        self.TimestampTickFrequency = SimulatedFeature(1000000000, writable=False)
+        self.BinningHorizontal = SimulatedFeature(1, on_set=self._update_geometry, value_range=lambda: self._range(1, 4))
+        self.BinningVertical = SimulatedFeature(1, on_set=self._update_geometry, value_range=lambda: self._range(1, 4))
+        self.DecimationHorizontal = SimulatedFeature(1, on_set=self._update_geometry, value_range=lambda: self._range(1, 4))
+        self.DecimationVertical = SimulatedFeature(1, on_set=self._update_geometry, value_range=lambda: self._range(1, 4))
+        self.Width = SimulatedFeature(self.SENSOR_WIDTH, on_set=self._update_geometry,
+                                      value_range=lambda: self._range(16, self._max_size()[0], 16))
+        self.Height = SimulatedFeature(self.SENSOR_HEIGHT, on_set=self._update_geometry,
+                                       value_range=lambda: self._range(2, self._max_size()[1], 2))
+        self.OffsetX = SimulatedFeature(0, value_range=lambda: self._range(0, self._max_size()[0] - self.Width.get(), 2))
+        self.OffsetY = SimulatedFeature(0, value_range=lambda: self._range(0, self._max_size()[1] - self.Height.get(), 2))
+        self.data_stream = [SimulatedDataStream(self)]
+    
+    @staticmethod
+    def _range(minimum, maximum, inc=1):
+        return {'min': minimum, 'max': maximum, 'inc': inc}
+    
+    def _max_size(self):
+        width_factor = self.BinningHorizontal.get() * self.DecimationHorizontal.get()
+        height_factor = self.BinningVertical.get() * self.DecimationVertical.get()
+        return self.SENSOR_WIDTH // width_factor, self.SENSOR_HEIGHT // height_factor
+    
+    def _max_fps(self):
+        # Readout-limited: binning still reads every row, ROI height and decimation skip rows
+        rows_read = self.Height.get() * self.BinningVertical.get()
+        return 227.0 * self.SENSOR_HEIGHT / max(rows_read, 1)
+    
+    def _set_fps(self, value):
+        self.requested_fps = float(value)
+        self._update_geometry(None)
+    
+    def _update_geometry(self, _value):
+        max_width, max_height = self._max_size()
+        self.Width.value = min(self.Width.value, max_width)
+        self.Height.value = min(self.Height.value, max_height)
+        self.fps = min(self.requested_fps, self._max_fps())
+        self.CurrentAcquisitionFrameRate.value = round(self._max_fps(), 2)
+    
+    def frame_shape(self):
+        return int(self.Height.get()), int(self.Width.get())
+    
+    def stream_on(self):
+        self.data_stream[0].on()
+    
+    def stream_off(self):
+        self.data_stream[0].start = None
+    
+    def close_device(self):
+        self.stream_off()
+
+
+class SimulatedDeviceManager:
+    """Stand-in for gxipy DeviceManager with one simulated Daheng camera"""
+    
+    def update_all_device_list(self):
+        return 1, [{'model_name': 'MER2-160-227U3C (simulated)', 'sn': 'SIM00001'}]
+    
+    def open_device_by_index(self, index):
+        if index != 1:
+            raise RuntimeError(f'No simulated Daheng camera at index {index}')
+        return SimulatedDahengDevice()
+
+
+class SimulatedGxSwitchEntry:
+    OFF = 0
+    ON = 1
+
+
+class SimulatedGx:
+    """Stand-in for the gxipy module"""
+    
+    DeviceManager = SimulatedDeviceManager
+    GxSwitchEntry = SimulatedGxSwitchEntry
+    
+    @staticmethod
+    def gx_init_lib():
+        pass
+
+
+class SyntheticMjpegSource:
+    """
+    Synthetic MJPEG stream standing in for the ELP /dev/videoN
+    
+    A small set of JPEG frames is encoded once and then replayed at the
+    requested frame rate, so the feeder costs almost no CPU and downstream
+    (ffmpeg copy / transcode / upload) performance can be measured.
+    """
+    
+    def __init__(self, width=1920, height=1080, fps=120, distinct_frames=30):
+        if not CV2_AVAILABLE:
+            raise RuntimeError('OpenCV is required for the synthetic MJPEG source')
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.rng = np.random.default_rng()
+        
+        period = camera_sim_config['motion_period']
+        self.jpeg_frames = []
+        for i in range(distinct_frames):
+            frame_time = period * (0.4 + 0.2 * i / distinct_frames)
+            gray = make_synthetic_frame(height, width, frame_time, period)
+            ok, encoded = cv2.imencode('.jpg', cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR))
+            if ok:
+                self.jpeg_frames.append(encoded.tobytes())
+    
+    def frames(self, duration):
+        """
+        Yield (jpeg_bytes, timestamp, sequence) at the simulated frame rate
+        
+        Timestamps are time.monotonic() seconds, like V4L2 driver timestamps;
+        duration None streams until the consumer stops.
+        """
+        start = time.monotonic()
+        drop_rate = camera_sim_config['drop_rate']
+        for index in (range(int(duration * self.fps)) if duration is not None else itertools.count()):
+            wait = start + index / self.fps - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if drop_rate > 0 and self.rng.random() < drop_rate:
+                continue
+            yield self.jpeg_frames[index % len(self.jpeg_frames)], start + index / self.fps, index
+    
+    def feed(self, pipe, duration):
+        """Write the MJPEG stream into a pipe (e.g. ffmpeg stdin), then close it"""
+        try:
+            for jpeg, _, _ in self.frames(duration):
+                pipe.write(jpeg)
+        except (BrokenPipeError, ValueError):
+            pass  # Consumer exited early
+        finally:
+            try:
+                pipe.close()
+            except Exception:
+                pass
+
+
+def enable_camera_simulation(daheng=True, elp=True, fps=None, drop_rate=None):
+    """
+    Route the camera code paths to the simulated backends
+    
+    Args:
+        daheng: Replace gxipy with SimulatedGx
+        elp: Replace /dev/videoN with a SyntheticMjpegSource piped into ffmpeg
+        fps: Simulated Daheng frame rate (until AcquisitionFrameRate is set)
+        drop_rate: Probability of dropping each frame (0.0 - 1.0)
+    """
+    global gx, GX_AVAILABLE
+    
+    if camera_state['recording']:
+        raise RuntimeError('Cannot change camera simulation while recording')
+    
+    # Any cached session belongs to the previous backend
+    release_daheng_session()
+    
+    camera_sim_config['enabled'] = bool(daheng or elp)
+    camera_sim_config['daheng'] = bool(daheng)
+    camera_sim_config['elp'] = bool(elp)
+    if fps is not None:
+        camera_sim_config['fps'] = float(fps)
+    if drop_rate is not None:
+        camera_sim_config['drop_rate'] = float(drop_rate)
+    
+    if daheng:
+        gx = SimulatedGx
+        GX_AVAILABLE = True
+    else:
+        gx = _real_gx
+        GX_AVAILABLE = _real_gx_available
+    
+    print(f"🧪 Camera simulation: daheng={camera_sim_config['daheng']}, "
+          f"elp={camera_sim_config['elp']}, fps={camera_sim_config['fps']}, "
+          f"drop_rate={camera_sim_config['drop_rate']}")
+
+
+def disable_camera_simulation():
+    """Restore the real camera backends"""
+    enable_camera_simulation(daheng=False, elp=False)
+
+
+def list_simulated_cameras():
+    """Simulated cameras in the same format as list_usb_cameras()"""
+    cameras = []
+    if camera_sim_config['elp']:
+        cameras.append({
+            'index': 0,
+            'device': '/dev/video0',
+            'name': 'Simulated ELP IMX577 HD USB Camera',
+            'interface': 'v4l2'
+        })
+    if camera_sim_config['daheng']:
+        cameras.append({
+            'index': 101,
+            'device': 'daheng:0',
+            'name': 'Simulated Daheng MER2-160-227U3C',
+            'interface': 'gxipy',
+            'usb_id': '2ba2:4d55'
+        })
+    return cameras
+
+
+# Child process supervision (ffmpeg, v4l2-ctl, lsusb)
+PROCESS_STDERR_LINES = 200       # stderr lines kept per process
+PROCESS_HISTORY = 20             # Finished processes kept for process_status
+PROCESS_EVENT_HISTORY = 500      # Progress events kept for subscribers
+FFMPEG_IDLE_TIMEOUT = 30         # Seconds without any ffmpeg output before it counts as hung
+ELP_CAPTURE_TIMEOUT_MARGIN = 30  # Seconds past the requested duration before an ELP capture is killed
+PROCESS_PID_FILE = os.path.join(tempfile.gettempdir(), 'hw_camera_children.json')
+SUPERVISED_PROGRAMS = ('ffmpeg', 'v4l2-ctl', 'lsusb', 'udevadm')
+
+# Keys of an ffmpeg -progress block (a block ends with progress=continue|end)
+FFMPEG_PROGRESS_KEYS = ('frame', 'fps', 'bitrate', 'total_size', 'out_time_us', 'out_time_ms', 'out_time',
+                        'dup_frames', 'drop_frames', 'speed', 'progress')
+FFMPEG_PROGRESS_RE = re.compile(r'^([a-z0-9_]+)=\s*(.*)$')
+FFMPEG_DURATION_RE = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+def read_boot_id():
+    """Kernel boot id (changes on every boot), or None where /proc doesn't provide it"""
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def read_process_stat(pid):
+    """
+    Parent PID and start time of a process from /proc/<pid>/stat
+    
+    Returns:
+        (parent pid, start time in clock ticks since boot), or None if the
+        process is gone
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # Fields after the command name (which may contain spaces) start at field 3
+            fields = f.read().rsplit(')', 1)[1].split()
+        return int(fields[1]), int(fields[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def parse_ffmpeg_number(value):
+    """Number from an ffmpeg progress value ('4.19x', 'N/A', '1234')"""
+    try:
+        return float(value.rstrip('x'))
+    except (AttributeError, ValueError):
+        return None
+
+
+class SupervisedProcess:
+    """
+    A child process started through ProcessSupervisor
+    
+    Stands in for the subprocess.Popen objects the handlers used before
+    (pid, stdin, poll, wait, kill, returncode). A reader thread drains
+    stderr into a bounded ring and parses ffmpeg -progress blocks, so
+    progress is known while the process runs and a chatty child can never
+    block on a full stderr pipe.
+    """
+    
+    def __init__(self, supervisor, process_id, kind, cmd, process, timeout=None, idle_timeout=None,
+                 total_frames=None, total_seconds=None):
+        self.supervisor = supervisor
+        self.id = process_id
+        self.kind = kind
+        self.cmd = cmd
+        self.process = process
+        self.pid = process.pid
+        self.start_ticks = (read_process_stat(process.pid) or (None, None))[1]  # Tells a reused PID apart
+        self.stdin = process.stdin
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.total_frames = total_frames
+        self.total_seconds = total_seconds
+        self.started_at = time.time()
+        self.last_output_at = self.started_at
+        self.ended_at = None
+        self.status = 'running'
+        self.stderr_lines = deque(maxlen=PROCESS_STDERR_LINES)
+        self.progress = {}
+        self.progress_block = {}
+        self.reader = threading.Thread(target=self._read_stderr, name=f'{kind}-stderr', daemon=True)
+        self.reader.start()
+    
+    @property
+    def returncode(self):
+        return self.process.returncode
+    
+    def _read_stderr(self):
+        for raw_line in iter(self.process.stderr.readline, b''):
+            self.last_output_at = time.time()
+            line = raw_line.decode(errors='replace').rstrip()
+            match = FFMPEG_PROGRESS_RE.match(line)
+            if match and match.group(1) in FFMPEG_PROGRESS_KEYS:
+                self.progress_block[match.group(1)] = match.group(2).strip()
+                if match.group(1) == 'progress':
+                    self._update_progress(self.progress_block)
+                    self.progress_block = {}
+                continue
+            
+            if self.total_seconds is None:
+                duration = FFMPEG_DURATION_RE.search(line)
+                if duration:
+                    hours, minutes, seconds = duration.groups()
+                    self.total_seconds = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            self.stderr_lines.append(line)
+        self.process.stderr.close()
+    
+    def _update_progress(self, block):
+        """Frames, fps, speed and ETA from one ffmpeg -progress block"""
+        frames = int(parse_ffmpeg_number(block.get('frame')) or 0)
+        out_time_us = parse_ffmpeg_number(block.get('out_time_us'))
+        out_time = max(out_time_us / 1e6, 0.0) if out_time_us is not None else None
+        speed = parse_ffmpeg_number(block.get('speed'))
+        elapsed = time.time() - self.started_at
+        
+        eta = percent = None
+        if self.total_frames and frames:
+            percent = frames / self.total_frames * 100
+            eta = (self.total_frames - frames) / (frames / elapsed)
+        elif self.total_seconds and out_time is not None and speed:
+            percent = out_time / self.total_seconds * 100
+            eta = (self.total_seconds - out_time) / speed
+        
+        self.progress = {
+            'frames': frames,
+            'fps': parse_ffmpeg_number(block.get('fps')),
+            'speed': speed,
+            'out_time_s': round(out_time, 3) if out_time is not None else None,
+            'drop_frames': int(parse_ffmpeg_number(block.get('drop_frames')) or 0),
+            'percent': round(min(percent, 100.0), 1) if percent is not None else None,
+            'eta_s': round(max(eta, 0.0), 2) if eta is not None else None,
+            'elapsed_s': round(elapsed, 2),
+            'done': block.get('progress') == 'end'
+        }
+        self.supervisor.publish(self, 'progress')
+    
+    def poll(self):
+        returncode = self.process.poll()
+        if returncode is not None:
+            self._finished()
+        return returncode
+    
+    def wait(self, timeout=None):
+        returncode = self.process.wait(timeout)
+        self.reader.join()
+        self._finished()
+        return returncode
+    
+    def kill(self, reason='killed'):
+        """Kill the process; reason becomes its status ('killed', 'timeout', 'stalled')"""
+        if self.process.poll() is None:
+            self.status = reason
+            self.process.kill()
+    
+    def _finished(self):
+        if self.ended_at is not None:
+            return
+        self.ended_at = time.time()
+        if self.status == 'running':
+            self.status = 'finished' if self.process.returncode == 0 else 'failed'
+        self.supervisor.on_exit(self)
+    
+    def stderr_text(self):
+        return '\n'.join(self.stderr_lines)
+    
+    def summary(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'pid': self.pid,
+            'status': self.status,
+            'returncode': self.process.returncode,
+            'runtime_s': round((self.ended_at or time.time()) - self.started_at, 2),
+            'progress': self.progress,
+            'stderr_tail': list(self.stderr_lines)[-5:],
+            'command': ' '.join(str(arg) for arg in self.cmd)
+        }
+
+
+class ProcessSupervisor:
+    """
+    Starts and watches every ffmpeg / v4l2-ctl / lsusb child
+    
+    Long-running children (start) get timeouts (total and idle), progress
+    parsing and a bounded stderr ring; short tools (run) always get a
+    timeout. Child PIDs are kept in PROCESS_PID_FILE (with their start time
+    and the boot id) so children orphaned by a crashed client are killed on
+    the next start.
+    """
+    
+    def __init__(self, pid_file=PROCESS_PID_FILE):
+        self.pid_file = pid_file
+        self.processes = {}
+        self.history = deque(maxlen=PROCESS_HISTORY)
+        self.events = deque(maxlen=PROCESS_EVENT_HISTORY)
+        self.event_seq = 0
+        self.next_id = 1
+        self.condition = threading.Condition()
+        self.watchdog = None
+    
+    def start(self, cmd, kind, timeout=None, idle_timeout=None, total_frames=None, total_seconds=None,
+              progress=True, **popen_kwargs):
+        """
+        Start a long-running child (ffmpeg capture or encode)
+        
+        Args:
+            kind: Label shown in status (e.g. 'elp_capture')
+            timeout: Kill after this many seconds (None: no limit)
+            idle_timeout: Kill when it prints nothing for this long (ffmpeg
+                          reports progress twice a second, so silence = hung)
+            total_frames / total_seconds: Expected output, for percent and ETA
+            progress: Add -progress pipe:2 to ffmpeg commands
+            popen_kwargs: Passed to subprocess.Popen (stdin, stdout, ...)
+        
+        Returns:
+            SupervisedProcess
+        """
+        cmd = list(cmd)
+        if progress and os.path.basename(cmd[0]) == 'ffmpeg':
+            cmd[1:1] = ['-progress', 'pipe:2', '-nostats']
+        popen_kwargs.setdefault('stdout', subprocess.DEVNULL)
+        process = subprocess.Popen(cmd, stderr=subprocess.PIPE, **popen_kwargs)
+        
+        with self.condition:
+            process_id = f'{kind}-{self.next_id}'
+            self.next_id += 1
+            supervised = SupervisedProcess(self, process_id, kind, cmd, process, timeout, idle_timeout,
+                                           total_frames, total_seconds)
+            self.processes[process_id] = supervised
+            if self.watchdog is None or not self.watchdog.is_alive():
+                self.watchdog = threading.Thread(target=self._watch, name='process-supervisor', daemon=True)
+                self.watchdog.start()
+        self.save_pids()
+        self.publish(supervised, 'started')
+        return supervised
+    
+    def run(self, cmd, kind=None, timeout=10, **kwargs):
+        """
+        Run a short tool (v4l2-ctl, lsusb, ...) to completion with a timeout
+        
+        Same arguments and result as subprocess.run; subprocess.run kills
+        the child when the timeout expires.
+        """
+        started_at = time.time()
+        status = 'failed'
+        returncode = None
+        try:
+            result = subprocess.run(cmd, timeout=timeout, **kwargs)
+            returncode = result.returncode
+            status = 'finished' if returncode == 0 else 'failed'
+            return result
+        except subprocess.TimeoutExpired:
+            status = 'timeout'
+            raise
+        finally:
+            with self.condition:
+                self.history.append({
+                    'kind': kind or os.path.basename(cmd[0]),
+                    'status': status,
+                    'returncode': returncode,
+                    'runtime_s': round(time.time() - started_at, 2),
+                    'command': ' '.join(str(arg) for arg in cmd)
+                })
+    
+    def _watch(self):
+        """Enforce timeouts and notice exits until no child is left"""
+        while True:
+            with self.condition:
+                running = list(self.processes.values())
+            if not running:
+                with self.condition:
+                    if not self.processes:
+                        self.watchdog = None
+                        return
+                continue
+            now = time.time()
+            for supervised in running:
+                if supervised.poll() is not None:
+                    continue
+                if supervised.timeout and now - supervised.started_at > supervised.timeout:
+                    print(f"⏰ {supervised.id} exceeded {supervised.timeout}s, killing")
+                    supervised.kill('timeout')
+                elif supervised.idle_timeout and now - supervised.last_output_at > supervised.idle_timeout:
+                    print(f"⏰ {supervised.id} silent for {supervised.idle_timeout}s, killing")
+                    supervised.kill('stalled')
+            time.sleep(0.5)
+    
+    def on_exit(self, supervised):
+        with self.condition:
+            if self.processes.pop(supervised.id, None) is None:
+                return
+            self.history.append(supervised.summary())
+        self.save_pids()
+        self.publish(supervised, 'exit')
+    
+    def publish(self, supervised, event):
+        """Add a progress/lifecycle event and wake subscribers"""
+        with self.condition:
+            self.event_seq += 1
+            self.events.append({
+                'seq': self.event_seq,
+                'event': event,
+                'id': supervised.id,
+                'kind': supervised.kind,
+                'status': supervised.status,
+                'progress': supervised.progress,
+                'time': time.time()
+            })
+            self.condition.notify_all()
+    
+    def subscribe(self, since=0, wait=0):
+        """
+        Events after sequence number since, waiting up to wait seconds for one
+        
+        Returns:
+            (events, latest sequence number)
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.event_seq > since, timeout=wait)
+            return [event for event in self.events if event['seq'] > since], self.event_seq
+    
+    def status(self):
+        with self.condition:
+            running = list(self.processes.values())
+            recent = list(self.history)
+        return {
+            'running': [supervised.summary() for supervised in running],
+            'recent': recent
+        }
+    
+    def kill_all(self):
+        with self.condition:
+            running = list(self.processes.values())
+        for supervised in running:
+            supervised.kill()
+    
+    def save_pids(self):
+        with self.condition:
+            children = [{'pid': supervised.pid, 'start_ticks': supervised.start_ticks}
+                        for supervised in self.processes.values()]
+        try:
+            with open(self.pid_file, 'w') as f:
+                json.dump({'parent': os.getpid(), 'boot_id': read_boot_id(), 'children': children}, f)
+        except OSError as e:
+            print(f"⚠️ Failed to write {self.pid_file}: {e}")
+    
+    def cleanup_orphans(self):
+        """
+        Kill children left behind by a client that died mid-recording
+        
+        Only processes that are exactly the recorded children (same boot,
+        same PID and start time, so a reused PID is never hit), still one of
+        SUPERVISED_PROGRAMS and re-parented (the client that started them is
+        gone) are killed.
+        
+        Returns:
+            List of killed PIDs
+        """
+        try:
+            with open(self.pid_file) as f:
+                recorded = json.load(f)
+            children, recorded_parent = recorded.get('children', []), recorded.get('parent')
+            recorded_boot_id = recorded.get('boot_id')
+        except (OSError, ValueError, AttributeError):
+            return []
+        
+        killed = []
+        if recorded_boot_id is None or recorded_boot_id != read_boot_id():
+            children = []  # Written before a reboot (or without /proc): every PID may be reused
+        for child in children:
+            pid = child.get('pid')
+            stat = read_process_stat(pid)
+            if stat is None or child.get('start_ticks') is None or stat[1] != child['start_ticks']:
+                continue
+            try:
+                with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                    program = os.path.basename(f.read().split(b'\0')[0].decode(errors='replace'))
+            except OSError:
+                continue
+            if program in SUPERVISED_PROGRAMS and stat[0] != recorded_parent:
+                try:
+                    os.kill(pid, 9)
+                    killed.append(pid)
+                except OSError:
+                    pass
+        if killed:
+            print(f"🧹 Killed {len(killed)} orphaned camera process(es): {killed}")
+        self.save_pids()
+        return killed
+
+
+def create_process_supervisor():
+    """Process-wide supervisor: orphans of a crashed client are killed once, at creation"""
+    supervisor = ProcessSupervisor()
+    supervisor.cleanup_orphans()
+    atexit.register(supervisor.kill_all)
+    return supervisor
+
+
+# Shared with reloaded / test-imported copies of this module, so they see the running children
+process_supervisor = services.get_or_create('camera.process_supervisor', create_process_supervisor)
+
+
+# Camera registry: sysfs scan kept up to date by kernel hotplug events
+SYSFS_ROOT = '/sys'
+DAHENG_USB_VENDOR = '2ba2'
+DAHENG_VIRTUAL_INDEX_BASE = 101  # Daheng cameras (gxipy, no /dev/video node) get 101, 102, ...
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+CAMERA_HOTPLUG_SUBSYSTEMS = ('video4linux', 'usb')
+CAMERA_HOTPLUG_SETTLE = 0.3  # seconds of quiet after a uevent burst before rescanning
+
+
+def read_sysfs_attr(path, name):
+    """One sysfs attribute as a stripped string, or None if it doesn't exist"""
+    try:
+        with open(os.path.join(path, name)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def find_sysfs_usb_device(path):
+    """The USB device directory (the one with idVendor) a sysfs device sits under, or None"""
+    path = os.path.realpath(path)
+    while path not in ('/', '') and os.path.basename(path) != 'devices':
+        if os.path.exists(os.path.join(path, 'idVendor')):
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+def parse_uevent(datagram):
+    """
+    Kernel uevent datagram ('add@/devices/...\\0ACTION=add\\0SUBSYSTEM=usb\\0...') as a dict
+    
+    Returns:
+        dict of the KEY=value fields, or None for anything else (udev's own
+        'libudev' messages, garbage)
+    """
+    fields = datagram.split(b'\0')
+    if b'@' not in fields[0]:
+        return None
+    event = {}
+    for field in fields[1:]:
+        key, sep, value = field.partition(b'=')
+        if sep:
+            event[key.decode(errors='replace')] = value.decode(errors='replace')
+    return event
+
 
-def list_usb_cameras():
-    """List all USB cameras with basic info, including Daheng cameras"""
+class CameraRegistry:
+    """
+    Connected cameras, read from sysfs and kept in memory
+    
+    V4L2 cameras come from /sys/class/video4linux (first node of each USB
+    device), Daheng cameras from /sys/bus/usb/devices (vendor 2ba2, they
+    have no V4L2 node). Every camera gets a stable id from its USB
+    vendor:product and serial number (port path when there is no unique
+    serial), and a Daheng camera keeps its virtual index across replugs.
+    
+    With monitoring on, a thread listens for kernel uevents and rescans
+    when a USB or video4linux device comes or goes, so cameras() answers
+    from memory. Changes are published on the process supervisor's event
+    stream (kind 'camera', status 'connected'/'disconnected'). Without
+    netlink (non-Linux, some containers) every cameras() call rescans
+    sysfs, which still needs no child processes.
+    """
+    
+    def __init__(self, sysfs_root=SYSFS_ROOT):
+        self.sysfs_root = sysfs_root
+        self.lock = threading.Lock()
+        self.entries = {}           # stable id -> camera dict
+        self.virtual_indices = {}   # stable id -> last Daheng index it had
+        self.generation = 0
+        self.scanned_at = None
+        self.scan_ms = None
+        self.events_seen = 0
+        self.monitoring = False
+        self.event_socket = None
+        self.thread = None
+    
+    def available(self):
+        """True if this system exposes the sysfs trees the registry reads"""
+        return (os.path.isdir(os.path.join(self.sysfs_root, 'class', 'video4linux')) or
+                os.path.isdir(os.path.join(self.sysfs_root, 'bus', 'usb', 'devices')))
+    
+    def _stable_id(self, usb, taken):
+        usb_id = f"{usb['vendor']}:{usb['product']}"
+        if usb['serial']:
+            camera_id = f"usb-{usb_id}-{usb['serial']}"
+            if camera_id not in taken:
+                return camera_id
+        # No serial, or two cameras sharing one: the USB port tells them apart
+        return f"usb-{usb_id}@{usb['port']}"
+    
+    def _usb_info(self, usb_path):
+        return {
+            'vendor': read_sysfs_attr(usb_path, 'idVendor'),
+            'product': read_sysfs_attr(usb_path, 'idProduct'),
+            'serial': read_sysfs_attr(usb_path, 'serial'),
+            'product_name': read_sysfs_attr(usb_path, 'product'),
+            'port': os.path.basename(usb_path)
+        }
+    
+    def scan(self):
+        """
+        Read the connected cameras from sysfs (no locking, no state change)
+        
+        Returns:
+            dict of stable id -> camera dict (same keys as list_usb_cameras(),
+            plus id, port, serial and model)
+        """
+        found = {}
+        
+        v4l2_root = os.path.join(self.sysfs_root, 'class', 'video4linux')
+        nodes = []
+        for name in os.listdir(v4l2_root) if os.path.isdir(v4l2_root) else []:
+            match = re.fullmatch(r'video(\d+)', name)
+            if match:
+                nodes.append((int(match.group(1)), os.path.join(v4l2_root, name)))
+        for device_index, node in sorted(nodes):
+            # UVC cameras have a second (metadata) node with index 1
+            if read_sysfs_attr(node, 'index') not in (None, '0'):
+                continue
+            usb_path = find_sysfs_usb_device(os.path.join(node, 'device'))
+            if not usb_path:
+                continue  # Platform codecs/ISP, not cameras
+            usb = self._usb_info(usb_path)
+            if any(camera['port'] == usb['port'] for camera in found.values()):
+                continue  # Another node of a camera already listed
+            camera_id = self._stable_id(usb, found)
+            found[camera_id] = {
+                'id': camera_id,
+                'index': device_index,
+                'device': f'/dev/video{device_index}',
+                'name': read_sysfs_attr(node, 'name') or usb['product_name'] or f'USB Camera {device_index}',
+                'interface': 'v4l2',
+                'usb_id': f"{usb['vendor']}:{usb['product']}",
+                'serial': usb['serial'],
+                'port': usb['port']
+            }
+        
+        usb_root = os.path.join(self.sysfs_root, 'bus', 'usb', 'devices')
+        for name in sorted(os.listdir(usb_root)) if os.path.isdir(usb_root) else []:
+            usb_path = os.path.join(usb_root, name)
+            if read_sysfs_attr(usb_path, 'idVendor') != DAHENG_USB_VENDOR:
+                continue
+            usb = self._usb_info(usb_path)
+            camera_id = self._stable_id(usb, found)
+            product_name = usb['product_name'] or ''
+            found[camera_id] = {
+                'id': camera_id,
+                'index': None,  # Assigned in rescan()
+                'device': None,
+                'name': f'Daheng {product_name} (USB3.0)' if 'MER2-160-227U3C' in product_name
+                        else 'Daheng Imaging Camera (USB)',
+                'interface': 'gxipy',
+                'usb_id': f"{usb['vendor']}:{usb['product']}",
+                'serial': usb['serial'],
+                'port': usb['port']
+            }
+        return found
+    
+    def rescan(self):
+        """
+        Rescan sysfs, update the registry and publish what changed
+        
+        Returns:
+            (connected ids, disconnected ids)
+        """
+        scan_start = time.perf_counter()
+        found = self.scan()
+        with self.lock:
+            # Daheng: keep the index a camera had before, else the lowest free one
+            in_use = set()
+            daheng = [camera for camera in found.values() if camera['interface'] == 'gxipy']
+            for camera in daheng:
+                previous = self.virtual_indices.get(camera['id'])
+                if previous is not None and previous not in in_use:
+                    camera['index'] = previous
+                    in_use.add(previous)
+            for camera in daheng:
+                if camera['index'] is None:
+                    camera['index'] = next(index for index in itertools.count(DAHENG_VIRTUAL_INDEX_BASE)
+                                           if index not in in_use)
+                    in_use.add(camera['index'])
+                camera['device'] = f"daheng:{camera['index'] - DAHENG_VIRTUAL_INDEX_BASE}"
+                self.virtual_indices[camera['id']] = camera['index']
+            for camera in found.values():
+                camera['model'] = identify_camera(camera['name'], camera['usb_id'])
+            
+            connected = [camera_id for camera_id in found if camera_id not in self.entries]
+            disconnected = [camera_id for camera_id in self.entries if camera_id not in found]
+            changed = [camera_id for camera_id in found
+                       if camera_id in self.entries and found[camera_id] != self.entries[camera_id]]
+            previous = self.entries
+            self.entries = found
+            if connected or disconnected or changed:
+                self.generation += 1
+            self.scanned_at = time.time()
+            self.scan_ms = round((time.perf_counter() - scan_start) * 1000, 3)
+        
+        for camera_id in connected:
+            print(f"🔌 Camera connected: {found[camera_id]['name']} ({found[camera_id]['device']}, {camera_id})")
+            self._publish(found[camera_id], 'connected')
+        for camera_id in disconnected:
+            print(f"🔌 Camera disconnected: {previous[camera_id]['name']} ({camera_id})")
+            self._publish(previous[camera_id], 'disconnected')
+        return connected, disconnected
+    
+    def _publish(self, camera, status):
+        process_supervisor.publish(types.SimpleNamespace(id=camera['id'], kind='camera', status=status,
+                                                         progress=dict(camera)), status)
+    
+    def cameras(self, refresh=False):
+        """Connected cameras (list_usb_cameras() format), from memory while monitoring"""
+        if refresh or not self.monitoring or self.scanned_at is None:
+            self.rescan()
+        with self.lock:
+            return sorted((dict(camera) for camera in self.entries.values()), key=lambda camera: camera['index'])
+    
+    def start(self, event_socket=None):
+        """
+        Scan once and follow hotplug events
+        
+        Args:
+            event_socket: Datagram socket delivering kernel uevents (default: a
+                          NETLINK_KOBJECT_UEVENT socket on the kernel group)
+        
+        Returns:
+            True if hotplug events are followed, False if cameras() will rescan
+            on every call
+        """
+        if self.monitoring:
+            return True
+        if event_socket is None:
+            try:
+                event_socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+                event_socket.bind((0, UEVENT_KERNEL_GROUP))
+            except (AttributeError, OSError) as e:
+                print(f"⚠️ No hotplug events ({e}), cameras are rescanned on every list")
+                self.rescan()
+                return False
+        self.event_socket = event_socket
+        self.monitoring = True
+        self.rescan()
+        self.thread = threading.Thread(target=self._monitor, daemon=True, name='camera-hotplug')
+        self.thread.start()
+        return True
+    
+    def stop(self):
+        """Stop following hotplug events"""
+        self.monitoring = False
+        if self.thread:
+            self.thread.join(timeout=2)
+        if self.event_socket:
+            self.event_socket.close()
+        self.event_socket = self.thread = None
+    
+    def _monitor(self):
+        """Rescan after each burst of USB/video4linux uevents (one plug = several events)"""
+        pending = False
+        while self.monitoring:
+            ready = select.select([self.event_socket], [], [], CAMERA_HOTPLUG_SETTLE if pending else 0.5)[0]
+            if not ready:
+                if pending:
+                    pending = False
+                    try:
+                        self.rescan()
+                    except Exception as e:
+                        print(f"⚠️ Camera rescan failed: {e}")
+                continue
+            try:
+                event = parse_uevent(self.event_socket.recv(16384))
+            except OSError:
+                break
+            if event and event.get('SUBSYSTEM') in CAMERA_HOTPLUG_SUBSYSTEMS:
+                self.events_seen += 1
+                pending = True
+        self.monitoring = False
+    
+    def status(self):
+        """Registry state for list_cameras / camera_status"""
+        return {
+            'source': 'sysfs',
+            'hotplug': self.monitoring,
+            'generation': self.generation,
+            'scanned_at': self.scanned_at,
+            'scan_ms': self.scan_ms,
+            'events_seen': self.events_seen
+        }
+
+
+def create_camera_registry():
+    """Camera registry for this system, following hotplug events when sysfs is there"""
+    registry = CameraRegistry()
+    if registry.available():
+        registry.start()
+    return registry
+
+
+def get_camera_registry():
+    """
+    Shared camera registry (started with hotplug monitoring on first use)
+    
+    Kept in core.services, so a reload never starts a second uevent thread.
+    """
+    return services.get_or_create('camera.registry', create_camera_registry)
+
+
+def list_usb_cameras(refresh=False):
+    """
+    List all USB cameras with basic info, including Daheng cameras
+    
+    Answered by the camera registry (sysfs + hotplug events); systems
+    without sysfs fall back to scan_usb_cameras_with_tools().
+    
+    Args:
+        refresh: Rescan even if the registry is following hotplug events
+    """
+    if camera_sim_config['enabled']:
+        return list_simulated_cameras()
+    registry = get_camera_registry()
+    if registry.available():
+        return registry.cameras(refresh)
+    return scan_usb_cameras_with_tools()
+
+
+def scan_usb_cameras_with_tools():
+    """List cameras by parsing v4l2-ctl --list-devices and lsusb (no sysfs)"""
     cameras = []
     
     # Step 1: Get V4L2 video devices
     try:
-        result = subprocess.run(
+        result = process_supervisor.run(
             ['v4l2-ctl', '--list-devices'],
             capture_output=True,
             text=True,
@@ -110,7 +1257,7 @@ def list_usb_cameras():
     
     # Step 2: Check for Daheng cameras via USB (they don't appear in V4L2)
     try:
-        result = subprocess.run(
+        result = process_supervisor.run(
             ['lsusb'],
             capture_output=True,
             text=True,
@@ -154,7 +1301,7 @@ def get_camera_controls(camera_index):
     """
     device = f'/dev/video{camera_index}'
     try:
-        result = subprocess.run(
+        result = process_supervisor.run(
             ['v4l2-ctl', '-d', device, '--list-ctrls'],
             capture_output=True, text=True, check=True
         )
@@ -221,8 +1368,13 @@ def identify_camera(camera_name, usb_id=None):
 
 
 def handle_list_cameras(data):
-    """List all connected USB cameras"""
-    cameras = list_usb_cameras()
+    """
+    List all connected USB cameras
+    
+    Params:
+        refresh: bool (rescan sysfs instead of answering from the registry, default False)
+    """
+    cameras = list_usb_cameras(refresh=data.get('refresh', False))
     
     cameras_info = []
     unknown_usb_cameras = []
@@ -230,13 +1382,15 @@ def handle_list_cameras(data):
     for cam in cameras:
         # Pass USB ID if available (for Daheng cameras)
         usb_id = cam.get('usb_id', None)
-        model = identify_camera(cam['name'], usb_id)
+        model = cam.get('model') or identify_camera(cam['name'], usb_id)
         camera_info = {
             'index': cam['index'],
             'device': cam['device'],
             'name': cam['name'],
             'model': model
         }
+        if cam.get('id'):
+            camera_info.update(id=cam['id'], usb_id=usb_id, port=cam['port'])
         cameras_info.append(camera_info)
         
         # Track unknown USB cameras for troubleshooting
@@ -265,19 +1419,760 @@ def handle_list_cameras(data):
         'cameras': cameras_info,
         'count': len(cameras_info),
         'unknown_usb_count': len(unknown_usb_cameras),
+        'registry': get_camera_list_source(),
         'timestamp': time.time()
     }
 
 
-def start_recording_elp_imx577(camera_index, data):
+def get_camera_list_source():
+    """Where list_usb_cameras() gets its answer: simulation, registry (sysfs) or tools"""
+    if camera_sim_config['enabled']:
+        return {'source': 'simulation'}
+    registry = get_camera_registry()
+    if registry.available():
+        return registry.status()
+    return {'source': 'tools'}
+
+
+def get_allowed_cpus():
+    """CPUs this process may run on"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return list(range(os.cpu_count() or 1))
+
+
+def get_worker_cpus():
     """
-    Start recording with ELP IMX577 camera using ffmpeg
+    CPUs for encoder/upload work: everything except the reserved capture core
+    """
+    cpus = get_allowed_cpus()
+    reserved = camera_state['realtime_cpu']
+    workers = [cpu for cpu in cpus if cpu != reserved]
+    return workers or cpus
+
+
+def pin_to_worker_cpus(pid=0):
+    """
+    Keep a worker thread (pid=0: calling thread) or child process off the capture core
+    
+    Returns:
+        Previous affinity (to restore a thread afterwards), or None
+    """
+    if camera_state['realtime_cpu'] is None:
+        return None
+    try:
+        previous = os.sched_getaffinity(pid)
+        os.sched_setaffinity(pid, get_worker_cpus())
+        return previous
+    except (AttributeError, OSError) as e:
+        print(f"⚠️ Could not pin to worker CPUs: {e}")
+        return None
+
+
+def restore_cpu_affinity(previous, pid=0):
+    """Restore affinity saved by pin_to_worker_cpus()"""
+    if previous is None:
+        return
+    try:
+        os.sched_setaffinity(pid, previous)
+    except (AttributeError, OSError):
+        pass
+
+
+def enter_realtime_profile(options, pid=0):
+    """
+    Apply the opt-in real-time capture profile to the capture thread
+    (pid=0) or capture process
+    
+    Options (True for defaults, or a dict):
+        cpu: int (core dedicated to capture, default: last allowed CPU)
+        policy: 'fifo' (SCHED_FIFO, needs CAP_SYS_NICE) or 'nice' (default 'fifo',
+                falls back to 'nice' when not permitted)
+        fifo_priority: int (1-99, default 50)
+        nice: int (default -10; negative values need CAP_SYS_NICE)
+        gc: 'freeze' (default), 'disable' or 'on' (only for the capture thread)
+    
+    Returns:
+        Profile state for exit_realtime_profile(), or None if not requested
+    """
+    if not options:
+        return None
+    if not isinstance(options, dict):
+        options = {}
+    
+    cpus = get_allowed_cpus()
+    profile = {
+        'cpu': None,
+        'policy': None,
+        'gc': None,
+        'errors': [],
+        'pid': pid,
+        'previous_affinity': None,
+        'previous_scheduler': None,
+        'previous_nice': None
+    }
+    
+    # Dedicated core
+    cpu = options.get('cpu', cpus[-1])
+    if len(cpus) < 2:
+        profile['errors'].append('Only one CPU available, not pinning')
+    elif cpu not in cpus:
+        profile['errors'].append(f'CPU {cpu} not available (allowed: {cpus})')
+    else:
+        try:
+            profile['previous_affinity'] = os.sched_getaffinity(pid)
+            os.sched_setaffinity(pid, {cpu})
+            profile['cpu'] = cpu
+            camera_state['realtime_cpu'] = cpu
+        except (AttributeError, OSError) as e:
+            profile['errors'].append(f'CPU pinning failed: {e}')
+    
+    # Scheduling priority
+    policy = options.get('policy', 'fifo')
+    if policy == 'fifo':
+        try:
+            profile['previous_scheduler'] = (os.sched_getscheduler(pid), os.sched_getparam(pid))
+            os.sched_setscheduler(pid, os.SCHED_FIFO, os.sched_param(options.get('fifo_priority', 50)))
+            profile['policy'] = 'fifo'
+        except (AttributeError, OSError) as e:
+            profile['previous_scheduler'] = None
+            profile['errors'].append(f'SCHED_FIFO not permitted ({e}), using nice')
+            policy = 'nice'
+    if policy == 'nice':
+        target = pid or threading.get_native_id()
+        try:
+            profile['previous_nice'] = os.getpriority(os.PRIO_PROCESS, target)
+            os.setpriority(os.PRIO_PROCESS, target, options.get('nice', -10))
+            profile['policy'] = f"nice {options.get('nice', -10)}"
+        except (AttributeError, OSError) as e:
+            profile['previous_nice'] = None
+            profile['errors'].append(f'Raising priority not permitted: {e}')
+    
+    # Garbage collector: no collection pauses during capture
+    gc_mode = options.get('gc', 'freeze')
+    if pid == 0 and gc_mode in ('freeze', 'disable'):
+        gc.disable()
+        if gc_mode == 'freeze':
+            gc.freeze()
+        profile['gc'] = gc_mode
+    
+    print(f"⚡ Real-time profile: cpu={profile['cpu']}, policy={profile['policy']}, gc={profile['gc']}")
+    for error in profile['errors']:
+        print(f"⚠️ Real-time profile: {error}")
+    
+    return profile
+
+
+def exit_realtime_profile(profile):
+    """
+    Undo enter_realtime_profile() for a capture thread
+    
+    The capture core stays reserved (worker threads keep off it) until the
+    next capture without the profile. Capture processes don't need this,
+    their profile ends with the process.
+    
+    Returns:
+        JSON-friendly summary of what was applied
+    """
+    if profile is None:
+        return None
+    
+    pid = profile['pid']
+    if profile['gc']:
+        if profile['gc'] == 'freeze':
+            gc.unfreeze()
+        gc.enable()
+    
+    if profile['previous_scheduler']:
+        try:
+            policy, param = profile['previous_scheduler']
+            os.sched_setscheduler(pid, policy, param)
+        except OSError:
+            pass
+    if profile['previous_nice'] is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid or threading.get_native_id(), profile['previous_nice'])
+        except OSError:
+            pass  # Lowering priority back needs no privileges, raising does
+    restore_cpu_affinity(profile['previous_affinity'], pid)
+    
+    return summarize_realtime_profile(profile)
+
+
+def summarize_realtime_profile(profile):
+    """JSON-friendly summary of an applied real-time profile"""
+    if profile is None:
+        return None
+    
+    return {
+        'cpu': profile['cpu'],
+        'policy': profile['policy'],
+        'gc': profile['gc'],
+        'worker_cpus': get_worker_cpus(),
+        'errors': profile['errors']
+    }
+
+
+def record_capture_profile_stats(realtime, actual_fps, jitter_ms):
+    """
+    Track achieved fps and jitter with and without the real-time profile
+    
+    Returns:
+        Stats for both profiles so they can be compared
+    """
+    stats = camera_state['capture_profile_stats'].setdefault(
+        'realtime' if realtime else 'standard',
+        {'recordings': 0, 'last_fps': 0.0, 'best_fps': 0.0, 'last_jitter_ms': None}
+    )
+    stats['recordings'] += 1
+    stats['last_fps'] = round(actual_fps, 1)
+    stats['best_fps'] = max(stats['best_fps'], stats['last_fps'])
+    stats['last_jitter_ms'] = jitter_ms
+    return camera_state['capture_profile_stats']
+
+
+# V4L2 (linux/videodev2.h) subset for native MJPEG capture
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_MEMORY_MMAP = 1
+V4L2_FIELD_ANY = 0
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_STREAMING = 0x04000000
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+V4L2_BUF_FLAG_ERROR = 0x00000040
+V4L2_PIX_FMT_MJPEG = struct.unpack('<I', b'MJPG')[0]
+
+
+class v4l2_capability(ctypes.Structure):
+    _fields_ = [
+        ('driver', ctypes.c_char * 16),
+        ('card', ctypes.c_char * 32),
+        ('bus_info', ctypes.c_char * 32),
+        ('version', ctypes.c_uint32),
+        ('capabilities', ctypes.c_uint32),
+        ('device_caps', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 3)
+    ]
+
+
+class v4l2_pix_format(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint32) for name in (
+        'width', 'height', 'pixelformat', 'field', 'bytesperline', 'sizeimage',
+        'colorspace', 'priv', 'flags', 'ycbcr_enc', 'quantization', 'xfer_func'
+    )]
+
+
+class v4l2_format_union(ctypes.Union):
+    # The kernel union holds pointers (v4l2_window), hence the pointer alignment
+    _fields_ = [('pix', v4l2_pix_format), ('raw_data', ctypes.c_uint8 * 200), ('align', ctypes.c_void_p)]
+
+
+class v4l2_format(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32), ('fmt', v4l2_format_union)]
+
+
+class v4l2_fract(ctypes.Structure):
+    _fields_ = [('numerator', ctypes.c_uint32), ('denominator', ctypes.c_uint32)]
+
+
+class v4l2_captureparm(ctypes.Structure):
+    _fields_ = [
+        ('capability', ctypes.c_uint32),
+        ('capturemode', ctypes.c_uint32),
+        ('timeperframe', v4l2_fract),
+        ('extendedmode', ctypes.c_uint32),
+        ('readbuffers', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 4)
+    ]
+
+
+class v4l2_streamparm_union(ctypes.Union):
+    _fields_ = [('capture', v4l2_captureparm), ('raw_data', ctypes.c_uint8 * 200)]
+
+
+class v4l2_streamparm(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32), ('parm', v4l2_streamparm_union)]
+
+
+class v4l2_requestbuffers(ctypes.Structure):
+    _fields_ = [
+        ('count', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('memory', ctypes.c_uint32),
+        ('capabilities', ctypes.c_uint32),
+        ('flags', ctypes.c_uint8),
+        ('reserved', ctypes.c_uint8 * 3)
+    ]
+
+
+class v4l2_timecode(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('frames', ctypes.c_uint8),
+        ('seconds', ctypes.c_uint8),
+        ('minutes', ctypes.c_uint8),
+        ('hours', ctypes.c_uint8),
+        ('userbits', ctypes.c_uint8 * 4)
+    ]
+
+
+class v4l2_timestamp(ctypes.Structure):
+    """The struct timeval inside v4l2_buffer"""
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_usec', ctypes.c_long)]
+
+
+class v4l2_buffer_m(ctypes.Union):
+    _fields_ = [
+        ('offset', ctypes.c_uint32),
+        ('userptr', ctypes.c_ulong),
+        ('planes', ctypes.c_void_p),
+        ('fd', ctypes.c_int32)
+    ]
+
+
+class v4l2_buffer(ctypes.Structure):
+    _fields_ = [
+        ('index', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('bytesused', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('field', ctypes.c_uint32),
+        ('timestamp', v4l2_timestamp),
+        ('timecode', v4l2_timecode),
+        ('sequence', ctypes.c_uint32),
+        ('memory', ctypes.c_uint32),
+        ('m', v4l2_buffer_m),
+        ('length', ctypes.c_uint32),
+        ('reserved2', ctypes.c_uint32),
+        ('request_fd', ctypes.c_int32)
+    ]
+
+
+def _vidioc(direction, nr, struct_type):
+    """_IOC(direction, 'V', nr, sizeof(struct_type)); direction 1 = write, 2 = read, 3 = both"""
+    return (direction << 30) | (ctypes.sizeof(struct_type) << 16) | (ord('V') << 8) | nr
+
+
+VIDIOC_QUERYCAP = _vidioc(2, 0, v4l2_capability)
+VIDIOC_S_FMT = _vidioc(3, 5, v4l2_format)
+VIDIOC_REQBUFS = _vidioc(3, 8, v4l2_requestbuffers)
+VIDIOC_QUERYBUF = _vidioc(3, 9, v4l2_buffer)
+VIDIOC_QBUF = _vidioc(3, 15, v4l2_buffer)
+VIDIOC_DQBUF = _vidioc(3, 17, v4l2_buffer)
+VIDIOC_STREAMON = _vidioc(1, 18, ctypes.c_int)
+VIDIOC_STREAMOFF = _vidioc(1, 19, ctypes.c_int)
+VIDIOC_S_PARM = _vidioc(3, 22, v4l2_streamparm)
+
+
+class V4L2MjpegDevice:
+    """
+    MJPEG capture from /dev/videoN through VIDIOC_* ioctls and mmap'd buffers
+    
+    No ffmpeg process: frames are dequeued in Python with the driver's
+    (CLOCK_MONOTONIC) timestamp and sequence number, copied out of the
+    driver buffer and the buffer is queued straight back.
+    """
+    
+    def __init__(self, device, buffer_count=8):
+        self.device = device
+        self.buffer_count = buffer_count
+        self.fd = None
+        self.buffers = []
+    
+    def open(self, width, height, fps):
+        """
+        Open the device and negotiate MJPEG at width x height @ fps
+        
+        Returns:
+            (width, height, fps) the driver actually granted
+        """
+        self.fd = os.open(self.device, os.O_RDWR | os.O_NONBLOCK)
+        
+        cap = v4l2_capability()
+        fcntl.ioctl(self.fd, VIDIOC_QUERYCAP, cap)
+        caps = cap.device_caps if cap.capabilities & V4L2_CAP_DEVICE_CAPS else cap.capabilities
+        if not (caps & V4L2_CAP_VIDEO_CAPTURE and caps & V4L2_CAP_STREAMING):
+            raise RuntimeError(f'{self.device} does not support streaming capture')
+        
+        fmt = v4l2_format()
+        fmt.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        fmt.fmt.pix.width = width
+        fmt.fmt.pix.height = height
+        fmt.fmt.pix.pixelformat = V4L2_PIX_FMT_MJPEG
+        fmt.fmt.pix.field = V4L2_FIELD_ANY
+        fcntl.ioctl(self.fd, VIDIOC_S_FMT, fmt)
+        if fmt.fmt.pix.pixelformat != V4L2_PIX_FMT_MJPEG:
+            raise RuntimeError(f'{self.device} refused MJPEG')
+        
+        parm = v4l2_streamparm()
+        parm.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        parm.parm.capture.timeperframe.numerator = 1
+        parm.parm.capture.timeperframe.denominator = int(fps)
+        fcntl.ioctl(self.fd, VIDIOC_S_PARM, parm)
+        frame_interval = parm.parm.capture.timeperframe
+        actual_fps = frame_interval.denominator / frame_interval.numerator if frame_interval.numerator else fps
+        
+        req = v4l2_requestbuffers()
+        req.count = self.buffer_count
+        req.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        req.memory = V4L2_MEMORY_MMAP
+        fcntl.ioctl(self.fd, VIDIOC_REQBUFS, req)
+        for index in range(req.count):
+            buf = self._new_buffer(index)
+            fcntl.ioctl(self.fd, VIDIOC_QUERYBUF, buf)
+            self.buffers.append(mmap.mmap(self.fd, buf.length, mmap.MAP_SHARED,
+                                          mmap.PROT_READ | mmap.PROT_WRITE, offset=buf.m.offset))
+        
+        return fmt.fmt.pix.width, fmt.fmt.pix.height, actual_fps
+    
+    def _new_buffer(self, index=0):
+        buf = v4l2_buffer()
+        buf.index = index
+        buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = V4L2_MEMORY_MMAP
+        return buf
+    
+    def start(self):
+        for index in range(len(self.buffers)):
+            fcntl.ioctl(self.fd, VIDIOC_QBUF, self._new_buffer(index))
+        fcntl.ioctl(self.fd, VIDIOC_STREAMON, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+    
+    def read_frame(self, timeout=0.5):
+        """
+        Next frame as (jpeg_bytes or None if the driver flagged it corrupt,
+        timestamp_s, sequence), or None when no frame arrived within timeout
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return None
+        buf = self._new_buffer()
+        try:
+            fcntl.ioctl(self.fd, VIDIOC_DQBUF, buf)
+        except BlockingIOError:
+            return None
+        try:
+            data = None if buf.flags & V4L2_BUF_FLAG_ERROR else self.buffers[buf.index][:buf.bytesused]
+        finally:
+            fcntl.ioctl(self.fd, VIDIOC_QBUF, buf)
+        return data, buf.timestamp.tv_sec + buf.timestamp.tv_usec / 1e6, buf.sequence
+    
+    def stop(self):
+        fcntl.ioctl(self.fd, VIDIOC_STREAMOFF, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+    
+    def close(self):
+        for buffer in self.buffers:
+            buffer.close()
+        self.buffers = []
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SimulatedV4L2Device:
+    """V4L2MjpegDevice stand-in replaying a SyntheticMjpegSource (monotonic timestamps)"""
+    
+    def __init__(self, device):
+        self.device = device
+        self.source = None
+        self.stream = None
+    
+    def open(self, width, height, fps):
+        self.source = SyntheticMjpegSource(width, height, fps)
+        return width, height, fps
+    
+    def start(self):
+        self.stream = self.source.frames(None)
+    
+    def read_frame(self, timeout=0.5):
+        return next(self.stream, None)
+    
+    def stop(self):
+        self.stream = None
+    
+    def close(self):
+        self.source = None
+
+
+def open_elp_v4l2_device(camera_index, width, height, fps):
+    """Open the ELP camera for native capture; returns (device, width, height, fps)"""
+    device_path = f'/dev/video{camera_index}'
+    device = SimulatedV4L2Device(device_path) if camera_sim_config['elp'] else V4L2MjpegDevice(device_path)
+    try:
+        return (device, *device.open(width, height, fps))
+    except Exception:
+        device.close()
+        raise
+
+
+class ElpV4L2Capture:
+    """
+    In-process ELP capture into an MJPEG ring buffer
+    
+    A capture thread dequeues frames from the device and keeps the newest
+    `capacity` JPEGs with their kernel timestamps and sequence numbers.
+    Timed captures stop after `duration` seconds of kernel time. Armed
+    captures run until trigger(): the ring then holds the pre-roll, and
+    capture continues for post_roll seconds.
+    """
+    
+    def __init__(self, device, fps, capacity):
+        self.device = device
+        self.fps = fps
+        self.capacity = capacity
+        self.frames = [None] * capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.sequences = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+        self.corrupt_frames = 0
+        self.duration = None
+        self.stop_at = None
+        self.trigger_time = None
+        self.stop_flag = False
+        self.started_at = None
+        self.first_frame_latency_ms = None
+        self.error = None
+        self.thread = None
+    
+    def start(self, duration=None):
+        self.duration = duration
+        self.started_at = time.monotonic()
+        self.device.start()
+        self.thread = threading.Thread(target=self._run, name='elp-v4l2-capture', daemon=True)
+        self.thread.start()
+    
+    def _run(self):
+        first_timestamp = None
+        try:
+            while not self.stop_flag:
+                frame = self.device.read_frame()
+                if frame is None:
+                    continue
+                data, timestamp, sequence = frame
+                if data is None:
+                    self.corrupt_frames += 1
+                    continue
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                    self.first_frame_latency_ms = round((time.monotonic() - self.started_at) * 1000, 2)
+                if self.duration and timestamp - first_timestamp >= self.duration:
+                    break
+                if self.stop_at is not None and timestamp >= self.stop_at:
+                    break
+                
+                slot = self.count % self.capacity
+                self.frames[slot] = data
+                self.timestamps[slot] = timestamp
+                self.sequences[slot] = sequence
+                self.count += 1
+        except Exception as e:
+            self.error = str(e)
+            print(f"❌ V4L2 capture error: {e}")
+        finally:
+            try:
+                self.device.stop()
+            except Exception as e:
+                print(f"⚠️ V4L2 stream off failed: {e}")
+    
+    def trigger(self, post_roll=0.0):
+        """Armed mode: keep capturing for post_roll seconds, then stop"""
+        self.trigger_time = time.monotonic()
+        self.stop_at = self.trigger_time + post_roll
+    
+    def wait(self):
+        self.thread.join()
+    
+    def stop(self):
+        self.stop_flag = True
+        self.thread.join()
+    
+    def ordered_indices(self, since=None):
+        """Ring slots oldest -> newest, optionally only frames at or after since (monotonic s)"""
+        stored = min(self.count, self.capacity)
+        indices = np.arange(self.count - stored, self.count) % self.capacity
+        if since is not None:
+            indices = indices[self.timestamps[indices] >= since]
+        return indices
+
+
+def build_mjpeg_capture_report(capture, indices, target_fps):
+    """Timing report for a native V4L2 capture (sequence gaps = dropped frames)"""
+    timestamps = capture.timestamps[indices]
+    sequences = capture.sequences[indices]
+    times = timestamps - timestamps[0]
+    intervals_ms = np.diff(times) * 1000.0
+    steps = np.diff(sequences)
+    dropped = int(np.sum(steps[steps > 1] - 1))
+    duration = float(times[-1])
+    measured_fps = (len(indices) - 1) / duration if duration > 0 else 0.0
+    return {
+        'frames': int(len(indices)),
+        'expected_frames': int(len(indices) + dropped),
+        'dropped_frames': dropped,
+        'corrupt_frames': capture.corrupt_frames,
+        'timestamp_source': 'kernel',
+        'duration': round(duration, 6),
+        'measured_fps': round(measured_fps, 3),
+        'target_fps': target_fps,
+        'interval_ms': {
+            'mean': round(float(np.mean(intervals_ms)), 4),
+            'std': round(float(np.std(intervals_ms)), 4),
+            'min': round(float(np.min(intervals_ms)), 4),
+            'max': round(float(np.max(intervals_ms)), 4)
+        },
+        'first_frame_latency_ms': capture.first_frame_latency_ms,
+        'pre_roll_s': round(capture.trigger_time - timestamps[0], 3) if capture.trigger_time else None,
+        'frame_times': [round(float(t), 6) for t in times]
+    }
+
+
+def mux_mjpeg_frames(frames, fps, out_path, frame_count=None):
+    """Stream-copy JPEG frames (a list, or any iterable with frame_count) into a video container"""
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'mjpeg', '-framerate', str(fps), '-i', 'pipe:0',
+        '-c:v', 'copy',
+        out_path
+    ]
+    process = process_supervisor.start(cmd, 'elp_mux', idle_timeout=FFMPEG_IDLE_TIMEOUT,
+                                       total_frames=frame_count or len(frames), stdin=subprocess.PIPE)
+    try:
+        for jpeg in frames:
+            process.stdin.write(jpeg)
+        process.stdin.close()
+    except BrokenPipeError:
+        print("❌ ffmpeg closed its input early")
+    process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f'MJPEG mux failed: {process.stderr_text()}')
+    return out_path
+
+
+def finish_elp_v4l2_capture(capture, raw_file):
+    """
+    Stop a native ELP capture and write its MJPEG master
+    
+    Armed captures are triggered here (keeping pre_roll seconds before now
+    plus post_roll after); timed captures are waited for.
+    
+    Returns:
+        capture report (also saved next to raw_file)
+    """
+    options = camera_state['elp_v4l2_options']
+    since = None
+    if options['armed']:
+        capture.trigger(options['post_roll'])
+        capture.wait()
+        since = capture.trigger_time - options['pre_roll']
+    else:
+        capture.wait()
+    capture.device.close()
+    
+    if capture.error:
+        raise RuntimeError(f'V4L2 capture failed: {capture.error}')
+    indices = capture.ordered_indices(since)
+    if len(indices) < 2:
+        raise RuntimeError(f'Only {len(indices)} frames captured')
+    
+    report = build_mjpeg_capture_report(capture, indices, options['fps'])
+    # Play back at the rate the frames were actually captured
+    mux_fps = round(report['measured_fps'], 3) or options['fps']
+    mux_mjpeg_frames([capture.frames[i] for i in indices], mux_fps, raw_file)
+    write_checksum_manifest(raw_file)
+    save_capture_report(raw_file, report)
+    print(f"📊 V4L2 capture: {report['frames']} frames, {report['dropped_frames']} dropped, "
+          f"{report['measured_fps']} fps (kernel timestamps)")
+    return report
+
+
+def start_recording_elp_v4l2(camera_index, data, raw_file, encoded_file, delivery=None):
+    """
+    Start a native (no ffmpeg) ELP capture into the MJPEG ring buffer
+    
+    Timed mode captures `duration` seconds and completes on its own, like
+    the ffmpeg path. Armed mode fills the ring continuously; stop_recording
+    is the trigger and keeps pre_roll seconds before it plus post_roll after.
+    """
+    duration = data.get('duration', 10)
+    fps = data.get('fps', 120)
+    armed = data.get('armed', False)
+    pre_roll = float(data.get('pre_roll', 2.0))
+    post_roll = float(data.get('post_roll', 1.0))
+    
+    device, width, height, fps = open_elp_v4l2_device(
+        camera_index, data.get('width', 1920), data.get('height', 1080), fps
+    )
+    window = pre_roll + post_roll if armed else duration
+    capacity = int(window * fps * 1.2) + int(fps)  # Headroom for timing jitter
+    capture = ElpV4L2Capture(device, fps, capacity)
+    capture.start(None if armed else duration)
+    
+    camera_state['elp_ffmpeg_process'] = None
+    camera_state['elp_v4l2_capture'] = capture
+    camera_state['elp_v4l2_options'] = {
+        'armed': armed, 'pre_roll': pre_roll, 'post_roll': post_roll, 'fps': fps
+    }
+    camera_state['elp_raw_file'] = raw_file
+    camera_state['elp_encoded_file'] = encoded_file
+    camera_state['elp_background_encode'] = data.get('background_encode', False)
+    camera_state['elp_output_profile'] = data.get('output_profile', 'default')
+    camera_state['elp_single_pass'] = False
+    camera_state['elp_segment_uploader'] = None
+    camera_state['elp_delivery'] = delivery
+    
+    if not armed:
+        def monitor_capture():
+            """Complete the recording once the timed capture has finished"""
+            capture.wait()
+            if camera_state['recording'] and camera_state['elp_v4l2_capture'] is capture:
+                stop_result = stop_recording_elp_imx577()
+                camera_state['recording'] = False
+                if stop_result.get('success'):
+                    print(f"✅ ELP V4L2 recording completed: {stop_result.get('encoded_file') or stop_result.get('encode_job')}")
+                else:
+                    print(f"❌ ELP V4L2 recording completion failed: {stop_result.get('error')}")
+        
+        threading.Thread(target=monitor_capture, daemon=True).start()
+    
+    print(f"🎥 Native V4L2 capture {'armed' if armed else 'started'}: {width}x{height} @ {fps} fps, "
+          f"ring {capacity} frames")
+    return {
+        'success': True,
+        'type': 'recording_armed' if armed else 'recording_started',
+        'camera_model': 'elp_imx577',
+        'camera_index': camera_index,
+        'backend': 'v4l2',
+        'armed': armed,
+        'pre_roll': pre_roll if armed else None,
+        'post_roll': post_roll if armed else None,
+        'duration': None if armed else duration,
+        'resolution': f'{width}x{height}',
+        'fps': fps,
+        'ring_frames': capacity,
+        'raw_file': raw_file,
+        'encoded_file': encoded_file,
+        'message': 'Armed: stop_recording triggers' if armed else 'Recording started (native V4L2)',
+        'timestamp': time.time()
+    }
+
+
+def start_recording_elp_imx577(camera_index, data):
+    """
+    Start recording with ELP IMX577 camera using ffmpeg
     
     Process:
     1. Set camera controls via v4l2-ctl
     2. Capture MJPEG to raw file using ffmpeg
     3. Re-encode to H.264 MP4 after recording stops
     
+    With single_pass the same ffmpeg process also encodes the H.264 MP4
+    while capturing, so the MP4 is ready as soon as capture ends. The MJPEG
+    master is kept unless keep_mjpeg is False.
+    
+    With delivery='offload' nothing is re-encoded on the Pi: the MJPEG
+    master (optionally remuxed to MP4) is uploaded for the server to
+    transcode; 'auto' picks whichever estimate_elp_delivery() expects to
+    be faster.
+    
     Specs:
     - 12MP sensor
     - 4K @ 30fps: 3840x3040
@@ -287,65 +2182,149 @@ def start_recording_elp_imx577(camera_index, data):
     width = data.get('width', 1920)
     height = data.get('height', 1080)
     fps = data.get('fps', 120)
+    segment_seconds = data.get('segment_seconds')
+    single_pass = data.get('single_pass', False) or bool(segment_seconds)
+    output_profile = data.get('output_profile', 'default')
     
     device = f'/dev/video{camera_index}'
     os.makedirs(camera_state['recording_path'], exist_ok=True)
+    try:
+        delivery = get_elp_delivery_options(data)
+    except ValueError as e:
+        return {
+            'success': False,
+            'type': 'recording_error',
+            'error': str(e),
+            'timestamp': time.time()
+        }
     
     # Generate filenames with camera name prefix
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
     raw_file = os.path.join(camera_state['recording_path'], f'elp_imx577_capture_{ts}_{width}x{height}_{fps}fps.mkv')
     encoded_file = os.path.join(camera_state['recording_path'], f'elp_imx577_capture_{ts}_{width}x{height}_{fps}fps.mp4')
     
+    # Native capture: frames land in a Python ring buffer, ffmpeg only muxes afterwards
+    if data.get('backend') == 'v4l2':
+        try:
+            return start_recording_elp_v4l2(camera_index, data, raw_file, encoded_file, delivery)
+        except Exception as e:
+            return {
+                'success': False,
+                'type': 'recording_error',
+                'error': f'V4L2 capture failed to start: {e}',
+                'timestamp': time.time()
+            }
+    
     # Simple camera setup (no control modifications)
     
+    # Simulated camera: same MJPEG stream-copy, fed from a pipe instead of V4L2
+    simulated = camera_sim_config['elp']
+    if simulated:
+        input_args = ['-f', 'mjpeg', '-framerate', str(fps), '-i', 'pipe:0']
+    else:
+        input_args = [
+            '-f', 'v4l2',
+            '-input_format', 'mjpeg',
+            '-video_size', f'{width}x{height}',
+            '-framerate', str(fps),
+            '-thread_queue_size', '512',
+            '-i', device
+        ]
+    
     # Start ffmpeg capture
+    if single_pass:
+        # One input, two outputs: MJPEG stream copy + H.264 encode
+        output_args = []
+        if data.get('keep_mjpeg', True):
+            output_args += ['-map', '0:v', '-c:v', 'copy', '-t', str(duration), raw_file]
+        else:
+            raw_file = None
+        output_args += [
+            '-map', '0:v',
+            *get_elp_encode_args(output_profile, ELP_ENCODE_DEFAULTS['single_pass_preset'], bool(segment_seconds)),
+            '-t', str(duration)
+        ]
+        if segment_seconds:
+            # encoded_file is the manifest; segments are <name>_seg000.mp4, ...
+            base = os.path.splitext(encoded_file)[0]
+            encoded_file = base + '.ffconcat'
+            output_args += get_elp_segment_args(segment_seconds, encoded_file, base + '_seg%03d.mp4')
+        else:
+            output_args.append(encoded_file)
+    else:
+        output_args = ['-c:v', 'copy', '-t', str(duration), raw_file]
     capture_cmd = [
         'ffmpeg', '-y',
-        '-f', 'v4l2',
-        '-input_format', 'mjpeg',
-        '-video_size', f'{width}x{height}',
-        '-framerate', str(fps),
-        '-thread_queue_size', '512',
-        '-i', device,
-        '-c:v', 'copy',
-        '-t', str(duration),
-        raw_file
+        *input_args,
+        *output_args
     ]
     
     try:
         print(f"🎥 Starting ffmpeg command: {' '.join(capture_cmd)}")
         
-        process = subprocess.Popen(
-            capture_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+        # Own pipe (not Popen stdin) so the feed stays under the source's control
+        sim_read_fd = sim_write_fd = None
+        if simulated:
+            sim_read_fd, sim_write_fd = os.pipe()
+        
+        process = process_supervisor.start(
+            capture_cmd, 'elp_capture',
+            timeout=duration + ELP_CAPTURE_TIMEOUT_MARGIN,
+            idle_timeout=FFMPEG_IDLE_TIMEOUT,
+            total_seconds=duration,
+            stdin=sim_read_fd
         )
         
         print(f"🔄 ffmpeg process started, PID: {process.pid}")
         
+        # Opt-in real-time profile for the capture process (no GC control: not Python)
+        camera_state['realtime_cpu'] = None
+        realtime_profile = summarize_realtime_profile(enter_realtime_profile(data.get('realtime'), pid=process.pid))
+        
+        if simulated:
+            os.close(sim_read_fd)
+            source = SyntheticMjpegSource(width, height, fps)
+            threading.Thread(
+                target=source.feed,
+                args=(os.fdopen(sim_write_fd, 'wb'), duration),
+                daemon=True
+            ).start()
+        
         camera_state['elp_ffmpeg_process'] = process
         camera_state['elp_raw_file'] = raw_file
         camera_state['elp_encoded_file'] = encoded_file
+        camera_state['elp_background_encode'] = data.get('background_encode', False)
+        camera_state['elp_output_profile'] = output_profile
+        camera_state['elp_single_pass'] = single_pass
+        camera_state['elp_segment_uploader'] = None
+        camera_state['elp_delivery'] = delivery
+        if segment_seconds:
+            upload = None
+            if data.get('upload_segments'):
+                upload = {'server_ip': data.get('server_ip', '192.168.1.2'), 'raspi_id': data.get('raspi_id')}
+            camera_state['elp_segment_uploader'] = ElpSegmentUploader(encoded_file, process, upload)
+            camera_state['elp_segment_uploader'].start()
         
         # Start monitoring thread to auto-complete recording after duration
         def monitor_recording():
             """Monitor ffmpeg process and complete recording when done"""
             try:
-                print(f"🔄 ELP Monitor: Waiting for ffmpeg process to complete (no timeout)")
+                print(f"🔄 ELP Monitor: Waiting for ffmpeg process to complete "
+                      f"(timeout {process.timeout}s, idle {process.idle_timeout}s)")
                 
-                # Wait indefinitely for process completion
-                stdout, stderr = process.communicate()
+                # The supervisor kills the capture if it overruns or hangs
+                process.wait()
                 
-                print(f"🎬 ELP Monitor: ffmpeg process completed with return code: {process.returncode}")
-                print(f"📄 ffmpeg stdout: {stdout.decode() if stdout else 'None'}")
-                print(f"📄 ffmpeg stderr: {stderr.decode() if stderr else 'None'}")
+                print(f"🎬 ELP Monitor: ffmpeg process {process.status} with return code: {process.returncode}")
+                print(f"📄 ffmpeg stderr (last lines): {process.stderr_text() or 'None'}")
                 
-                # Check if the raw file actually exists
-                if os.path.exists(raw_file):
-                    file_size = os.path.getsize(raw_file)
-                    print(f"✅ Raw file created: {raw_file} ({file_size} bytes)")
+                # Check if the raw file (or the single-pass MP4) actually exists
+                output_file = raw_file or encoded_file
+                if os.path.exists(output_file):
+                    file_size = os.path.getsize(output_file)
+                    print(f"✅ Output file created: {output_file} ({file_size} bytes)")
                 else:
-                    print(f"❌ Raw file NOT created: {raw_file}")
+                    print(f"❌ Output file NOT created: {output_file}")
                     camera_state['recording'] = False
                     return
                 
@@ -358,8 +2337,11 @@ def start_recording_elp_imx577(camera_index, data):
                     
                     if stop_result.get('success'):
                         camera_state['recording'] = False
-                        camera_state['last_recording'] = stop_result.get('encoded_file')
-                        print(f"✅ ELP recording completed: {camera_state['last_recording']}")
+                        if stop_result.get('encode_job'):
+                            print(f"✅ ELP recording completed, encode queued: {stop_result['encode_job']['id']}")
+                        else:
+                            camera_state['last_recording'] = stop_result.get('encoded_file')
+                            print(f"✅ ELP recording completed: {camera_state['last_recording']}")
                     else:
                         print(f"❌ ELP recording completion failed: {stop_result.get('error')}")
                         camera_state['recording'] = False
@@ -389,6 +2371,9 @@ def start_recording_elp_imx577(camera_index, data):
             'fps': fps,
             'raw_file': raw_file,
             'encoded_file': encoded_file,
+            'single_pass': single_pass,
+            'segment_seconds': segment_seconds,
+            'realtime_profile': realtime_profile,
             'message': 'Recording started with ffmpeg',
             'timestamp': time.time()
         }
@@ -402,35 +2387,539 @@ def start_recording_elp_imx577(camera_index, data):
         }
 
 
-def daheng_capture_thread_func(cam, buffer_frames, target_fps):
-    """Thread function for capturing Daheng frames to RAM"""
-    print(f"🎬 Daheng capture thread starting...")
-    
-    # Initialize gxipy in this thread context
+def get_daheng_device_timestamp(raw_image):
+    """
+    Read the device (hardware) timestamp of a Daheng frame
+
+    Returns 0 when the camera/SDK does not provide one, so the capture
+    loop never has to handle a missing timestamp.
+    """
     try:
-        gx.gx_init_lib()
-        print(f"✅ gxipy initialized in capture thread")
+        return int(raw_image.get_timestamp())
+    except Exception:
+        return 0
+
+
+def get_daheng_tick_frequency(cam):
+    """
+    Get the device timestamp tick frequency in Hz
+
+    USB3 Vision cameras count in nanoseconds; use the camera's own
+    TimestampTickFrequency when it reports one.
+    """
+    try:
+        if hasattr(cam, 'TimestampTickFrequency') and cam.TimestampTickFrequency.is_implemented():
+            tick_hz = float(cam.TimestampTickFrequency.get())
+            if tick_hz > 0:
+                return tick_hz
     except Exception as e:
-        print(f"⚠️ gxipy thread init warning: {e}")
-    
-    # Wait for first frame with retry logic
-    raw_image = None
-    max_retries = 10
-    for attempt in range(max_retries):
-        try:
-            raw_image = cam.data_stream[0].get_image(timeout=1000)
-            if raw_image is not None:
-                break
-        except Exception as e:
-            print(f"   Attempt {attempt + 1}/{max_retries}: Waiting for data stream... ({e})")
-            time.sleep(0.1)
-    
-    if raw_image is None:
-        print(f"❌ Daheng: Failed to get first frame after {max_retries} attempts")
-        return
-    
-    first_numpy = raw_image.get_numpy_array()
-    if first_numpy is None or first_numpy.ndim != 2:
+        print(f"⚠️ Could not read TimestampTickFrequency: {e}")
+    return 1e9
+
+
+def get_daheng_ordered_indices():
+    """
+    Get ring buffer indices in chronological order (oldest -> newest)
+    """
+    frame_buffer = camera_state['daheng_frame_buffer']
+    frame_count = camera_state['daheng_frame_count']
+
+    if frame_buffer is None or frame_count == 0:
+        return np.empty(0, dtype=np.int64)
+
+    buffer_size = frame_buffer.shape[0]
+    total_frames = min(frame_count, buffer_size)
+
+    if frame_count <= buffer_size:
+        # Never wrapped. Valid frames are [0 .. total_frames-1]
+        start = 0
+    else:
+        # Wrapped at least once. Oldest frame is at 'head'
+        start = camera_state['daheng_head']
+
+    return (start + np.arange(total_frames)) % buffer_size
+
+
+def get_frame_times(host_ts, dev_ts=None, tick_hz=1e9):
+    """
+    Frame times in seconds since the first frame
+    
+    Prefers hardware timestamps (no scheduler jitter) when every frame has
+    one and they increase; falls back to host timestamps.
+    
+    Returns:
+        (times array, 'device' or 'host')
+    """
+    if dev_ts is not None and np.all(dev_ts > 0) and np.all(np.diff(dev_ts) > 0):
+        return (dev_ts - dev_ts[0]) / (tick_hz or 1e9), 'device'
+    return host_ts - host_ts[0], 'host'
+
+
+def get_daheng_frame_times(indices):
+    """Frame times (seconds since the first of indices) from the Daheng ring buffer"""
+    dev_ts_buffer = camera_state['daheng_dev_ts_buffer']
+    return get_frame_times(
+        camera_state['daheng_ts_buffer'][indices],
+        dev_ts_buffer[indices] if dev_ts_buffer is not None else None,
+        camera_state['daheng_tick_hz']
+    )
+
+
+def build_daheng_capture_report(target_fps=220):
+    """
+    Build a per-recording timing report from the Daheng ring buffer
+
+    Uses frame ID discontinuities to count dropped frames and the device
+    timestamps (falling back to host timestamps) for inter-frame intervals.
+
+    Returns:
+        dict with dropped count, longest gap and an interval histogram
+    """
+    indices = get_daheng_ordered_indices()
+    dev_ts_buffer = camera_state['daheng_dev_ts_buffer']
+    return build_capture_report(
+        camera_state['daheng_ts_buffer'][indices],
+        camera_state['daheng_id_buffer'][indices],
+        dev_ts_buffer[indices] if dev_ts_buffer is not None else None,
+        camera_state['daheng_tick_hz'],
+        target_fps
+    )
+
+
+def build_capture_report(host_ts, frame_ids, dev_ts=None, tick_hz=1e9, target_fps=220):
+    """
+    Timing report for a sequence of Daheng frames (see build_daheng_capture_report)
+
+    Args:
+        host_ts, frame_ids, dev_ts: Per-frame arrays in capture order
+
+    Returns:
+        Report dict, or None for fewer than two frames
+    """
+    if len(host_ts) < 2:
+        return None
+
+    times, timestamp_source = get_frame_times(host_ts, dev_ts, tick_hz)
+
+    intervals = np.diff(times)
+    host_intervals = np.diff(host_ts)
+
+    # Frame ID gaps: a step of N > 1 means N - 1 frames never reached us.
+    # A step <= 0 means the counter restarted (stream_off/on), not a drop.
+    id_steps = np.diff(frame_ids)
+    gap_mask = id_steps > 1
+    id_resets = int(np.count_nonzero(id_steps <= 0))
+    dropped = int(np.sum(id_steps[gap_mask] - 1))
+
+    longest_gap = {'frames': 0, 'ms': 0.0, 'at_frame': None}
+    if np.any(gap_mask):
+        gap_pos = int(np.argmax(np.where(gap_mask, id_steps, 0)))
+        longest_gap = {
+            'frames': int(id_steps[gap_pos] - 1),
+            'ms': round(float(intervals[gap_pos]) * 1000.0, 3),
+            'at_frame': int(frame_ids[gap_pos])
+        }
+
+    duration = float(times[-1])
+    measured_fps = (len(host_ts) - 1) / duration if duration > 0 else 0.0
+
+    # Histogram in multiples of the nominal frame period
+    nominal_ms = 1000.0 / (measured_fps or target_fps)
+    edges = np.array([0.0, 0.5, 0.9, 1.1, 1.5, 2.5, np.inf]) * nominal_ms
+    intervals_ms = intervals * 1000.0
+    counts, _ = np.histogram(intervals_ms, bins=edges)
+    histogram = [
+        {
+            'min_ms': round(float(edges[i]), 3),
+            'max_ms': None if np.isinf(edges[i + 1]) else round(float(edges[i + 1]), 3),
+            'count': int(counts[i])
+        }
+        for i in range(len(counts))
+    ]
+
+    return {
+        'frames': int(len(host_ts)),
+        'first_frame_id': int(frame_ids[0]),
+        'last_frame_id': int(frame_ids[-1]),
+        'expected_frames': int(len(host_ts) + dropped),
+        'dropped_frames': dropped,
+        'gap_count': int(np.count_nonzero(gap_mask)),
+        'id_resets': id_resets,
+        'longest_gap': longest_gap,
+        'timestamp_source': timestamp_source,
+        'tick_hz': tick_hz,
+        'duration': round(duration, 6),
+        'measured_fps': round(measured_fps, 3),
+        'interval_ms': {
+            'mean': round(float(np.mean(intervals_ms)), 4),
+            'std': round(float(np.std(intervals_ms)), 4),
+            'min': round(float(np.min(intervals_ms)), 4),
+            'max': round(float(np.max(intervals_ms)), 4)
+        },
+        'host_jitter_ms': round(float(np.std(host_intervals)) * 1000.0, 4),
+        'interval_histogram': histogram
+    }
+
+
+def save_capture_report(video_path, report):
+    """
+    Store a capture report next to the video file (<video>.json)
+
+    Returns path to the report file, or None on failure
+    """
+    if not video_path or not report:
+        return None
+
+    report_path = os.path.splitext(video_path)[0] + '.json'
+    try:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report_path
+    except Exception as e:
+        print(f"⚠️ Failed to write capture report: {e}")
+        return None
+
+
+# Default Daheng feature values (applied on first open, then only when changed)
+DAHENG_DEFAULT_SETTINGS = {
+    'exposure': 1500.0,  # microseconds
+    'gain': 24.0,  # dB
+    'gamma': 0.4,
+    'contrast': -50,
+    'fps': 220,
+    
+    # Capture geometry (None = full sensor)
+    'width': None,
+    'height': None,
+    'offset_x': 0,
+    'offset_y': 0,
+    'binning': 1,
+    'decimation': 1
+}
+
+DAHENG_GEOMETRY_SETTINGS = ('width', 'height', 'offset_x', 'offset_y', 'binning', 'decimation')
+
+
+def get_daheng_settings(data):
+    """Extract Daheng feature settings from command data"""
+    return {key: data.get(key, default) for key, default in DAHENG_DEFAULT_SETTINGS.items()}
+
+
+def set_daheng_int_feature(cam, name, value):
+    """
+    Set an integer feature, clamped and aligned to the camera's range
+    
+    Returns:
+        Value actually written, or None if the feature is not available
+    """
+    feature = getattr(cam, name, None)
+    if feature is None or not feature.is_implemented() or not feature.is_writable():
+        return None
+    
+    value = int(value)
+    try:
+        feature_range = feature.get_range()
+        minimum = int(feature_range['min'])
+        maximum = int(feature_range['max'])
+        inc = max(int(feature_range.get('inc', 1)), 1)
+        value = min(max(value, minimum), maximum)
+        value = minimum + (value - minimum) // inc * inc
+    except Exception:
+        pass  # No range info - let the camera reject invalid values
+    
+    feature.set(value)
+    return value
+
+
+def get_daheng_int_feature(cam, name, default=None):
+    """Read an integer feature (default if not available)"""
+    feature = getattr(cam, name, None)
+    try:
+        if feature is not None and feature.is_implemented():
+            return int(feature.get())
+    except Exception:
+        pass
+    return default
+
+
+def get_daheng_int_feature_max(cam, name):
+    """Get the current maximum of an integer feature (None if unknown)"""
+    feature = getattr(cam, name, None)
+    try:
+        return int(feature.get_range()['max'])
+    except Exception:
+        return None
+
+
+def apply_daheng_geometry(cam, settings):
+    """
+    Configure sensor ROI, binning and decimation
+    
+    Offsets are cleared first so a larger ROI always fits, binning and
+    decimation are set before Width/Height because they change the maximum
+    image size. Offsets are kept even so the Bayer pattern stays BG.
+    """
+    set_daheng_int_feature(cam, 'OffsetX', 0)
+    set_daheng_int_feature(cam, 'OffsetY', 0)
+    
+    for name in ('BinningHorizontal', 'BinningVertical'):
+        if set_daheng_int_feature(cam, name, settings['binning']) is None and settings['binning'] != 1:
+            print(f"⚠️ {name} not supported, ignoring binning={settings['binning']}")
+    
+    for name in ('DecimationHorizontal', 'DecimationVertical'):
+        if set_daheng_int_feature(cam, name, settings['decimation']) is None and settings['decimation'] != 1:
+            print(f"⚠️ {name} not supported, ignoring decimation={settings['decimation']}")
+    
+    width = settings['width'] or get_daheng_int_feature_max(cam, 'Width')
+    height = settings['height'] or get_daheng_int_feature_max(cam, 'Height')
+    if width:
+        width = set_daheng_int_feature(cam, 'Width', width)
+    if height:
+        height = set_daheng_int_feature(cam, 'Height', height)
+    
+    offset_x = set_daheng_int_feature(cam, 'OffsetX', int(settings['offset_x']) // 2 * 2)
+    offset_y = set_daheng_int_feature(cam, 'OffsetY', int(settings['offset_y']) // 2 * 2)
+    
+    print(f"📐 Capture geometry: {width}x{height} at ({offset_x}, {offset_y}), "
+          f"binning {settings['binning']}, decimation {settings['decimation']}")
+
+
+def get_daheng_max_fps(cam):
+    """Frame rate limit reported by the camera for the current geometry/exposure"""
+    for name in ('CurrentAcquisitionFrameRate', 'AcquisitionResultingFrameRate'):
+        feature = getattr(cam, name, None)
+        try:
+            if feature is not None and feature.is_implemented():
+                return round(float(feature.get()), 2)
+        except Exception:
+            pass
+    return None
+
+
+def get_daheng_capture_mode(cam, width=None, height=None):
+    """
+    Capture mode the camera is configured for (ROI/binning/decimation)
+    
+    Args:
+        width, height: Frame size actually delivered (default: the Width/Height features)
+    """
+    return {
+        'width': width or get_daheng_int_feature(cam, 'Width'),
+        'height': height or get_daheng_int_feature(cam, 'Height'),
+        'offset_x': get_daheng_int_feature(cam, 'OffsetX', 0),
+        'offset_y': get_daheng_int_feature(cam, 'OffsetY', 0),
+        'binning': get_daheng_int_feature(cam, 'BinningVertical', 1),
+        'decimation': get_daheng_int_feature(cam, 'DecimationVertical', 1),
+        'camera_max_fps': get_daheng_max_fps(cam)
+    }
+
+
+def record_daheng_mode_fps(capture_mode, actual_fps):
+    """
+    Track the fps achieved per capture mode (ROI/binning/decimation)
+    
+    Returns:
+        Stats for all capture modes recorded so far
+    """
+    mode_key = (f"{capture_mode['width']}x{capture_mode['height']}"
+                f"+{capture_mode['offset_x']}+{capture_mode['offset_y']}"
+                f"_bin{capture_mode['binning']}_dec{capture_mode['decimation']}")
+    stats = camera_state['daheng_mode_stats'].setdefault(mode_key, {
+        'recordings': 0,
+        'best_fps': 0.0,
+        'last_fps': 0.0
+    })
+    stats['recordings'] += 1
+    stats['last_fps'] = round(actual_fps, 1)
+    stats['best_fps'] = max(stats['best_fps'], stats['last_fps'])
+    return camera_state['daheng_mode_stats']
+
+
+def open_daheng_session():
+    """
+    Get the open Daheng camera, opening it only if no session exists
+    
+    Keeping the device open between races avoids the device enumeration,
+    open and full feature rewrite on every recording.
+    
+    Returns:
+        gxipy device, or None if no Daheng camera is connected
+    """
+    session = camera_state['daheng_session']
+    if session['cam'] is not None:
+        return session['cam']
+    
+    device_manager = gx.DeviceManager()
+    dev_num, dev_info_list = device_manager.update_all_device_list()
+    
+    if dev_num == 0:
+        return None
+    
+    # For Daheng cameras, use device index 1 (first Daheng camera)
+    # camera_index is virtual (101+), but gxipy uses 1-based indexing
+    daheng_device_index = 1  # First (and likely only) Daheng camera
+    print(f"📹 Opening Daheng camera at gxipy index {daheng_device_index}")
+    cam = device_manager.open_device_by_index(daheng_device_index)
+    
+    session['cam'] = cam
+    session['settings'] = {}
+    session['streaming'] = False
+    session['opened_at'] = time.time()
+    
+    # TriggerMode only needs to be set once per open
+    if cam.TriggerMode.is_implemented() and cam.TriggerMode.is_writable():
+        cam.TriggerMode.set(gx.GxSwitchEntry.OFF)
+        print(f"✅ Set TriggerMode to OFF")
+    
+    return cam
+
+
+def apply_daheng_settings(cam, settings):
+    """
+    Write only the settings that changed since the last recording
+    
+    Returns:
+        List of setting names that were written to the camera
+    """
+    session = camera_state['daheng_session']
+    applied = session['settings']
+    changed = [key for key, value in settings.items() if applied.get(key) != value]
+    
+    if not changed:
+        print(f"📊 Daheng settings unchanged, skipping configuration")
+        return []
+    
+    print(f"📊 Configuring Daheng camera settings: {', '.join(changed)}")
+    
+    # Geometry first: it changes the frame rate limit
+    if any(key in changed for key in DAHENG_GEOMETRY_SETTINGS):
+        apply_daheng_geometry(cam, settings)
+    
+    if 'exposure' in changed:
+        if cam.ExposureTime.is_implemented() and cam.ExposureTime.is_writable():
+            cam.ExposureTime.set(settings['exposure'])
+            print(f"📊 Set Exposure to {settings['exposure']}μs")
+    
+    if 'gain' in changed:
+        if cam.Gain.is_implemented() and cam.Gain.is_writable():
+            cam.Gain.set(settings['gain'])
+            print(f"📊 Set Gain to {settings['gain']}dB")
+    
+    # Set gamma (check if writable)
+    if 'gamma' in changed:
+        if hasattr(cam, 'GammaEnable') and cam.GammaEnable.is_implemented() and cam.GammaEnable.is_writable():
+            cam.GammaEnable.set(True)
+        if hasattr(cam, 'Gamma') and cam.Gamma.is_implemented() and cam.Gamma.is_writable():
+            cam.Gamma.set(settings['gamma'])
+            print(f"📊 Set Gamma to {settings['gamma']}")
+        else:
+            print(f"⚠️ Gamma control not writable, using camera defaults")
+    
+    # Set contrast (check if writable)
+    if 'contrast' in changed:
+        if hasattr(cam, 'ContrastParam') and cam.ContrastParam.is_implemented() and cam.ContrastParam.is_writable():
+            cam.ContrastParam.set(settings['contrast'])
+            print(f"📊 Set Contrast to {settings['contrast']}")
+        else:
+            print(f"⚠️ Contrast control not writable, using camera defaults")
+    
+    # Set FPS (exactly like working test_camera_imx273.py)
+    if 'fps' in changed or any(key in changed for key in DAHENG_GEOMETRY_SETTINGS):
+        if hasattr(cam, 'AcquisitionFrameRate') and cam.AcquisitionFrameRate.is_implemented():
+            if cam.AcquisitionFrameRate.is_writable():
+                try:
+                    if hasattr(cam, 'AcquisitionFrameRateMode'):
+                        cam.AcquisitionFrameRateMode.set(gx.GxSwitchEntry.ON)
+                except Exception:
+                    pass
+                cam.AcquisitionFrameRate.set(float(settings['fps']))
+                print(f"📊 Set FPS to {settings['fps']}")
+    
+    # Only remember settings once they were all written successfully
+    applied.update({key: settings[key] for key in changed})
+    return changed
+
+
+def start_daheng_stream(cam):
+    """Start streaming (no-op if the session is already streaming)"""
+    session = camera_state['daheng_session']
+    if session['streaming']:
+        return
+    
+    cam.stream_on()
+    session['streaming'] = True
+    
+    # Drop frames queued before this recording started
+    try:
+        cam.data_stream[0].flush_queue()
+    except Exception:
+        pass
+
+
+def stop_daheng_stream():
+    """Stop streaming but keep the device open and configured"""
+    session = camera_state['daheng_session']
+    if session['cam'] is None or not session['streaming']:
+        return
+    
+    try:
+        session['cam'].stream_off()
+        print("🛑 Daheng camera streaming stopped")
+    except Exception as e:
+        print(f"⚠️ Warning stopping stream: {e}")
+    session['streaming'] = False
+
+
+def release_daheng_session():
+    """Stop streaming and close the Daheng device"""
+    session = camera_state['daheng_session']
+    cam = session['cam']
+    if cam is None:
+        return False
+    
+    stop_daheng_stream()
+    try:
+        cam.close_device()
+        print("🔒 Daheng camera closed")
+    except Exception as e:
+        print(f"⚠️ Warning closing camera: {e}")
+    
+    session['cam'] = None
+    session['settings'] = {}
+    session['streaming'] = False
+    session['opened_at'] = None
+    return True
+
+
+def daheng_capture_thread_func(cam, buffer_frames, target_fps):
+    """Thread function for capturing Daheng frames to RAM"""
+    print(f"🎬 Daheng capture thread starting...")
+    
+    # Initialize gxipy in this thread context
+    try:
+        gx.gx_init_lib()
+        print(f"✅ gxipy initialized in capture thread")
+    except Exception as e:
+        print(f"⚠️ gxipy thread init warning: {e}")
+    
+    # Wait for first frame with retry logic
+    raw_image = None
+    max_retries = 10
+    for attempt in range(max_retries):
+        try:
+            raw_image = cam.data_stream[0].get_image(timeout=1000)
+            if raw_image is not None:
+                break
+        except Exception as e:
+            print(f"   Attempt {attempt + 1}/{max_retries}: Waiting for data stream... ({e})")
+            time.sleep(0.1)
+    
+    if raw_image is None:
+        print(f"❌ Daheng: Failed to get first frame after {max_retries} attempts")
+        return
+    
+    first_numpy = raw_image.get_numpy_array()
+    if first_numpy is None or first_numpy.ndim != 2:
         print(f"❌ Daheng: Invalid first frame data")
         return
     
@@ -440,6 +2929,7 @@ def daheng_capture_thread_func(cam, buffer_frames, target_fps):
     camera_state['daheng_frame_buffer'] = np.empty((buffer_frames, height, width), dtype=np.uint8)
     camera_state['daheng_ts_buffer'] = np.empty(buffer_frames, dtype=np.float64)
     camera_state['daheng_id_buffer'] = np.empty(buffer_frames, dtype=np.int64)
+    camera_state['daheng_dev_ts_buffer'] = np.zeros(buffer_frames, dtype=np.int64)
     camera_state['daheng_head'] = 0
     camera_state['daheng_frame_count'] = 0
     
@@ -447,6 +2937,7 @@ def daheng_capture_thread_func(cam, buffer_frames, target_fps):
     camera_state['daheng_frame_buffer'][0, :, :] = first_numpy
     camera_state['daheng_ts_buffer'][0] = time.time()
     camera_state['daheng_id_buffer'][0] = raw_image.get_frame_id()
+    camera_state['daheng_dev_ts_buffer'][0] = get_daheng_device_timestamp(raw_image)
     camera_state['daheng_head'] = 1
     camera_state['daheng_frame_count'] = 1
     
@@ -471,18 +2962,73 @@ def daheng_capture_thread_func(cam, buffer_frames, target_fps):
         camera_state['daheng_frame_buffer'][head, :, :] = numpy_image
         camera_state['daheng_ts_buffer'][head] = time.time()
         camera_state['daheng_id_buffer'][head] = raw_image.get_frame_id()
+        camera_state['daheng_dev_ts_buffer'][head] = get_daheng_device_timestamp(raw_image)
         
         camera_state['daheng_head'] = (head + 1) % buffer_frames
         camera_state['daheng_frame_count'] += 1
 
 
+def capture_daheng_frames(cam, buffer_frames, target_end_time, start_time, report_interval=500):
+    """
+    Capture loop: store Daheng frames in the RAM ring buffer until the end
+    time or the stop flag
+    
+    Kept free of allocations and logging beyond the periodic progress report
+    so it can run on the real-time profile's dedicated core.
+    """
+    frame_count = camera_state['daheng_frame_count']  # Start from 1 (first frame already captured)
+    last_report_time = start_time
+    
+    while time.time() < target_end_time and not camera_state['daheng_stop_flag']:
+        try:
+            # Use same timeout as working test_camera_imx273.py
+            raw_image = cam.data_stream[0].get_image(timeout=1000)
+            if raw_image is None:
+                continue
+            
+            numpy_image = raw_image.get_numpy_array()
+            if numpy_image is None:
+                continue
+            
+            # Store in ring buffer (optimized)
+            head = frame_count % buffer_frames
+            camera_state['daheng_frame_buffer'][head, :, :] = numpy_image
+            camera_state['daheng_ts_buffer'][head] = time.time()
+            camera_state['daheng_id_buffer'][head] = raw_image.get_frame_id()
+            camera_state['daheng_dev_ts_buffer'][head] = get_daheng_device_timestamp(raw_image)
+            
+            frame_count += 1
+            camera_state['daheng_frame_count'] = frame_count  # ✅ UPDATE GLOBAL STATE!
+            
+            # Less frequent progress reports for high-speed capture
+            if frame_count % report_interval == 0:
+                current_time = time.time()
+                elapsed_since_report = current_time - last_report_time
+                if elapsed_since_report > 0:
+                    current_fps = report_interval / elapsed_since_report
+                    total_elapsed = current_time - start_time
+                    avg_fps = frame_count / total_elapsed if total_elapsed > 0 else 0
+                    print(f"📊 {frame_count} frames, current: {current_fps:.1f} fps, avg: {avg_fps:.1f} fps")
+                    last_report_time = current_time
+            
+        except Exception as e:
+            print(f"⚠️ Capture error: {e}")
+            continue  # Remove sleep for maximum speed
+    
+    # Update final frame count and head position
+    camera_state['daheng_frame_count'] = frame_count  # ✅ ENSURE FINAL COUNT IS SAVED!
+    camera_state['daheng_head'] = frame_count % buffer_frames
+    
+    return frame_count
+
+
 def start_recording_daheng_imx273(camera_index, data):
     """
     Start recording with Daheng IMX273 camera using gxipy SDK
     
     Process:
-    1. Open camera with Daheng SDK
-    2. Configure camera settings (exposure, gain, gamma, etc.)
+    1. Open camera with Daheng SDK (or reuse the open session)
+    2. Configure camera settings that changed (exposure, gain, gamma, etc.)
     3. Capture Bayer frames to RAM ring buffer
     4. After stop, demosaic and encode to MP4
     
@@ -500,31 +3046,21 @@ def start_recording_daheng_imx273(camera_index, data):
             'timestamp': time.time()
         }
     
+    request_time = time.time()
+    
     duration = data.get('duration', 10)
-    fps = data.get('fps', 220)
-    exposure = data.get('exposure', 1500.0)  # microseconds
-    gain = data.get('gain', 24.0)  # dB
-    gamma = data.get('gamma', 0.4)
-    contrast = data.get('contrast', -50)
+    settings = get_daheng_settings(data)
+    fps = settings['fps']
+    exposure = settings['exposure']
+    gain = settings['gain']
     
     buffer_frames = int(fps * duration)
     
     try:
-        # Ensure any existing Daheng camera is properly closed
-        if camera_state['daheng_cam'] is not None:
-            print("🔄 Closing existing Daheng camera connection...")
-            try:
-                camera_state['daheng_cam'].stream_off()
-                camera_state['daheng_cam'].close_device()
-            except Exception as e:
-                print(f"⚠️ Warning closing existing camera: {e}")
-            camera_state['daheng_cam'] = None
-        
-        # Open Daheng camera
-        device_manager = gx.DeviceManager()
-        dev_num, dev_info_list = device_manager.update_all_device_list()
-        
-        if dev_num == 0:
+        # Reuse the open camera session; only changed settings are written
+        session_reused = camera_state['daheng_session']['cam'] is not None
+        cam = open_daheng_session()
+        if cam is None:
             return {
                 'success': False,
                 'type': 'recording_error',
@@ -532,65 +3068,40 @@ def start_recording_daheng_imx273(camera_index, data):
                 'timestamp': time.time()
             }
         
-        # For Daheng cameras, use device index 1 (first Daheng camera)
-        # camera_index is virtual (101+), but gxipy uses 1-based indexing
-        daheng_device_index = 1  # First (and likely only) Daheng camera
-        print(f"📹 Opening Daheng camera at gxipy index {daheng_device_index}")
-        cam = device_manager.open_device_by_index(daheng_device_index)
-        
-        # Configure camera
-        print(f"📊 Configuring Daheng camera settings...")
-        if cam.TriggerMode.is_implemented() and cam.TriggerMode.is_writable():
-            cam.TriggerMode.set(gx.GxSwitchEntry.OFF)
-            print(f"✅ Set TriggerMode to OFF")
-        
-        if cam.ExposureTime.is_implemented() and cam.ExposureTime.is_writable():
-            cam.ExposureTime.set(exposure)
-            print(f"📊 Set Exposure to {exposure}μs")
+        try:
+            settings_applied = apply_daheng_settings(cam, settings)
+        except Exception as settings_error:
+            if not session_reused:
+                raise
+            # Stale session (e.g. camera replugged) - reopen once and retry
+            print(f"⚠️ Cached Daheng session failed ({settings_error}), reopening...")
+            release_daheng_session()
+            session_reused = False
+            cam = open_daheng_session()
+            if cam is None:
+                return {
+                    'success': False,
+                    'type': 'recording_error',
+                    'error': 'No Daheng cameras found',
+                    'timestamp': time.time()
+                }
+            settings_applied = apply_daheng_settings(cam, settings)
         
-        if cam.Gain.is_implemented() and cam.Gain.is_writable():
-            cam.Gain.set(gain)
-            print(f"📊 Set Gain to {gain}dB")
+        # Size the ring buffer for the rate this capture mode can actually deliver
+        camera_max_fps = get_daheng_max_fps(cam)
+        if camera_max_fps and camera_max_fps < fps:
+            buffer_frames = int(camera_max_fps * duration)
+            print(f"📐 Capture mode limited to {camera_max_fps} fps, buffer sized to {buffer_frames} frames")
         
-        # Set gamma (check if writable)
-        if hasattr(cam, 'GammaEnable') and cam.GammaEnable.is_implemented() and cam.GammaEnable.is_writable():
-            cam.GammaEnable.set(True)
-        if hasattr(cam, 'Gamma') and cam.Gamma.is_implemented() and cam.Gamma.is_writable():
-            cam.Gamma.set(gamma)
-            print(f"📊 Set Gamma to {gamma}")
-        else:
-            print(f"⚠️ Gamma control not writable, using camera defaults")
-        
-        # Set contrast (check if writable)
-        if hasattr(cam, 'ContrastParam') and cam.ContrastParam.is_implemented() and cam.ContrastParam.is_writable():
-            cam.ContrastParam.set(contrast)
-            print(f"📊 Set Contrast to {contrast}")
-        else:
-            print(f"⚠️ Contrast control not writable, using camera defaults")
-        
-        # Set FPS (exactly like working test_camera_imx273.py)
-        if hasattr(cam, 'AcquisitionFrameRate') and cam.AcquisitionFrameRate.is_implemented():
-            if cam.AcquisitionFrameRate.is_writable():
-                try:
-                    if hasattr(cam, 'AcquisitionFrameRateMode'):
-                        cam.AcquisitionFrameRateMode.set(gx.GxSwitchEntry.ON)
-                except Exception:
-                    pass
-                cam.AcquisitionFrameRate.set(float(fps))
-                print(f"📊 Set FPS to {fps}")
-        
-        print(f"🔧 Camera configuration complete, starting streaming...")
+        print(f"🔧 Camera configuration complete, starting streaming...")
         
         # Start streaming (exactly like working test_camera_imx273.py)
         try:
-            cam.stream_on()
+            start_daheng_stream(cam)
             print(f"✅ Daheng camera streaming started!")
         except Exception as stream_error:
             print(f"❌ Failed to start camera stream: {stream_error}")
-            try:
-                cam.close_device()
-            except:
-                pass
+            release_daheng_session()
             return {
                 'success': False,
                 'type': 'recording_error', 
@@ -605,8 +3116,7 @@ def start_recording_daheng_imx273(camera_index, data):
             raw_image = cam.data_stream[0].get_image()
             if raw_image is None:
                 print(f"❌ Failed to get initial image")
-                cam.stream_off()
-                cam.close_device()
+                release_daheng_session()
                 return {
                     'success': False,
                     'type': 'recording_error',
@@ -617,8 +3127,7 @@ def start_recording_daheng_imx273(camera_index, data):
             first_numpy = raw_image.get_numpy_array()
             if first_numpy is None or first_numpy.ndim != 2:
                 print(f"❌ Invalid initial frame data")
-                cam.stream_off()
-                cam.close_device()
+                release_daheng_session()
                 return {
                     'success': False,
                     'type': 'recording_error',
@@ -626,13 +3135,18 @@ def start_recording_daheng_imx273(camera_index, data):
                     'timestamp': time.time()
                 }
             
+            first_frame_latency = time.time() - request_time
             height, width = first_numpy.shape
             print(f"✅ Image resolution: {width} x {height}")
+            print(f"⏱️ Start-to-first-frame: {first_frame_latency * 1000:.1f} ms "
+                  f"({'warm session' if session_reused else 'cold open'})")
             
             # Allocate ring buffers in RAM (like working test)
             camera_state['daheng_frame_buffer'] = np.empty((buffer_frames, height, width), dtype=np.uint8)
             camera_state['daheng_ts_buffer'] = np.empty(buffer_frames, dtype=np.float64)
             camera_state['daheng_id_buffer'] = np.empty(buffer_frames, dtype=np.int64)
+            camera_state['daheng_dev_ts_buffer'] = np.zeros(buffer_frames, dtype=np.int64)
+            camera_state['daheng_tick_hz'] = get_daheng_tick_frequency(cam)
             camera_state['daheng_head'] = 0
             camera_state['daheng_frame_count'] = 0
             
@@ -640,6 +3154,7 @@ def start_recording_daheng_imx273(camera_index, data):
             camera_state['daheng_frame_buffer'][0, :, :] = first_numpy
             camera_state['daheng_ts_buffer'][0] = time.time()
             camera_state['daheng_id_buffer'][0] = raw_image.get_frame_id()
+            camera_state['daheng_dev_ts_buffer'][0] = get_daheng_device_timestamp(raw_image)
             camera_state['daheng_head'] = 1
             camera_state['daheng_frame_count'] = 1
             
@@ -647,11 +3162,7 @@ def start_recording_daheng_imx273(camera_index, data):
             
         except Exception as init_error:
             print(f"❌ Buffer initialization failed: {init_error}")
-            try:
-                cam.stream_off()
-                cam.close_device()
-            except:
-                pass
+            release_daheng_session()
             return {
                 'success': False,
                 'type': 'recording_error',
@@ -663,6 +3174,7 @@ def start_recording_daheng_imx273(camera_index, data):
         camera_state['daheng_cam'] = cam
         camera_state['daheng_stop_flag'] = False
         camera_state['daheng_capture_thread'] = None  # No thread needed
+        camera_state['daheng_recording_name'] = f"daheng_imx273_capture_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         camera_state['recording'] = True
         
         # Start a simple capture process in main thread (like working test)
@@ -672,55 +3184,48 @@ def start_recording_daheng_imx273(camera_index, data):
         start_time = time.time()
         target_end_time = start_time + duration
         
-        frame_count = camera_state['daheng_frame_count']  # Start from 1 (first frame already captured)
-        
         # Optimize for maximum performance
-        last_report_time = start_time
         report_interval = 500  # Report every 500 frames for high-speed capture
         
-        while time.time() < target_end_time and not camera_state['daheng_stop_flag']:
-            try:
-                # Use same timeout as working test_camera_imx273.py
-                raw_image = cam.data_stream[0].get_image(timeout=1000)
-                if raw_image is None:
-                    continue
-                
-                numpy_image = raw_image.get_numpy_array()
-                if numpy_image is None:
-                    continue
-                
-                # Store in ring buffer (optimized)
-                head = frame_count % buffer_frames
-                camera_state['daheng_frame_buffer'][head, :, :] = numpy_image
-                camera_state['daheng_ts_buffer'][head] = time.time()
-                camera_state['daheng_id_buffer'][head] = raw_image.get_frame_id()
-                
-                frame_count += 1
-                camera_state['daheng_frame_count'] = frame_count  # ✅ UPDATE GLOBAL STATE!
-                
-                # Less frequent progress reports for high-speed capture
-                if frame_count % report_interval == 0:
-                    current_time = time.time()
-                    elapsed_since_report = current_time - last_report_time
-                    if elapsed_since_report > 0:
-                        current_fps = report_interval / elapsed_since_report
-                        total_elapsed = current_time - start_time
-                        avg_fps = frame_count / total_elapsed if total_elapsed > 0 else 0
-                        print(f"📊 {frame_count} frames, current: {current_fps:.1f} fps, avg: {avg_fps:.1f} fps")
-                        last_report_time = current_time
-                
-            except Exception as e:
-                print(f"⚠️ Capture error: {e}")
-                continue  # Remove sleep for maximum speed
+        # Opt-in real-time profile: dedicated core, raised priority, no GC pauses
+        camera_state['realtime_cpu'] = None
+        rt_profile = enter_realtime_profile(data.get('realtime'))
+        if rt_profile:
+            report_interval = 1 << 62  # No progress prints while capturing
+        
+        # Optional encode-while-capturing: ffmpeg trails the capture head
+        live_encoder = None
+        if data.get('live_encode', False):
+            if shutil.which('ffmpeg'):
+                live_encoder = DahengLiveEncoder(
+                    get_daheng_output_path(),
+                    round(min(fps, camera_max_fps or fps)),
+                    encode=data.get('encode')
+                )
+                live_encoder.start()
+            else:
+                print("⚠️ live_encode needs ffmpeg - encoding after stop instead")
+        camera_state['daheng_live_encoder'] = live_encoder
         
-        # Update final frame count and head position
-        camera_state['daheng_frame_count'] = frame_count  # ✅ ENSURE FINAL COUNT IS SAVED!
-        camera_state['daheng_head'] = frame_count % buffer_frames
+        try:
+            frame_count = capture_daheng_frames(cam, buffer_frames, target_end_time, start_time, report_interval)
+        finally:
+            realtime_profile = exit_realtime_profile(rt_profile)
         
         elapsed = time.time() - start_time
         final_fps = frame_count / elapsed if elapsed > 0 else 0
         
-        print(f"✅ Capture completed: {frame_count} frames in {elapsed:.2f}s ({final_fps:.1f} fps)")
+        # Host-side jitter: how evenly the capture loop received frames
+        host_ts = camera_state['daheng_ts_buffer'][get_daheng_ordered_indices()]
+        jitter_ms = round(float(np.std(np.diff(host_ts))) * 1000.0, 4) if len(host_ts) > 2 else None
+        profile_stats = record_capture_profile_stats(rt_profile is not None, final_fps, jitter_ms)
+        
+        print(f"✅ Capture completed: {frame_count} frames in {elapsed:.2f}s ({final_fps:.1f} fps, jitter {jitter_ms} ms)")
+        
+        # Capture mode actually delivered by the camera (ROI/binning/decimation)
+        capture_mode = get_daheng_capture_mode(cam, width, height)
+        capture_mode['mb_per_second'] = round(width * height * final_fps / (1024 * 1024), 1)
+        mode_stats = record_daheng_mode_fps(capture_mode, final_fps)
         
         # ✅ MATCH ELP BEHAVIOR: Just return 'recording_started' and wait for stop_recording
         camera_state['recording'] = True
@@ -749,11 +3254,23 @@ def start_recording_daheng_imx273(camera_index, data):
             'frames_captured': frame_count,
             'exposure': exposure,
             'gain': gain,
+            'session_reused': session_reused,
+            'settings_applied': settings_applied,
+            'capture_mode': capture_mode,
+            'mode_fps': mode_stats,
+            'jitter_ms': jitter_ms,
+            'realtime_profile': realtime_profile,
+            'profile_stats': profile_stats,
+            'first_frame_latency_ms': round(first_frame_latency * 1000, 1),
+            'live_encode': live_encoder is not None,
             'message': 'Recording completed to RAM buffer',
             'timestamp': time.time()
         }
         
     except Exception as e:
+        if camera_state['daheng_live_encoder']:
+            camera_state['daheng_live_encoder'].abort()
+            camera_state['daheng_live_encoder'] = None
         return {
             'success': False,
             'type': 'recording_error',
@@ -770,9 +3287,32 @@ def handle_start_recording(data):
         camera_index: int (optional, defaults to 0)
         camera_model: str (optional, 'elp_imx577' or 'daheng_imx273')
         duration: int (seconds, default 10)
-        width: int (resolution width)
-        height: int (resolution height)
+        width: int (resolution width; Daheng: sensor ROI width, default full)
+        height: int (resolution height; Daheng: sensor ROI height, default full)
         fps: int (frames per second)
+        offset_x, offset_y: int (Daheng ROI offset, default 0)
+        binning: int (Daheng binning factor, default 1)
+        decimation: int (Daheng decimation factor, default 1)
+        realtime: bool or dict (opt-in real-time capture profile, see enter_realtime_profile)
+        background_encode: bool (ELP: re-encode in the encode queue after capture)
+        output_profile: str (ELP re-encode: 'default', 'scrub' or 'intra', see VIDEO_OUTPUT_PROFILES)
+        single_pass: bool (ELP: encode H.264 in the capture process, default False)
+        keep_mjpeg: bool (ELP single_pass: also keep the MJPEG master, default True)
+        segment_seconds: float (ELP: single-pass MP4 segments of this length plus an
+                         ffconcat manifest, returned as encoded_file)
+        upload_segments: bool (ELP segmented: upload each segment as soon as it is finished)
+        server_ip, raspi_id: str (segment / offload upload target)
+        delivery: str (ELP: 'transcode' (default), 'offload' (upload the MJPEG master, no Pi encode)
+                  or 'auto' (estimate_elp_delivery decides))
+        remux: bool (ELP offload: stream-copy the master into MP4 before upload, default False)
+        upload: bool (ELP offload: upload when the recording stops, default True)
+        delivery_estimate: dict (ELP: known values for ELP_DELIVERY_DEFAULTS, e.g. link_mb_per_s)
+        backend: str (ELP: 'ffmpeg' (default) or 'v4l2' for native mmap capture into a ring buffer)
+        armed: bool (ELP v4l2: capture continuously; stop_recording is the trigger)
+        pre_roll, post_roll: float (ELP v4l2 armed: seconds kept before / captured after the trigger,
+                             default 2 / 1)
+        live_encode: bool (Daheng: encode with ffmpeg while capturing, default False)
+        encode: dict (Daheng encoder settings, see DAHENG_ENCODE_DEFAULTS)
     """
     if camera_state['recording']:
         return {
@@ -844,19 +3384,568 @@ def handle_start_recording(data):
     return result
 
 
+# Output profiles: keyframe spacing and MP4 layout for the viewer
+VIDEO_OUTPUT_PROFILES = {
+    'default': {'gop': None, 'all_intra': False, 'faststart': False},  # Encoder defaults (long GOP)
+    'scrub': {'gop': 15, 'all_intra': False, 'faststart': True},       # Keyframe every 15 frames
+    'intra': {'gop': 1, 'all_intra': True, 'faststart': True}          # Every frame a keyframe
+}
+
+
+def get_output_profile(profile=None, overrides=None):
+    """
+    Output profile settings ('gop', 'all_intra', 'faststart')
+    
+    Args:
+        profile: Name from VIDEO_OUTPUT_PROFILES (default 'default')
+        overrides: dict of individual settings that win over the profile
+    """
+    profile = profile or 'default'
+    if profile not in VIDEO_OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile: {profile}")
+    settings = dict(VIDEO_OUTPUT_PROFILES[profile])
+    for key, value in (overrides or {}).items():
+        if key in settings and value is not None:
+            settings[key] = value
+    return settings
+
+
+def get_output_profile_args(settings):
+    """ffmpeg output options for an output profile"""
+    args = []
+    if settings.get('all_intra'):
+        args += ['-g', '1', '-bf', '0']
+    elif settings.get('gop'):
+        gop = str(int(settings['gop']))
+        args += ['-g', gop, '-keyint_min', gop]
+    if settings.get('faststart'):
+        args += ['-movflags', '+faststart']  # moov before mdat: playable before fully downloaded
+    return args
+
+
+ELP_ENCODE_DEFAULTS = {
+    'preset': 'fast',                   # Re-encode after capture
+    'crf': 23,
+    'single_pass_preset': 'ultrafast'   # Encode during capture: must keep up with the camera
+}
+
+
+def get_elp_encode_args(profile=None, preset=None, segmented=False):
+    """
+    ffmpeg H.264 output options for ELP recordings
+    
+    Args:
+        segmented: Output goes through the segment muxer, which takes the
+                   MP4 options via -segment_format_options
+    """
+    settings = get_output_profile(profile)
+    faststart = settings['faststart']
+    args = [
+        '-c:v', 'libx264',
+        '-preset', preset or ELP_ENCODE_DEFAULTS['preset'],
+        '-crf', str(ELP_ENCODE_DEFAULTS['crf']),
+        *get_output_profile_args(dict(settings, faststart=faststart and not segmented)),
+        '-pix_fmt', 'yuv420p'
+    ]
+    if segmented and faststart:
+        args += ['-segment_format_options', 'movflags=+faststart']
+    return args
+
+
+def get_elp_segment_args(segment_seconds, manifest_file, segment_pattern):
+    """
+    ffmpeg segment muxer options: fixed-duration MP4 segments plus an
+    ffconcat manifest that ffmpeg appends to as each segment is closed
+    """
+    return [
+        # A keyframe at every boundary so segments split exactly on time
+        '-force_key_frames', f'expr:gte(t,n_forced*{segment_seconds})',
+        '-f', 'segment',
+        '-segment_time', str(segment_seconds),
+        '-segment_format', 'mp4',
+        '-reset_timestamps', '1',
+        '-segment_list', manifest_file,
+        '-segment_list_type', 'ffconcat',
+        segment_pattern
+    ]
+
+
+def read_segment_manifest(manifest_file):
+    """Finished segment paths listed in an ffconcat manifest, in order"""
+    try:
+        with open(manifest_file) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return []
+    manifest_dir = os.path.dirname(manifest_file)
+    return [os.path.join(manifest_dir, line[5:].strip().strip("'"))
+            for line in lines if line.startswith('file ')]
+
+
+class ElpSegmentUploader:
+    """
+    Hand each finished segment of a segmented ELP recording to the uploader
+    
+    A background thread watches the ffconcat manifest, which ffmpeg only
+    appends to once a segment file is closed, and uploads new segments
+    straight away while the capture continues.
+    """
+    
+    def __init__(self, manifest_file, process, upload=None, poll_interval=0.2):
+        """
+        Args:
+            manifest_file: ffconcat manifest written by the segment muxer
+            process: Capture ffmpeg process (the watcher stops after it exits)
+            upload: None (only track segments) or dict with server_ip, raspi_id
+        """
+        self.manifest_file = manifest_file
+        self.process = process
+        self.upload = upload
+        self.poll_interval = poll_interval
+        self.segments = []
+        self.started_at = time.time()
+        self.thread = None
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='elp-segment-uploader', daemon=True)
+        self.thread.start()
+    
+    def _run(self):
+        while True:
+            capture_done = self.process.poll() is not None  # Read before the manifest so no segment is missed
+            for segment_file in read_segment_manifest(self.manifest_file)[len(self.segments):]:
+                self._handle_segment(segment_file)
+            if capture_done:
+                break
+            time.sleep(self.poll_interval)
+    
+    def _handle_segment(self, segment_file):
+        index = len(self.segments)
+        segment = {
+            'index': index,
+            'file': segment_file,
+            'size': os.path.getsize(segment_file) if os.path.exists(segment_file) else 0,
+            'ready_s': round(time.time() - self.started_at, 3),
+            'upload': None,
+            'uploaded_s': None
+        }
+        self.segments.append(segment)
+        print(f"🧩 Segment {index} ready: {segment_file}")
+        
+        if self.upload:
+            segment['upload'] = upload_video_to_server(
+                segment_file, self.upload.get('server_ip', '192.168.1.2'), self.upload.get('raspi_id'),
+                'elp_imx577', variant='segment',
+                segment={'recording': os.path.splitext(os.path.basename(self.manifest_file))[0], 'index': index}
+            )
+            segment['uploaded_s'] = round(time.time() - self.started_at, 3)
+    
+    def finish(self):
+        """Wait for the last segments after the capture process has exited"""
+        if self.thread:
+            self.thread.join()
+        return self.segments
+
+
+def transcode_elp_raw(raw_file, encoded_file, control=None, profile=None):
+    """
+    Re-encode an ELP MJPEG capture to H.264 MP4
+    
+    Args:
+        control: Optional EncodeControl; cancel() kills ffmpeg
+        profile: Output profile name from VIDEO_OUTPUT_PROFILES (default 'default')
+    
+    Returns:
+        (ffmpeg return code, stderr bytes (last PROCESS_STDERR_LINES lines))
+    """
+    # Re-encode to H.264 MP4 (fast preset for testing)
+    encode_cmd = [
+        'ffmpeg', '-y',
+        '-i', raw_file,
+        *get_elp_encode_args(profile),
+        encoded_file
+    ]
+    
+    encode_process = process_supervisor.start(encode_cmd, 'elp_transcode', idle_timeout=FFMPEG_IDLE_TIMEOUT)
+    pin_to_worker_cpus(encode_process.pid)  # Keep encoding off the capture core
+    if control:
+        control.attach(encode_process)
+    # No total timeout (long clips take long), but a hung ffmpeg is killed
+    encode_process.wait()
+    if encode_process.returncode == 0 and encode_process.progress.get('frames'):
+        seconds = encode_process.ended_at - encode_process.started_at
+        record_delivery_stat('encode_fps', encode_process.progress['frames'] / seconds)
+        record_delivery_stat('compression_ratio', os.path.getsize(encoded_file) / os.path.getsize(raw_file))
+    if encode_process.returncode == 0:
+        write_checksum_manifest(encoded_file)
+    return encode_process.returncode, encode_process.stderr_text().encode()
+
+
+# How a finished ELP recording reaches the server (start_recording 'delivery' param):
+#   transcode - re-encode to H.264 on the Pi, then upload (original behaviour)
+#   offload   - upload the MJPEG master as-is; the server transcodes it
+#   auto      - whichever estimate_elp_delivery() expects to deliver first
+ELP_DELIVERY_MODES = ('transcode', 'offload', 'auto')
+
+# Used by estimate_elp_delivery() until this Pi has measured its own values
+ELP_DELIVERY_DEFAULTS = {
+    'encode_fps': 25.0,          # libx264 1080p on the Pi
+    'compression_ratio': 0.15,   # H.264 size / MJPEG size
+    'link_mb_per_s': 11.0,       # 100 Mbit Ethernet
+    'remux_mb_per_s': 150.0,     # Stream copy is bound by the SD card
+    'server_encode_fps': 240.0   # Server-side libx264 (not measured from the Pi)
+}
+DELIVERY_STAT_SMOOTHING = 0.5  # Weight of the newest measurement
+DELIVERY_MIN_UPLOAD_BYTES = 1024 * 1024  # Smaller uploads are latency-bound, not a throughput sample
+
+
+def record_delivery_stat(name, value):
+    """Blend a new measurement into camera_state['delivery_stats']"""
+    stats = camera_state['delivery_stats']
+    previous = stats.get(name)
+    if previous is not None:
+        value = DELIVERY_STAT_SMOOTHING * value + (1 - DELIVERY_STAT_SMOOTHING) * previous
+    stats[name] = round(value, 4)
+
+
+def estimate_elp_delivery(raw_size, frames, overrides=None, remux=False):
+    """
+    Estimate when each delivery mode would have a playable H.264 MP4 on the server
+    
+    Args:
+        raw_size: MJPEG master size in bytes
+        frames: Frame count of the master
+        overrides: Optional values for ELP_DELIVERY_DEFAULTS keys (e.g. a known link speed)
+        remux: Offload remuxes the master to MP4 first
+    
+    Returns:
+        Dict with per-mode timings, the inputs used (and whether they were
+        measured) and 'recommended'
+    """
+    inputs = {}
+    for key, default in ELP_DELIVERY_DEFAULTS.items():
+        value = (overrides or {}).get(key)
+        source = 'override'
+        if value is None:
+            value = camera_state['delivery_stats'].get(key)
+            source = 'measured'
+        if value is None:
+            value, source = default, 'default'
+        inputs[key] = {'value': value, 'source': source}
+    
+    value = {key: entry['value'] for key, entry in inputs.items()}
+    raw_mb = raw_size / (1024 * 1024)
+    encode_s = frames / value['encode_fps']
+    transcode_upload_s = raw_mb * value['compression_ratio'] / value['link_mb_per_s']
+    offload_upload_s = raw_mb / value['link_mb_per_s']
+    server_encode_s = frames / value['server_encode_fps']
+    remux_s = raw_mb / value['remux_mb_per_s'] if remux else 0.0
+    
+    estimate = {
+        'transcode': {
+            'pi_encode_s': round(encode_s, 2),
+            'upload_s': round(transcode_upload_s, 2),
+            'total_s': round(encode_s + transcode_upload_s, 2)
+        },
+        'offload': {
+            'remux_s': round(remux_s, 2),
+            'upload_s': round(offload_upload_s, 2),
+            'server_encode_s': round(server_encode_s, 2),
+            'total_s': round(remux_s + offload_upload_s + server_encode_s, 2)
+        },
+        'raw_mb': round(raw_mb, 2),
+        'frames': frames,
+        'inputs': inputs
+    }
+    estimate['recommended'] = min(('transcode', 'offload'), key=lambda mode: estimate[mode]['total_s'])
+    return estimate
+
+
+def get_elp_delivery_options(data):
+    """Delivery options from start_recording params (see ELP_DELIVERY_MODES)"""
+    mode = data.get('delivery', 'transcode')
+    if mode not in ELP_DELIVERY_MODES:
+        raise ValueError(f"Unknown delivery '{mode}' (expected one of {', '.join(ELP_DELIVERY_MODES)})")
+    return {
+        'mode': mode,
+        'remux': data.get('remux', False),
+        'upload': data.get('upload', True),
+        'server_ip': data.get('server_ip', '192.168.1.2'),
+        'raspi_id': data.get('raspi_id'),
+        'overrides': data.get('delivery_estimate')
+    }
+
+
+def remux_mjpeg_to_mp4(mjpeg_file):
+    """
+    Stream-copy an MJPEG master into MP4 (no transcoding)
+    
+    Returns:
+        Path to <capture>_mjpeg.mp4
+    """
+    mp4_file = os.path.splitext(mjpeg_file)[0] + '_mjpeg.mp4'
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', mjpeg_file, '-c:v', 'copy', '-movflags', '+faststart',
+           mp4_file]
+    remux_start = time.time()
+    process = process_supervisor.start(cmd, 'elp_remux', idle_timeout=FFMPEG_IDLE_TIMEOUT)
+    process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f'MJPEG remux failed: {process.stderr_text()}')
+    seconds = time.time() - remux_start
+    if seconds > 0:
+        record_delivery_stat('remux_mb_per_s', os.path.getsize(mjpeg_file) / (1024 * 1024) / seconds)
+    write_checksum_manifest(mp4_file)
+    return mp4_file
+
+
+def offload_elp_master(raw_file, delivery, frames):
+    """
+    Ship an ELP MJPEG master to the server instead of re-encoding it on the Pi
+    
+    Args:
+        delivery: camera_state['elp_delivery'] options (remux, upload, server_ip, raspi_id)
+        frames: Frame count of the master (for the estimate)
+    
+    Returns:
+        Dict with 'master_file' and the 'upload' result (None when upload is off)
+    """
+    master_file = remux_mjpeg_to_mp4(raw_file) if delivery['remux'] else raw_file
+    upload = None
+    if delivery['upload']:
+        upload = upload_video_to_server(master_file, delivery['server_ip'], delivery['raspi_id'], 'elp_imx577',
+                                        variant='master')
+        print(f"📤 MJPEG master {'uploaded' if upload.get('success') else 'upload failed'}: {master_file}")
+    return {
+        'mode': 'offload',
+        'master_file': master_file,
+        'remuxed': delivery['remux'],
+        'upload': upload
+    }
+
+
+# Matroska (EBML) element IDs needed to locate MJPEG frames in a raw capture
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_NUMBER = 0xD7
+MKV_CODEC_ID = 0x86
+MKV_CLUSTER = 0x1F43B675
+MKV_CLUSTER_TIMECODE = 0xE7
+MKV_BLOCK_GROUP = 0xA0
+MKV_BLOCK = 0xA1
+MKV_SIMPLE_BLOCK = 0xA3
+MKV_MASTER_ELEMENTS = (MKV_SEGMENT, MKV_INFO, MKV_TRACKS, MKV_TRACK_ENTRY, MKV_CLUSTER, MKV_BLOCK_GROUP)
+
+MJPEG_INDEX_VERSION = 1
+MJPEG_MAX_RANGE_FRAMES = 3600  # read_frame_range limit (1 minute at 60 fps)
+
+
+def read_ebml_vint(f, keep_marker=False):
+    """
+    Read an EBML variable-length integer
+    
+    Returns:
+        (value, length) or (None, 0) at end of file; value is None for the
+        reserved "unknown size" (all data bits set)
+    """
+    first = f.read(1)
+    if not first:
+        return None, 0
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first[0] & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError(f'Invalid EBML vint at offset {f.tell() - 1}')
+    rest = f.read(length - 1)
+    if len(rest) < length - 1:
+        return None, 0
+    value = first[0] if keep_marker else first[0] & (mask - 1)
+    for byte in rest:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def get_mjpeg_index_path(mjpeg_file):
+    """Frame index stored next to the capture (<capture>.index.json)"""
+    return os.path.splitext(mjpeg_file)[0] + '.index.json'
+
+
+def scan_mkv_mjpeg_frames(mkv_path):
+    """
+    Locate every JPEG frame of an MJPEG Matroska file without reading frame data
+    
+    Walks the EBML element tree, descending into Segment/Cluster/BlockGroup and
+    seeking past everything else, so only block headers are read. A capture
+    cut short (unfinished cluster, unknown sizes) indexes up to the last
+    complete frame.
+    
+    Returns:
+        (offsets, sizes, pts) lists: byte offset and size of each JPEG, and its
+        presentation time in seconds from the container
+    """
+    file_size = os.path.getsize(mkv_path)
+    offsets, sizes, pts = [], [], []
+    timecode_scale = 1000000  # ns per tick (Matroska default)
+    cluster_timecode = 0
+    video_track = None
+    track_number = None
+    
+    with open(mkv_path, 'rb') as f:
+        header_id, _ = read_ebml_vint(f, keep_marker=True)
+        if header_id != 0x1A45DFA3:
+            raise ValueError(f'Not a Matroska file: {mkv_path}')
+        size, _ = read_ebml_vint(f)
+        pos = f.tell() + size
+        
+        while pos < file_size:
+            f.seek(pos)
+            element_id, id_length = read_ebml_vint(f, keep_marker=True)
+            size, size_length = read_ebml_vint(f)
+            if not id_length or not size_length:
+                break
+            data_start = pos + id_length + size_length
+            
+            if element_id in MKV_MASTER_ELEMENTS:
+                # Unknown-size masters (live capture) simply continue into their children
+                pos = data_start
+                continue
+            if size is None or data_start + size > file_size:
+                break  # Truncated capture: stop at the last complete element
+            
+            if element_id == MKV_TIMECODE_SCALE:
+                timecode_scale = int.from_bytes(f.read(size), 'big')
+            elif element_id == MKV_TRACK_NUMBER:
+                track_number = int.from_bytes(f.read(size), 'big')
+            elif element_id == MKV_CODEC_ID:
+                if f.read(size).rstrip(b'\0') == b'V_MJPEG' and video_track is None:
+                    video_track = track_number
+            elif element_id == MKV_CLUSTER_TIMECODE:
+                cluster_timecode = int.from_bytes(f.read(size), 'big')
+            elif element_id in (MKV_SIMPLE_BLOCK, MKV_BLOCK):
+                block_track, track_length = read_ebml_vint(f)
+                relative, flags = struct.unpack('>hB', f.read(3))
+                if video_track is None or block_track == video_track:
+                    if flags & 0x06:
+                        raise ValueError('Laced MJPEG blocks are not supported')
+                    header_length = track_length + 3
+                    offsets.append(data_start + header_length)
+                    sizes.append(size - header_length)
+                    pts.append((cluster_timecode + relative) * timecode_scale / 1e9)
+            pos = data_start + size
+    
+    return offsets, sizes, pts
+
+
+def build_mjpeg_index(mjpeg_file):
+    """
+    Build and store the frame index of an MJPEG capture
+    
+    Presentation times come from the container; when a capture report with
+    kernel frame times sits next to the file (native V4L2 captures) and covers
+    the same frames, those are used instead.
+    
+    Returns:
+        Index dict (also written to <capture>.index.json)
+    """
+    start = time.time()
+    offsets, sizes, pts = scan_mkv_mjpeg_frames(mjpeg_file)
+    if not offsets:
+        raise ValueError(f'No MJPEG frames found in {mjpeg_file}')
+    
+    timestamp_source = 'container'
+    report_file = os.path.splitext(mjpeg_file)[0] + '.json'
+    if os.path.exists(report_file):
+        with open(report_file) as f:
+            frame_times = json.load(f).get('frame_times')
+        if frame_times and len(frame_times) == len(offsets):
+            pts = frame_times
+            timestamp_source = 'capture_report'
+    
+    # Cheap sanity check: every frame must start with a JPEG SOI marker
+    with open(mjpeg_file, 'rb') as f:
+        for i in (0, len(offsets) // 2, len(offsets) - 1):
+            f.seek(offsets[i])
+            if f.read(2) != b'\xff\xd8':
+                raise ValueError(f'Frame {i} of {mjpeg_file} is not a JPEG')
+    
+    index = {
+        'version': MJPEG_INDEX_VERSION,
+        'file': os.path.basename(mjpeg_file),
+        'file_size': os.path.getsize(mjpeg_file),
+        'frames': len(offsets),
+        'duration': round(pts[-1] - pts[0], 6),
+        'timestamp_source': timestamp_source,
+        'offsets': offsets,
+        'sizes': sizes,
+        'pts': [round(float(t), 6) for t in pts]
+    }
+    with open(get_mjpeg_index_path(mjpeg_file), 'w') as f:
+        json.dump(index, f)
+    print(f"🗂️ MJPEG index: {len(offsets)} frames in {(time.time() - start) * 1000:.0f} ms "
+          f"({get_mjpeg_index_path(mjpeg_file)})")
+    return index
+
+
+def load_mjpeg_index(mjpeg_file):
+    """Load the frame index of a capture, (re)building it if missing or stale"""
+    index_path = get_mjpeg_index_path(mjpeg_file)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            if index.get('version') == MJPEG_INDEX_VERSION and index.get('file_size') == os.path.getsize(mjpeg_file):
+                return index
+        except (ValueError, OSError) as e:
+            print(f"⚠️ Rebuilding unreadable MJPEG index: {e}")
+    return build_mjpeg_index(mjpeg_file)
+
+
+def find_mjpeg_frame(index, frame=None, time_s=None):
+    """Frame number for an explicit frame or the frame shown at time_s (seconds from the first frame)"""
+    if frame is None:
+        if time_s is None:
+            raise ValueError('frame or time is required')
+        pts = np.asarray(index['pts']) - index['pts'][0]
+        frame = int(np.searchsorted(pts, float(time_s), side='right')) - 1
+    frame = int(frame)
+    if frame < 0:
+        frame += index['frames']
+    if not 0 <= frame < index['frames']:
+        raise ValueError(f"Frame {frame} out of range (0-{index['frames'] - 1})")
+    return frame
+
+
+def read_mjpeg_frames(mjpeg_file, index, frames):
+    """Read JPEG frames straight from the capture file (no decoding)"""
+    with open(mjpeg_file, 'rb') as f:
+        for frame in frames:
+            f.seek(index['offsets'][frame])
+            yield f.read(index['sizes'][frame])
+
+
 def stop_recording_elp_imx577():
     """
     Stop ELP IMX577 recording and re-encode to H.264
     
     Process:
-    1. Wait for ffmpeg capture to finish
-    2. Re-encode MJPEG to H.264 MP4
+    1. Wait for ffmpeg capture to finish (native V4L2 captures: trigger or
+       wait, then mux the ring buffer into the MJPEG master)
+    2. Re-encode MJPEG to H.264 MP4 (skipped in single-pass mode: the
+       capture process already wrote it)
     """
     process = camera_state['elp_ffmpeg_process']
+    v4l2_capture = camera_state['elp_v4l2_capture']
     raw_file = camera_state['elp_raw_file']
     encoded_file = camera_state['elp_encoded_file']
+    output_profile = camera_state['elp_output_profile']
     
-    if not process:
+    if not process and not v4l2_capture:
         return {
             'success': False,
             'type': 'recording_error',
@@ -865,27 +3954,98 @@ def stop_recording_elp_imx577():
         }
     
     try:
-        # Wait for ffmpeg to finish (no timeout - wait indefinitely)
-        process.wait()
-        
-        # Re-encode to H.264 MP4 (fast preset for testing)
-        encode_cmd = [
-            'ffmpeg', '-y',
-            '-i', raw_file,
-            '-c:v', 'libx264',
-            '-preset', 'fast',  # Much faster encoding
-            '-crf', '23',       # Slightly lower quality but much faster
-            '-pix_fmt', 'yuv420p',
-            encoded_file
-        ]
+        capture_report = None
+        if v4l2_capture:
+            capture_report = finish_elp_v4l2_capture(v4l2_capture, raw_file)
+        else:
+            # Wait for ffmpeg to finish (the supervisor enforces the timeouts)
+            process.wait()
         
-        encode_process = subprocess.run(
-            encode_cmd,
-            capture_output=True
-            # No timeout - wait indefinitely for encoding
-        )
+        # Index the MJPEG master straight away so stills and windows can be read before any encode
+        frame_index = None
+        if raw_file and os.path.exists(raw_file):
+            try:
+                build_mjpeg_index(raw_file)
+                frame_index = get_mjpeg_index_path(raw_file)
+                camera_state['last_mjpeg_file'] = raw_file
+            except Exception as e:
+                print(f"⚠️ MJPEG index failed: {e}")
+        
+        # Offload: the master goes to the server as it is, the Pi never re-encodes
+        delivery = camera_state['elp_delivery']
+        if delivery and delivery['mode'] != 'transcode' and not camera_state['elp_single_pass']:
+            frames = load_mjpeg_index(raw_file)['frames']
+            estimate = estimate_elp_delivery(os.path.getsize(raw_file), frames, delivery['overrides'],
+                                             delivery['remux'])
+            mode = estimate['recommended'] if delivery['mode'] == 'auto' else delivery['mode']
+            print(f"🚚 ELP delivery: {mode} (transcode ~{estimate['transcode']['total_s']}s, "
+                  f"offload ~{estimate['offload']['total_s']}s)")
+            if mode == 'offload':
+                result = offload_elp_master(raw_file, delivery, frames)
+                result['estimate'] = estimate
+                camera_state['last_recording'] = result['master_file']
+                return {
+                    'success': result['upload'] is None or result['upload'].get('success', False),
+                    'type': 'recording_stopped',
+                    'camera_model': 'elp_imx577',
+                    'raw_file': raw_file,
+                    'encoded_file': None,
+                    'delivery': result,
+                    'capture_report': capture_report,
+                    'frame_index': frame_index,
+                    'message': 'Recording stopped, MJPEG master offloaded',
+                    'timestamp': time.time()
+                }
+        
+        if camera_state['elp_single_pass']:
+            if process.returncode != 0 or not os.path.exists(encoded_file):
+                return {
+                    'success': False,
+                    'type': 'recording_error',
+                    'error': f'Single-pass capture failed (ffmpeg code {process.returncode})',
+                    'raw_file': raw_file,
+                    'timestamp': time.time()
+                }
+            segments = None
+            if camera_state['elp_segment_uploader']:
+                segments = camera_state['elp_segment_uploader'].finish()
+            camera_state['last_recording'] = encoded_file
+            write_checksum_manifest(encoded_file)
+            upload = None if segments else auto_enqueue_upload(encoded_file, 'elp_imx577')
+            return {
+                'success': True,
+                'type': 'recording_stopped',
+                'camera_model': 'elp_imx577',
+                'raw_file': raw_file,
+                'encoded_file': encoded_file,
+                'single_pass': True,
+                'segments': segments,
+                'upload': upload,
+                'frame_index': frame_index,
+                'message': 'Recording stopped, encoded during capture',
+                'timestamp': time.time()
+            }
+        
+        # Re-encode later in the background encode queue
+        if camera_state['elp_background_encode']:
+            job = get_encode_queue().enqueue('elp_reencode', raw_file, output_file=encoded_file,
+                                             params={'output_profile': output_profile})
+            return {
+                'success': True,
+                'type': 'recording_stopped',
+                'camera_model': 'elp_imx577',
+                'raw_file': raw_file,
+                'encoded_file': None,
+                'encode_job': job,
+                'capture_report': capture_report,
+                'frame_index': frame_index,
+                'message': 'Recording stopped, encode queued',
+                'timestamp': time.time()
+            }
         
-        if encode_process.returncode == 0:
+        returncode, encode_stderr = transcode_elp_raw(raw_file, encoded_file, profile=output_profile)
+        
+        if returncode == 0:
             # Optionally delete raw file
             # os.remove(raw_file)
             
@@ -898,14 +4058,17 @@ def stop_recording_elp_imx577():
                 'camera_model': 'elp_imx577',
                 'raw_file': raw_file,
                 'encoded_file': encoded_file,
+                'upload': auto_enqueue_upload(encoded_file, 'elp_imx577'),
+                'capture_report': capture_report,
                 'message': 'Recording stopped and encoded',
+                'frame_index': frame_index,
                 'timestamp': time.time()
             }
         else:
             return {
                 'success': False,
                 'type': 'recording_error',
-                'error': f'Encoding failed: {encode_process.stderr.decode()}',
+                'error': f'Encoding failed: {encode_stderr.decode()}',
                 'raw_file': raw_file,
                 'timestamp': time.time()
             }
@@ -924,139 +4087,1011 @@ def stop_recording_elp_imx577():
         camera_state['elp_ffmpeg_process'] = None
         camera_state['elp_raw_file'] = None
         camera_state['elp_encoded_file'] = None
+        camera_state['elp_background_encode'] = False
+        camera_state['elp_output_profile'] = 'default'
+        camera_state['elp_single_pass'] = False
+        camera_state['elp_segment_uploader'] = None
+        camera_state['elp_v4l2_capture'] = None
+        camera_state['elp_v4l2_options'] = None
+        camera_state['elp_delivery'] = None
         # Update last recording path
         if 'encoded_file' in locals() and encoded_file and os.path.exists(encoded_file):
             camera_state['last_recording'] = encoded_file
 
 
-def save_daheng_buffer_to_mp4(target_fps=220):
+def demosaic_frames(frame_buffer, ordered_indices, workers=1, chunk_frames=8):
     """
-    Demosaic Bayer frames from RAM buffer and encode to MP4
+    Demosaic Bayer frames from the ring buffer, yielding BGR frames in order
     
-    Returns path to saved MP4 file
-    """
-    frame_buffer = camera_state['daheng_frame_buffer']
-    ts_buffer = camera_state['daheng_ts_buffer']
-    id_buffer = camera_state['daheng_id_buffer']
-    head = camera_state['daheng_head']
-    frame_count = camera_state['daheng_frame_count']
+    With workers > 1, chunks of frames are demosaiced in a thread pool
+    (cv2.cvtColor releases the GIL) while the caller writes earlier frames.
+    Frames are read straight from the ring buffer (views, no copies) and at
+    most 2 chunks per worker are in flight, which bounds memory use.
     
-    if frame_buffer is None or frame_count == 0:
-        return None
+    Args:
+        frame_buffer: Ring buffer of (H, W) Bayer frames
+        ordered_indices: Buffer indices in output order
+        workers: Demosaic threads (1 = single loop in the calling thread)
+        chunk_frames: Frames per work item
+    """
+    bayer_code = cv2.COLOR_BAYER_BG2BGR  # Same as working test
     
-    os.makedirs(camera_state['recording_path'], exist_ok=True)
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_path = os.path.join(camera_state['recording_path'], f'capture_{ts}_color.mp4')
+    if workers <= 1:
+        for idx in ordered_indices:
+            yield cv2.cvtColor(frame_buffer[idx], bayer_code)
+        return
     
-    buffer_size = frame_buffer.shape[0]
-    total_frames = min(frame_count, buffer_size)
+    def demosaic_chunk(chunk):
+        return [cv2.cvtColor(frame_buffer[idx], bayer_code) for idx in chunk]
     
-    if total_frames < 2:
-        return None
+    chunks = [ordered_indices[i:i + chunk_frames] for i in range(0, len(ordered_indices), chunk_frames)]
     
-    # Determine chronological order
-    if frame_count <= buffer_size:
-        start = 0
-    else:
-        start = head
+    # Workers stay off the real-time capture core
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='demosaic',
+                            initializer=pin_to_worker_cpus) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(demosaic_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def get_default_encode_workers():
+    """Demosaic threads: one per worker CPU, leaving one for the writer"""
+    return max(len(get_worker_cpus()) - 1, 1)
+
+
+DAHENG_ENCODE_DEFAULTS = {
+    'encoder': 'auto',      # Backend from ENCODER_BACKENDS, or 'auto' (benchmark choice / ffmpeg / opencv)
+    'writer': 'ffmpeg',     # Set by the backend: 'ffmpeg' pipe or 'opencv' VideoWriter
+    'codec': 'libx264',
+    'bitrate': None,        # e.g. '12M'; needed by encoders without CRF (hardware)
+    'profile': 'default',   # Output profile from VIDEO_OUTPUT_PROFILES
+    'gop': None,            # Keyframe interval in frames (None: profile/encoder default)
+    'all_intra': False,
+    'faststart': False,
+    'preset': 'ultrafast',
+    'crf': 23,
+    'threads': 0,           # 0 = let ffmpeg decide
+    'scale_width': None,    # Downscale to this width (aspect kept), None = full size
+    'frame_timing': 'cfr'   # 'vfr' = per-frame timestamps from the capture (see write_mp4_frame_times)
+}
+
+# Media timescale for VFR output (ticks per second, MPEG standard clock)
+VFR_TIMESCALE = 90000
+
+# Quick preview clip, encoded (and optionally uploaded) before the full-quality file
+DAHENG_PREVIEW_DEFAULTS = {
+    'width': 480,
+    'decimate': 4,          # Keep every 4th frame (output fps is divided too)
+    'preset': 'ultrafast',
+    'crf': 30,
+    'frame_timing': 'cfr'
+}
+
+# OpenCV's BAYER_BG (used by the working test) is ffmpeg's bayer_rggb8
+DAHENG_FFMPEG_BAYER_FORMAT = 'bayer_rggb8'
+
+
+# Encoder backends: each entry overrides DAHENG_ENCODE_DEFAULTS
+ENCODER_BACKENDS = {
+    'opencv': {
+        'writer': 'opencv',
+        'codec': None,
+        'description': 'cv2.VideoWriter (avc1, falls back to mp4v), demosaic in Python threads'
+    },
+    'ffmpeg': {
+        'writer': 'ffmpeg',
+        'codec': 'libx264',
+        'description': 'Bayer frames piped to ffmpeg, libx264 software encoder'
+    },
+    'ffmpeg_hw': {
+        'writer': 'ffmpeg',
+        'codec': 'h264_v4l2m2m',
+        'bitrate': '12M',
+        'description': 'Bayer frames piped to ffmpeg, V4L2 mem2mem hardware H.264 (Raspberry Pi)'
+    }
+}
+
+
+def get_daheng_encode_settings(encode=None):
+    """
+    Merge encoder settings: DAHENG_ENCODE_DEFAULTS, then the backend's
+    overrides (ENCODER_BACKENDS), then the output profile
+    (VIDEO_OUTPUT_PROFILES), then the command's own settings
+    """
+    encode = encode or {}
+    backend_name = encode.get('encoder') or DAHENG_ENCODE_DEFAULTS['encoder']
+    if backend_name == 'auto':
+        backend_name = get_auto_encoder_backend()
+    if backend_name not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend: {backend_name}")
     
-    ordered_indices = [(start + i) % buffer_size for i in range(total_frames)]
+    settings = dict(DAHENG_ENCODE_DEFAULTS)
+    settings.update({key: value for key, value in ENCODER_BACKENDS[backend_name].items() if key in settings})
+    settings['profile'] = encode.get('profile') or settings['profile']
+    settings.update(get_output_profile(settings['profile']))
+    for key, value in encode.items():
+        if key in settings and value is not None and key != 'encoder':
+            settings[key] = value
+    settings['encoder'] = backend_name
+    return settings
+
+
+def get_encoder_choice_file():
+    return os.path.join(camera_state['recording_path'], 'encoder_benchmark.json')
+
+
+def load_encoder_choice():
+    """Backend chosen by the last encoder_benchmark on this device (or None)"""
+    if camera_state['encoder_choice'] is None:
+        camera_state['encoder_choice'] = {}
+        try:
+            with open(get_encoder_choice_file()) as f:
+                camera_state['encoder_choice'] = json.load(f).get(socket.gethostname(), {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Failed to read encoder benchmark cache: {e}")
+    return camera_state['encoder_choice'].get('backend')
+
+
+def get_auto_encoder_backend():
+    """'auto' = benchmark choice for this device, else ffmpeg when installed, else OpenCV"""
+    choice = load_encoder_choice()
+    if choice in ENCODER_BACKENDS:
+        return choice
+    return 'ffmpeg' if shutil.which('ffmpeg') else 'opencv'
+
+
+def probe_encoder_backends(force=False):
+    """
+    Check which encoder backends work on this device
     
-    # Compute FPS from timestamps
-    first_ts = ts_buffer[ordered_indices[0]]
-    last_ts = ts_buffer[ordered_indices[-1]]
-    duration = last_ts - first_ts
+    ffmpeg backends must be listed by `ffmpeg -encoders` and pass a short
+    test encode (hardware encoders are often listed but unusable, e.g.
+    h264_v4l2m2m off the Pi). Results are cached in camera_state.
     
-    if duration > 0:
-        fps = (total_frames - 1) / duration
-    else:
-        fps = float(target_fps)
+    Returns:
+        dict backend -> {'available': bool, 'reason': str or None}
+    """
+    if camera_state['encoder_probe'] and not force:
+        return camera_state['encoder_probe']
     
-    if fps <= 0 or fps > 1000:
-        fps = float(target_fps)
+    probe = {}
+    ffmpeg_encoders = ''
+    if shutil.which('ffmpeg'):
+        try:
+            ffmpeg_encoders = process_supervisor.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                                     capture_output=True, text=True, timeout=10).stdout
+        except Exception as e:
+            print(f"⚠️ ffmpeg -encoders failed: {e}")
     
-    fps = round(fps)
+    for name, backend in ENCODER_BACKENDS.items():
+        if backend['writer'] == 'opencv':
+            probe[name] = {'available': CV2_AVAILABLE, 'reason': None if CV2_AVAILABLE else 'cv2 not installed'}
+            continue
+        if not ffmpeg_encoders:
+            probe[name] = {'available': False, 'reason': 'ffmpeg not installed'}
+            continue
+        if not re.search(rf'\s{re.escape(backend["codec"])}\s', ffmpeg_encoders):
+            probe[name] = {'available': False, 'reason': f'{backend["codec"]} not in ffmpeg -encoders'}
+            continue
+        
+        test_cmd = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'testsrc=size=320x240:rate=30',
+            '-frames:v', '10', '-c:v', backend['codec'],
+            '-b:v', '1M', '-pix_fmt', 'yuv420p', '-f', 'null', '-'
+        ]
+        try:
+            result = process_supervisor.run(test_cmd, kind='encoder_probe', capture_output=True, text=True,
+                                            timeout=20)
+            ok = result.returncode == 0
+            reason = None if ok else result.stderr.strip()[-300:]
+        except subprocess.TimeoutExpired:
+            ok, reason = False, 'test encode timed out'
+        probe[name] = {'available': ok, 'reason': reason}
     
-    # Get frame dimensions
-    sample_frame = frame_buffer[ordered_indices[0]]
-    if sample_frame.ndim != 2:
-        return None
+    camera_state['encoder_probe'] = probe
+    return probe
+
+
+def measure_psnr(video_path, frame_buffer, indices, every=5):
+    """Mean PSNR (dB) of decoded video frames against an OpenCV demosaic of the source"""
+    capture = cv2.VideoCapture(video_path)
+    values = []
+    for i, idx in enumerate(indices):
+        ok, decoded = capture.read()
+        if not ok:
+            break
+        if i % every:
+            continue
+        reference = cv2.cvtColor(frame_buffer[idx], cv2.COLOR_BAYER_BG2BGR)
+        if decoded.shape != reference.shape:
+            decoded = cv2.resize(decoded, (reference.shape[1], reference.shape[0]))
+        mse = np.mean((decoded.astype(np.float32) - reference.astype(np.float32)) ** 2)
+        values.append(99.0 if mse == 0 else 10 * np.log10(255.0 ** 2 / mse))
+    capture.release()
+    return round(float(np.mean(values)), 2) if values else None
+
+
+def run_encoder_benchmark(frames=60, width=1440, height=1080, fps=220, min_psnr=30.0, max_mb_per_s=None,
+                          backends=None):
+    """
+    Time every available encoder backend on synthetic Bayer frames
     
-    height, width = sample_frame.shape
+    The fastest backend meeting the quality (PSNR) and size (MB per second
+    of video) targets becomes this device's 'auto' choice and is cached in
+    <recording_path>/encoder_benchmark.json, keyed by hostname.
+    
+    Returns:
+        dict with per-backend results and the chosen backend
+    """
+    probe = probe_encoder_backends(force=True)
+    
+    # A car crossing a slightly noisy track, like a real race clip
+    rng = np.random.default_rng(0)
+    base = make_synthetic_frame(height, width, 0, 1.0)
+    frame_buffer = np.empty((frames, height, width), dtype=np.uint8)
+    for i in range(frames):
+        frame = make_synthetic_frame(height, width, 0.4 + 0.2 * i / frames, 1.0, base)
+        noise = rng.integers(-3, 4, size=(height, width), dtype=np.int16)
+        frame_buffer[i] = np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    indices = np.arange(frames)
+    
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='hw_encoder_benchmark_')
+    encode_stats = camera_state['last_encode_stats']
+    try:
+        for name in (backends or ENCODER_BACKENDS):
+            if not probe.get(name, {}).get('available'):
+                results[name] = {'available': False, 'reason': probe.get(name, {}).get('reason', 'unknown backend')}
+                continue
+            
+            out_path = os.path.join(work_dir, f'{name}.mp4')
+            print(f"⏱️ Benchmarking encoder backend: {name}")
+            written = encode_bayer_frames_to_mp4(frame_buffer, indices, fps, out_path, encode={'encoder': name})
+            if not written:
+                results[name] = {'available': True, 'error': 'encode failed', 'meets_target': False}
+                continue
+            
+            stats = camera_state['last_encode_stats']
+            mb_per_s = os.path.getsize(out_path) / (1024 * 1024) / (frames / fps)
+            psnr = measure_psnr(out_path, frame_buffer, indices)
+            meets_target = (psnr is not None and psnr >= min_psnr and
+                            (max_mb_per_s is None or mb_per_s <= max_mb_per_s))
+            results[name] = {
+                'available': True,
+                'codec': stats['codec'],
+                'fps': stats['fps'],
+                'seconds': stats['seconds'],
+                'mb_per_s': round(mb_per_s, 2),
+                'psnr': psnr,
+                'meets_target': meets_target
+            }
+            os.remove(out_path)
+    finally:
+        camera_state['last_encode_stats'] = encode_stats
+        for name in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+    
+    candidates = [name for name, result in results.items() if result.get('meets_target')]
+    chosen = max(candidates, key=lambda name: results[name]['fps']) if candidates else None
+    
+    if chosen:
+        choice = {
+            'backend': chosen,
+            'results': results,
+            'frames': frames,
+            'resolution': f'{width}x{height}',
+            'targets': {'min_psnr': min_psnr, 'max_mb_per_s': max_mb_per_s},
+            'timestamp': time.time()
+        }
+        try:
+            cache = {}
+            if os.path.exists(get_encoder_choice_file()):
+                with open(get_encoder_choice_file()) as f:
+                    cache = json.load(f)
+            cache[socket.gethostname()] = choice
+            os.makedirs(camera_state['recording_path'], exist_ok=True)
+            with open(get_encoder_choice_file(), 'w') as f:
+                json.dump(cache, f, indent=2)
+        except Exception as e:
+            print(f"⚠️ Failed to save encoder benchmark cache: {e}")
+        camera_state['encoder_choice'] = choice
+        print(f"🏁 Fastest encoder meeting targets: {chosen} ({results[chosen]['fps']} frames/s)")
+    
+    return {'results': results, 'chosen': chosen}
+
+
+def get_scaled_size(width, height, scale_width=None):
+    """Output size for a downscale to scale_width (even height, aspect kept)"""
+    if not scale_width or scale_width >= width:
+        return width, height
+    return int(scale_width) // 2 * 2, max(round(height * scale_width / width / 2) * 2, 2)
+
+
+def write_frames_opencv(out_path, frame_buffer, ordered_indices, fps, workers, control=None, scale_width=None):
+    """
+    Demosaic in Python and write BGR frames with cv2.VideoWriter
+    
+    Args:
+        control: Optional EncodeControl to cancel between frames
+        scale_width: Optional output width (downscaled after demosaic)
     
-    # Create video writer - use H.264 codec for browser compatibility
-    fourcc_avc1 = cv2.VideoWriter_fourcc(*'avc1')  # H.264 codec
-    writer = cv2.VideoWriter(out_path, fourcc_avc1, fps, (width, height), True)
+    Returns:
+        True if all frames were written
+    """
+    height, width = frame_buffer.shape[1:3]
+    out_width, out_height = get_scaled_size(width, height, scale_width)
+    total_frames = len(ordered_indices)
+    
+    # Create MP4 writer - use H.264 codec for browser compatibility
+    fourcc_avc1 = cv2.VideoWriter_fourcc(*"avc1")  # H.264 codec
+    writer = cv2.VideoWriter(out_path, fourcc_avc1, fps, (out_width, out_height), True)
     
     if not writer.isOpened():
         print("⚠️ avc1 (H.264) codec failed, trying mp4v fallback")
-        fourcc_mp4v = cv2.VideoWriter_fourcc(*'mp4v')  # MPEG-4 fallback
-        writer = cv2.VideoWriter(out_path, fourcc_mp4v, fps, (width, height), True)
+        fourcc_mp4v = cv2.VideoWriter_fourcc(*"mp4v")  # MPEG-4 fallback
+        writer = cv2.VideoWriter(out_path, fourcc_mp4v, fps, (out_width, out_height), True)
         print("📹 Using mp4v codec (may have browser compatibility issues)")
     else:
         print("✅ Using avc1 (H.264) codec for browser compatibility")
     
     if not writer.isOpened():
-        return None
+        print("❌ Failed to open VideoWriter")
+        return False
+
+    print(f"🎬 Encoding to color MP4 ({workers} demosaic worker(s))...")
+
+    # Demosaic Bayer to color in parallel, write in capture order
+    for i, frame_bgr in enumerate(demosaic_frames(frame_buffer, ordered_indices, workers)):
+        if control and control.cancelled:
+            print("⏹️ Encode cancelled")
+            writer.release()
+            return False
+        if out_width != width:
+            frame_bgr = cv2.resize(frame_bgr, (out_width, out_height), interpolation=cv2.INTER_AREA)
+        writer.write(frame_bgr)
+
+        # Progress report
+        if (i + 1) % 200 == 0 or i == total_frames - 1:
+            print(f"  📹 Encoded {i + 1}/{total_frames} frames")
+
+    writer.release()
+    return True
+
+
+def build_ffmpeg_bayer_command(out_path, width, height, fps, encode):
+    """ffmpeg command reading raw Bayer frames from stdin and writing an MP4"""
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'rawvideo',
+        '-pix_fmt', DAHENG_FFMPEG_BAYER_FORMAT,
+        '-s', f'{width}x{height}',
+        '-framerate', str(fps),
+        '-i', 'pipe:0',
+        '-c:v', encode['codec']
+    ]
+    out_width, out_height = get_scaled_size(width, height, encode.get('scale_width'))
+    if out_width != width:
+        cmd += ['-vf', f'scale={out_width}:{out_height}']
+    if encode.get('frame_timing') == 'vfr':
+        # No B-frames: per-frame durations are rewritten after encoding
+        cmd += ['-bf', '0', '-video_track_timescale', str(VFR_TIMESCALE)]
+    # preset/crf only exist for the x264/x265 software encoders
+    if encode['codec'] in ('libx264', 'libx265'):
+        cmd += ['-preset', str(encode['preset']), '-crf', str(encode['crf'])]
+    if encode.get('bitrate'):
+        cmd += ['-b:v', str(encode['bitrate'])]
+    cmd += get_output_profile_args(encode)
+    cmd += [
+        '-threads', str(encode['threads']),
+        '-pix_fmt', 'yuv420p',
+        out_path
+    ]
+    return cmd
+
+
+def write_bayer_frames_ffmpeg(out_path, frame_buffer, ordered_indices, fps, encode, control=None):
+    """
+    Stream single-channel Bayer frames to ffmpeg as rawvideo
     
-    # Demosaic and write frames
-    bayer_code = cv2.COLOR_BAYER_BG2BGR
+    ffmpeg does the colour conversion and encoding in native threads, so
+    Python only copies 1 byte per pixel into the pipe (a third of BGR).
+    Frames are written straight from the ring buffer without copies.
     
-    for idx in ordered_indices:
-        raw_bayer = frame_buffer[idx]
-        frame_bgr = cv2.cvtColor(raw_bayer, bayer_code)
-        writer.write(frame_bgr)
+    Args:
+        control: Optional EncodeControl; cancel() kills ffmpeg
     
-    writer.release()
+    Returns:
+        True if ffmpeg finished successfully
+    """
+    height, width = frame_buffer.shape[1:3]
+    total_frames = len(ordered_indices)
+    cmd = build_ffmpeg_bayer_command(out_path, width, height, fps, encode)
     
-    return out_path
+    print(f"🎬 Encoding Bayer frames with ffmpeg ({encode['codec']}, preset {encode['preset']})...")
+    print(f"🎥 ffmpeg command: {' '.join(cmd)}")
+    
+    process = process_supervisor.start(cmd, 'daheng_encode', idle_timeout=FFMPEG_IDLE_TIMEOUT,
+                                       total_frames=total_frames, stdin=subprocess.PIPE)
+    pin_to_worker_cpus(process.pid)  # Keep encoding off the capture core
+    if control:
+        control.attach(process)
+    
+    try:
+        for i, idx in enumerate(ordered_indices):
+            process.stdin.write(frame_buffer[idx])
+
+            # Progress report
+            if (i + 1) % 200 == 0 or i == total_frames - 1:
+                print(f"  📹 Encoded {i + 1}/{total_frames} frames")
+        process.stdin.close()
+    except BrokenPipeError:
+        print("❌ ffmpeg closed its input early")
+    
+    process.wait()
+    
+    if process.returncode != 0:
+        print(f"❌ ffmpeg encode {process.status} (code {process.returncode}): {process.stderr_text()}")
+        return False
+    return True
+
+
+# MP4 boxes rewritten for variable-frame-rate output (other boxes are copied as-is)
+MP4_CONTAINER_BOXES = (b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts')
+
+
+def parse_mp4_boxes(data):
+    """Parse MP4 boxes into [type, payload] lists, descending into MP4_CONTAINER_BOXES"""
+    boxes = []
+    pos = 0
+    while pos + 8 <= len(data):
+        size, box_type = struct.unpack('>I4s', data[pos:pos + 8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+            header_size = 16
+        elif size == 0:
+            size = len(data) - pos
+        payload = data[pos + header_size:pos + size]
+        boxes.append([box_type, parse_mp4_boxes(payload) if box_type in MP4_CONTAINER_BOXES else payload])
+        pos += size
+    return boxes
+
+
+def build_mp4_boxes(boxes):
+    """Serialize [type, payload] lists back to bytes (sizes recomputed)"""
+    out = bytearray()
+    for box_type, payload in boxes:
+        if isinstance(payload, list):
+            payload = build_mp4_boxes(payload)
+        out += struct.pack('>I4s', len(payload) + 8, box_type) + payload
+    return bytes(out)
+
+
+def find_mp4_box(boxes, box_type):
+    return next((box for box in boxes if box[0] == box_type), None)
+
+
+def scan_mp4_top_level(f):
+    """Top-level boxes of an MP4 file as {type: (offset, size)} (first occurrence)"""
+    boxes = {}
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+        elif size == 0:
+            size = file_size - offset
+        boxes.setdefault(box_type, (offset, size))
+        offset += size
+    return boxes
+
+
+def set_mp4_duration_field(box, offset_v0, offset_v1, value):
+    """Write a duration field of a versioned full box (32-bit in v0, 64-bit in v1)"""
+    payload = bytearray(box[1])
+    if payload[0] == 1:
+        struct.pack_into('>Q', payload, offset_v1, value)
+    else:
+        struct.pack_into('>I', payload, offset_v0, min(value, 0xFFFFFFFF))
+    box[1] = bytes(payload)
+
+
+def read_mp4_moov(mp4_path):
+    """Top-level box table and parsed moov children of an MP4 file"""
+    with open(mp4_path, 'rb') as f:
+        top = scan_mp4_top_level(f)
+        if b'moov' not in top:
+            raise ValueError("No moov box")
+        moov_offset, moov_size = top[b'moov']
+        f.seek(moov_offset)
+        return top, parse_mp4_boxes(f.read(moov_size))[0][1]
+
+
+def find_mp4_video_trak(moov):
+    """Children of the first video trak in a parsed moov"""
+    for box in moov:
+        if box[0] == b'trak':
+            hdlr = find_mp4_box(find_mp4_box(box[1], b'mdia')[1], b'hdlr')
+            if hdlr and hdlr[1][8:12] == b'vide':
+                return box[1]
+    raise ValueError("No video track")
+
+
+def get_mp4_trak_stbl(trak):
+    return find_mp4_box(find_mp4_box(find_mp4_box(trak, b'mdia')[1], b'minf')[1], b'stbl')[1]
+
+
+def shift_mp4_chunk_offsets(moov, delta):
+    """Move every track's chunk offsets (stco/co64) by delta bytes"""
+    for box in moov:
+        if box[0] != b'trak':
+            continue
+        trak_stbl = get_mp4_trak_stbl(box[1])
+        for offsets_type, dtype in ((b'stco', '>u4'), (b'co64', '>u8')):
+            offsets_box = find_mp4_box(trak_stbl, offsets_type)
+            if offsets_box:
+                offsets = np.frombuffer(offsets_box[1][8:], dtype=dtype).astype(np.int64) + delta
+                offsets_box[1] = offsets_box[1][:8] + offsets.astype(dtype).tobytes()
+
+
+def move_mp4_moov_to_front(mp4_path):
+    """
+    Fast-start an MP4 in place: move the moov box in front of mdat
+    
+    Same result as ffmpeg -movflags +faststart, for writers that can't do
+    it themselves (cv2.VideoWriter). Frame data is copied, not re-encoded,
+    and hashed on the way into the checksum manifest the upload uses.
+    
+    Returns:
+        True if the file was rewritten, False if moov was already in front
+    """
+    top, moov = read_mp4_moov(mp4_path)
+    moov_offset, moov_size = top[b'moov']
+    mdat_offset = top.get(b'mdat', (0, 0))[0]
+    if moov_offset < mdat_offset:
+        return False
+    
+    shift_mp4_chunk_offsets(moov, moov_size)
+    new_moov = build_mp4_boxes([[b'moov', moov]])
+    tmp_path = mp4_path + '.tmp'
+    hasher = ChunkHasher()
+    with open(mp4_path, 'rb') as src, open(tmp_path, 'wb') as out:
+        dst = HashingWriter(out, hasher)
+        dst.write(src.read(mdat_offset))
+        dst.write(new_moov)
+        remaining = moov_offset - mdat_offset
+        while remaining > 0:
+            chunk = src.read(min(remaining, RAW_ARCHIVE_WRITE_CHUNK))
+            dst.write(chunk)
+            remaining -= len(chunk)
+        src.seek(moov_offset + moov_size)
+        shutil.copyfileobj(src, dst, RAW_ARCHIVE_WRITE_CHUNK)
+    os.replace(tmp_path, mp4_path)
+    hasher.save(mp4_path)
+    return True
+
+
+def measure_playback(mp4_path, seeks=10):
+    """
+    Measure how quickly a viewer can start and scrub an MP4
+    
+    bytes_before_playback is what a browser must download before the first
+    frame can be shown (everything up to the end of moov, i.e. the whole
+    file when moov is at the end). Seek times are random frame-accurate
+    seeks through OpenCV, which decode forward from the previous keyframe
+    just like the viewer does.
+    
+    Returns:
+        dict with moov_at_front, bytes_before_playback, keyframe_interval,
+        first_frame_ms, seek_ms_mean and seek_ms_max
+    """
+    top, moov = read_mp4_moov(mp4_path)
+    moov_offset, moov_size = top[b'moov']
+    moov_at_front = moov_offset < top.get(b'mdat', (0, 0))[0]
+    
+    stbl = get_mp4_trak_stbl(find_mp4_video_trak(moov))
+    stsz = find_mp4_box(stbl, b'stsz')[1]
+    sample_count = struct.unpack('>I', stsz[8:12])[0]
+    stss = find_mp4_box(stbl, b'stss')
+    # No stss box: every sample is a sync sample
+    keyframes = struct.unpack('>I', stss[1][4:8])[0] if stss else sample_count
+    
+    result = {
+        'file_size': os.path.getsize(mp4_path),
+        'moov_at_front': moov_at_front,
+        'bytes_before_playback': moov_offset + moov_size if moov_at_front else os.path.getsize(mp4_path),
+        'frames': sample_count,
+        'keyframes': keyframes,
+        'keyframe_interval': round(sample_count / keyframes, 1) if keyframes else None
+    }
+    
+    if CV2_AVAILABLE:
+        open_start = time.perf_counter()
+        capture = cv2.VideoCapture(mp4_path)
+        ok, _ = capture.read()
+        result['first_frame_ms'] = round((time.perf_counter() - open_start) * 1000, 2) if ok else None
+        
+        seek_times = []
+        rng = np.random.default_rng(0)
+        for position in rng.integers(0, max(sample_count - 1, 1), size=seeks):
+            seek_start = time.perf_counter()
+            capture.set(cv2.CAP_PROP_POS_FRAMES, int(position))
+            if capture.read()[0]:
+                seek_times.append((time.perf_counter() - seek_start) * 1000)
+        capture.release()
+        result['seek_ms_mean'] = round(float(np.mean(seek_times)), 2) if seek_times else None
+        result['seek_ms_max'] = round(float(np.max(seek_times)), 2) if seek_times else None
+    return result
+
+
+def write_mp4_frame_times(mp4_path, frame_times):
+    """
+    Turn a constant-rate MP4 into a variable-frame-rate one
+    
+    Rewrites the video track's time-to-sample table (stts) so every frame
+    gets its real duration from the capture timestamps, then fixes the
+    track/movie durations and the edit list. Frame data is not touched.
+    Files with B-frames (ctts) are refused, since their composition offsets
+    assume the constant rate.
+    
+    Args:
+        mp4_path: MP4 file, one video sample per entry of frame_times
+        frame_times: Presentation times in seconds (first frame = 0)
+    """
+    top, moov = read_mp4_moov(mp4_path)
+    moov_offset, moov_size = top[b'moov']
+    
+    mvhd = find_mp4_box(moov, b'mvhd')
+    movie_timescale = struct.unpack('>I', mvhd[1][20:24] if mvhd[1][0] == 1 else mvhd[1][12:16])[0]
+    
+    video_trak = find_mp4_video_trak(moov)
+    mdia = find_mp4_box(video_trak, b'mdia')[1]
+    mdhd = find_mp4_box(mdia, b'mdhd')
+    timescale = struct.unpack('>I', mdhd[1][20:24] if mdhd[1][0] == 1 else mdhd[1][12:16])[0]
+    stbl = find_mp4_box(find_mp4_box(mdia, b'minf')[1], b'stbl')[1]
+    if find_mp4_box(stbl, b'ctts'):
+        raise ValueError("Track has B-frames (ctts), cannot retime")
+    
+    stts = find_mp4_box(stbl, b'stts')
+    entry_count = struct.unpack('>I', stts[1][4:8])[0]
+    entries = np.frombuffer(stts[1][8:8 + entry_count * 8], dtype='>u4').reshape(-1, 2)
+    sample_count = int(entries[:, 0].sum())
+    if sample_count != len(frame_times):
+        raise ValueError(f"{sample_count} samples in file, {len(frame_times)} timestamps")
+    
+    # Round absolute times (not durations) to ticks so rounding never drifts
+    ticks = np.round(np.asarray(frame_times, dtype=np.float64) * timescale).astype(np.int64)
+    durations = np.diff(ticks)
+    last = int(np.median(durations)) if len(durations) else timescale
+    durations = np.maximum(np.append(durations, last), 1)
+    
+    # Run-length encode (count, delta) pairs
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(durations)) + 1))
+    counts = np.diff(np.append(starts, len(durations)))
+    table = np.column_stack([counts, durations[starts]]).astype('>u4')
+    stts[1] = stts[1][:4] + struct.pack('>I', len(starts)) + table.tobytes()
+    
+    media_duration = int(durations.sum())
+    movie_duration = int(round(media_duration * movie_timescale / timescale))
+    set_mp4_duration_field(mdhd, 16, 24, media_duration)
+    set_mp4_duration_field(find_mp4_box(video_trak, b'tkhd'), 20, 28, movie_duration)
+    set_mp4_duration_field(mvhd, 16, 24, movie_duration)
+    
+    edts = find_mp4_box(video_trak, b'edts')
+    elst = find_mp4_box(edts[1], b'elst') if edts else None
+    if elst:
+        payload = bytearray(elst[1])
+        version = payload[0]
+        entry_size = 20 if version == 1 else 12
+        for i in range(struct.unpack('>I', payload[4:8])[0]):
+            pos = 8 + i * entry_size
+            if version == 1:
+                media_time = struct.unpack_from('>q', payload, pos + 8)[0]
+            else:
+                media_time = struct.unpack_from('>i', payload, pos + 4)[0]
+            if media_time >= 0:
+                struct.pack_into('>Q' if version == 1 else '>I', payload, pos, movie_duration)
+        elst[1] = bytes(payload)
+    
+    new_moov = build_mp4_boxes([[b'moov', moov]])
+    growth = len(new_moov) - moov_size
+    mdat_offset = top.get(b'mdat', (0, 0))[0]
+    
+    # moov in front of mdat (fast start): chunk offsets move with the moov size
+    if growth and moov_offset < mdat_offset:
+        shift_mp4_chunk_offsets(moov, growth)
+        new_moov = build_mp4_boxes([[b'moov', moov]])
+    
+    if moov_offset + moov_size == os.path.getsize(mp4_path):
+        # moov at the end: rewrite it in place
+        with open(mp4_path, 'r+b') as f:
+            f.seek(moov_offset)
+            f.write(new_moov)
+            f.truncate()
+    else:
+        tmp_path = mp4_path + '.tmp'
+        with open(mp4_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            dst.write(src.read(moov_offset))
+            dst.write(new_moov)
+            src.seek(moov_offset + moov_size)
+            shutil.copyfileobj(src, dst, RAW_ARCHIVE_WRITE_CHUNK)
+        os.replace(tmp_path, mp4_path)
+
+
+class EncodeControl:
+    """
+    Cancellation handle for a running encode
+    
+    Encoders attach their ffmpeg process so cancel() can kill it, and
+    Python-side loops poll .cancelled between frames.
+    """
+    
+    def __init__(self):
+        self.cancelled = False
+        self.process = None
+    
+    def attach(self, process):
+        self.process = process
+        if self.cancelled:
+            process.kill()
+    
+    def cancel(self):
+        self.cancelled = True
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+
+
+def get_daheng_output_path():
+    """
+    MP4 path of the current recording in the recording directory
+    
+    Named after the recording's start time, so its preview (_preview.mp4),
+    raw archive (.hwraw) and full MP4 share one base name: the recording id
+    the server uses to drop a preview once the full video has arrived.
+    """
+    name = camera_state['daheng_recording_name'] or \
+        f"daheng_imx273_capture_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    os.makedirs(camera_state['recording_path'], exist_ok=True)
+    return os.path.join(camera_state['recording_path'], f'{name}.mp4')
+
+
+class DahengLiveEncoder:
+    """
+    Encode Daheng frames while the capture is still running
+    
+    A background thread trails the capture head in the ring buffer and
+    pipes each finished frame to ffmpeg, so after stop only the tail is
+    left to encode. The capture loop never waits for the encoder: when the
+    encoder lags by more than catchup_frames it switches to catch-up mode
+    (large batched writes, no idling), and if it is about to be lapped by
+    the ring buffer it skips ahead and counts the skipped frames.
+    
+    The frame ID and timestamps of every written frame are kept, since the
+    ring buffer only holds the last frames by the time capture stops: the
+    capture report and the file's timing (measured rate, or VFR) come from
+    exactly the frames in the file.
+    """
+    
+    def __init__(self, out_path, fps, encode=None, catchup_frames=64):
+        self.out_path = out_path
+        self.fps = fps
+        self.encode = get_daheng_encode_settings(encode)
+        if self.encode['writer'] != 'ffmpeg':
+            # Live encoding needs a pipe; use the software ffmpeg backend
+            self.encode = get_daheng_encode_settings(dict(encode or {}, encoder='ffmpeg'))
+        self.catchup_frames = catchup_frames
+        self.frame_buffer = camera_state['daheng_frame_buffer']
+        self.process = None
+        self.thread = None
+        self.capture_done = False
+        self.error = None
+        self.frames_written = 0
+        self.frames_skipped = 0
+        self.catchup_events = 0
+        self.max_lag_frames = 0
+        self.frame_timing = 'cfr'
+        self.output_fps = fps
+        self.written_host_ts = []  # Per-write array chunks, in file order
+        self.written_dev_ts = []
+        self.written_ids = []
+        self.started_at = None
+    
+    def start(self):
+        """Start ffmpeg and the encoder thread"""
+        height, width = self.frame_buffer.shape[1:3]
+        cmd = build_ffmpeg_bayer_command(self.out_path, width, height, self.fps, self.encode)
+        print(f"🎬 Live encoder: {' '.join(cmd)}")
+        
+        # No idle timeout: ffmpeg is legitimately silent while it waits for frames
+        self.process = process_supervisor.start(cmd, 'daheng_live_encode', stdin=subprocess.PIPE)
+        pin_to_worker_cpus(self.process.pid)  # Keep encoding off the capture core
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self._run, name='daheng-live-encoder', daemon=True)
+        self.thread.start()
+    
+    def _run(self):
+        """Trail the capture head until capture is done and all frames are written"""
+        pin_to_worker_cpus()
+        buffer_size = self.frame_buffer.shape[0]
+        safety_frames = max(buffer_size // 8, 1)  # Never read a slot the capture is about to overwrite
+        next_frame = 0
+        catching_up = False
+        
+        try:
+            while True:
+                done = self.capture_done  # Read before the count so the final count is seen
+                lag = camera_state['daheng_frame_count'] - next_frame
+                self.max_lag_frames = max(self.max_lag_frames, lag)
+                
+                if lag <= 0:
+                    if done:
+                        break
+                    time.sleep(0.002)
+                    continue
+                
+                if lag > buffer_size - safety_frames:
+                    skip = lag - buffer_size // 2
+                    print(f"⚠️ Live encoder lapped by capture, skipping {skip} frames")
+                    next_frame += skip
+                    self.frames_skipped += skip
+                    continue
+                
+                if lag > self.catchup_frames and not catching_up:
+                    self.catchup_events += 1
+                catching_up = lag > self.catchup_frames
+                
+                # One write per contiguous run of ready frames (up to the buffer end)
+                head = next_frame % buffer_size
+                count = min(lag, buffer_size - head, self.catchup_frames if catching_up else lag)
+                self.written_host_ts.append(camera_state['daheng_ts_buffer'][head:head + count].copy())
+                self.written_dev_ts.append(camera_state['daheng_dev_ts_buffer'][head:head + count].copy())
+                self.written_ids.append(camera_state['daheng_id_buffer'][head:head + count].copy())
+                self.process.stdin.write(self.frame_buffer[head:head + count])
+                next_frame += count
+                self.frames_written += count
+        except Exception as e:
+            self.error = str(e)
+            print(f"❌ Live encoder error: {e}")
+    
+    def capture_report(self, target_fps=220):
+        """Capture report (build_capture_report) of the frames written to the file"""
+        if not self.written_ids:
+            return None
+        return build_capture_report(np.concatenate(self.written_host_ts), np.concatenate(self.written_ids),
+                                    np.concatenate(self.written_dev_ts), camera_state['daheng_tick_hz'],
+                                    target_fps)
+    
+    def _apply_timing(self):
+        """
+        Give the file the capture's timing: the real frame times for VFR
+        output, else a constant rate at the measured (not nominal) fps
+        """
+        if self.frames_written < 2:
+            return
+        frame_times = get_frame_times(np.concatenate(self.written_host_ts), np.concatenate(self.written_dev_ts),
+                                      camera_state['daheng_tick_hz'])[0]
+        self.frame_timing = apply_frame_timing(self.out_path, frame_times, self.encode)
+        if self.frame_timing == 'vfr' or frame_times[-1] <= 0:
+            return
+        measured_fps = (self.frames_written - 1) / float(frame_times[-1])
+        if abs(measured_fps - self.fps) <= self.fps * 0.005:
+            return
+        try:
+            write_mp4_frame_times(self.out_path, np.arange(self.frames_written) / measured_fps)
+            self.output_fps = measured_fps
+            print(f"⏱️ Live encode retimed from {self.fps} to the measured {measured_fps:.2f} fps")
+        except Exception as e:
+            print(f"⚠️ Keeping the nominal {self.fps} fps, retiming failed: {e}")
+    
+    def finish(self):
+        """
+        Encode the remaining tail and close the file
+        
+        Returns:
+            Output path, or None if encoding failed
+        """
+        self.capture_done = True
+        self.thread.join()
+        
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        
+        if self.process.returncode != 0:
+            self.error = self.error or f"ffmpeg exited with code {self.process.returncode}"
+            print(f"❌ Live encode failed: {self.process.stderr_text()}")
+        
+        if self.error or not os.path.exists(self.out_path):
+            return None
+        self._apply_timing()
+        write_checksum_manifest(self.out_path)
+        return self.out_path
+    
+    def abort(self):
+        """Stop the encoder without waiting for the tail"""
+        self.capture_done = True
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+        if self.thread:
+            self.thread.join(timeout=5)
+    
+    def stats(self):
+        """Encoder counters for the stop_recording response"""
+        return {
+            'frames': self.frames_written,
+            'frames_skipped': self.frames_skipped,
+            'catchup_events': self.catchup_events,
+            'max_lag_frames': self.max_lag_frames,
+            'encoder': 'ffmpeg_live',
+            'codec': self.encode['codec'],
+            'frame_timing': self.frame_timing,
+            'output_fps': round(self.output_fps, 3),
+            'error': self.error
+        }
 
 
-def save_daheng_buffer_to_mp4():
+def save_daheng_buffer_to_mp4(measured_fps=None, workers=None, encode=None, frame_range=None):
     """
     Save Daheng ring buffer to MP4 video file
-    Uses the exact same approach as working test_camera_imx273.py
+    
+    With ffmpeg installed the Bayer frames are piped to ffmpeg, which
+    debayers and encodes them. Otherwise frames are demosaiced in Python
+    worker threads and written with cv2.VideoWriter, exactly like the
+    working test_camera_imx273.py.
+    
+    Args:
+        measured_fps: Capture rate from the capture report (device timestamps).
+                      Falls back to host timestamps when not given.
+        workers: Demosaic threads for the OpenCV writer (default: one per worker CPU)
+        encode: Encoder settings, see DAHENG_ENCODE_DEFAULTS
+        frame_range: Optional (start, end) positions in capture order to encode
+                     (e.g. the motion window from find_daheng_motion_window)
     """
     frame_buffer = camera_state['daheng_frame_buffer']
     ts_buffer = camera_state['daheng_ts_buffer'] 
-    id_buffer = camera_state['daheng_id_buffer']
-    head = camera_state['daheng_head']
     frame_count = camera_state['daheng_frame_count']
     
     if frame_buffer is None or frame_count == 0:
         print("No frames to save.")
         return None
 
-    buffer_size = frame_buffer.shape[0]
-    total_frames = min(frame_count, buffer_size)
+    # Determine chronological order: oldest -> newest
+    ordered_indices = get_daheng_ordered_indices()
+    if frame_range:
+        ordered_indices = ordered_indices[frame_range[0]:frame_range[1]]
+    total_frames = len(ordered_indices)
 
     if total_frames < 2:
         print("Not enough frames to make a video.")
         return None
 
     # Create output path with camera name prefix
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_path = os.path.join(camera_state['recording_path'], f'daheng_imx273_capture_{timestamp}.mp4')
-    os.makedirs(camera_state['recording_path'], exist_ok=True)
+    out_path = get_daheng_output_path()
 
     print(f"🎬 Encoding {total_frames} frames to MP4...")
 
-    # Determine chronological order: oldest -> newest (exactly like working test)
-    if frame_count <= buffer_size:
-        # Never wrapped. Valid frames are [0 .. total_frames-1]
-        start = 0
-    else:
-        # Wrapped at least once. Oldest frame is at 'head'
-        start = head
-
-    ordered_indices = [(start + i) % buffer_size for i in range(total_frames)]
-
     # Compute effective FPS from timestamps (exactly like working test)
     first_ts = ts_buffer[ordered_indices[0]]
     last_ts = ts_buffer[ordered_indices[-1]]
     duration = last_ts - first_ts
 
-    if duration > 0:
+    if measured_fps:
+        fps = measured_fps
+        print(f"📊 Measured capture FPS (capture report): {fps:.2f}")
+    elif duration > 0:
         fps = (total_frames - 1) / duration
         print(f"📊 Measured capture FPS: {fps:.2f}")
     else:
@@ -1077,39 +5112,87 @@ def save_daheng_buffer_to_mp4():
     height, width = sample_frame.shape
     print(f"📊 Video dimensions: {width}x{height} @ {fps} fps")
 
-    # Create MP4 writer - use H.264 codec for browser compatibility
-    fourcc_avc1 = cv2.VideoWriter_fourcc(*"avc1")  # H.264 codec
-    writer = cv2.VideoWriter(out_path, fourcc_avc1, fps, (width, height), True)
-    
-    if not writer.isOpened():
-        print("⚠️ avc1 (H.264) codec failed, trying mp4v fallback")
-        fourcc_mp4v = cv2.VideoWriter_fourcc(*"mp4v")  # MPEG-4 fallback
-        writer = cv2.VideoWriter(out_path, fourcc_mp4v, fps, (width, height), True)
-        print("📹 Using mp4v codec (may have browser compatibility issues)")
-    else:
-        print("✅ Using avc1 (H.264) codec for browser compatibility")
+    frame_times, _ = get_daheng_frame_times(ordered_indices)
+    return encode_bayer_frames_to_mp4(frame_buffer, ordered_indices, fps, out_path, workers, encode,
+                                      frame_times=frame_times)
+
+
+def apply_frame_timing(out_path, frame_times, encode):
+    """
+    Give an encoded MP4 the real capture timing when VFR output is requested
     
-    if not writer.isOpened():
-        print("❌ Failed to open VideoWriter")
-        return None
+    Returns:
+        'vfr' if per-frame timestamps were written, else 'cfr'
+    """
+    if encode.get('frame_timing') != 'vfr' or frame_times is None:
+        return 'cfr'
+    try:
+        write_mp4_frame_times(out_path, frame_times)
+        print(f"⏱️ Variable frame rate: {len(frame_times)} frame timestamps written")
+        return 'vfr'
+    except Exception as e:
+        print(f"⚠️ Keeping constant frame rate, VFR rewrite failed: {e}")
+        return 'cfr'
 
-    print(f"🎬 Encoding to color MP4...")
 
-    # Demosaic Bayer to color (exactly like working test)
-    bayer_code = cv2.COLOR_BAYER_BG2BGR  # Same as working test
+def encode_bayer_frames_to_mp4(frame_buffer, ordered_indices, fps, out_path, workers=None, encode=None,
+                               control=None, frame_times=None):
+    """
+    Encode Bayer frames (ring buffer or raw archive) to an MP4 file
+    
+    Args:
+        frame_buffer: (N, H, W) Bayer frames (array or memmap)
+        ordered_indices: Frame indices in output order
+        fps: Output frame rate
+        out_path: MP4 path
+        workers: Demosaic threads for the OpenCV writer (default: one per worker CPU)
+        encode: Encoder settings, see DAHENG_ENCODE_DEFAULTS
+        control: Optional EncodeControl for cancellation
+        frame_times: Capture times (seconds) of the frames, used when
+                     encode['frame_timing'] is 'vfr'
+    
+    Returns:
+        out_path, or None if encoding failed
+    """
+    total_frames = len(ordered_indices)
+    height, width = frame_buffer.shape[1:3]
+    
+    if workers is None:
+        workers = get_default_encode_workers()
+    encode = get_daheng_encode_settings(encode)
+    encoder = encode['encoder']
 
-    for i, idx in enumerate(ordered_indices):
-        raw_bayer = frame_buffer[idx]  # (H, W), uint8
-        
-        # Demosaic to BGR color (exactly like working test)
-        frame_bgr = cv2.cvtColor(raw_bayer, bayer_code)
-        writer.write(frame_bgr)
+    encode_start = time.time()
 
-        # Progress report
-        if (i + 1) % 200 == 0 or i == total_frames - 1:
-            print(f"  📹 Encoded {i + 1}/{total_frames} frames")
+    if encode['writer'] == 'ffmpeg':
+        written = write_bayer_frames_ffmpeg(out_path, frame_buffer, ordered_indices, fps, encode, control)
+        workers = 0  # ffmpeg debayers in its own threads
+    else:
+        written = write_frames_opencv(out_path, frame_buffer, ordered_indices, fps, workers, control,
+                                      encode['scale_width'])
 
-    writer.release()
+    if not written:
+        return None
+    frame_timing = apply_frame_timing(out_path, frame_times, encode)
+    hashed = False
+    if encode['writer'] == 'opencv':
+        if encode['gop'] or encode['all_intra']:
+            print("⚠️ OpenCV writer cannot set the keyframe interval, use an ffmpeg backend")
+        if encode['faststart']:
+            hashed = move_mp4_moov_to_front(out_path)
+    
+    encode_seconds = time.time() - encode_start
+    camera_state['last_encode_stats'] = {
+        'frames': int(total_frames),
+        'encoder': encoder,
+        'codec': encode['codec'],
+        'frame_timing': frame_timing,
+        'workers': workers,
+        'seconds': round(encode_seconds, 3),
+        'fps': round(total_frames / encode_seconds, 1) if encode_seconds > 0 else None
+    }
+    print(f"📊 Encode: {total_frames} frames in {encode_seconds:.2f}s "
+          f"({camera_state['last_encode_stats']['fps']} frames/s)")
     
     # Verify file was created and has reasonable size
     if os.path.exists(out_path):
@@ -1117,29 +5200,595 @@ def save_daheng_buffer_to_mp4():
         file_size_mb = file_size / (1024 * 1024)
         print(f"✅ Video saved: {out_path}")
         print(f"📊 File size: {file_size_mb:.2f} MB")
-        print(f"📊 Final video: {width}x{height} @ {fps}fps, {total_frames} frames")
+        out_width, out_height = get_scaled_size(width, height, encode['scale_width'])
+        print(f"📊 Final video: {out_width}x{out_height} @ {fps}fps, {total_frames} frames")
+        if not hashed:
+            write_checksum_manifest(out_path)
         return out_path
     else:
         print(f"❌ Failed to create video file")
         return None
 
 
-def stop_recording_daheng_imx273(camera_index=None, data=None):
+# Motion auto-trim: only the part of the buffer where something moves is encoded
+DAHENG_TRIM_DEFAULTS = {
+    'pixel_stride': 8,              # Sample every 8th row/column of the green Bayer sites
+    'pixel_threshold': 25,          # Grey-level change that counts as a changed pixel
+    'min_changed_fraction': 0.0005, # Changed-pixel fraction that counts as motion...
+    'noise_factor': 4.0,            # ...or this many times the clip's median (sensor noise)
+    'padding_s': 0.25,              # Kept before and after the active window
+    'chunk_frames': 64              # Frames differenced per vectorized step
+}
+
+
+def get_contiguous_runs(indices):
+    """Split buffer indices into (start, stop) runs of consecutive values"""
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.append(breaks, len(indices))
+    return [(int(indices[a]), int(indices[b - 1]) + 1) for a, b in zip(starts, stops)]
+
+
+def compute_motion_scores(frame_buffer, ordered_indices, pixel_stride=8, pixel_threshold=25, chunk_frames=64):
     """
-    Stop Daheng IMX273 recording and encode to MP4
+    Fraction of changed pixels between consecutive frames
     
-    Args:
-        camera_index: Camera index (optional, for compatibility)
-        data: Additional data (optional, for compatibility)
+    Works on the raw Bayer frames without demosaicing: only the green
+    sites on even rows / odd columns (RGGB layout) are sampled, every
+    pixel_stride-th row and column, and differenced in vectorized chunks.
     
-    Process:
-    1. Stop camera streaming
-    2. Demosaic Bayer frames from RAM 
-    3. Encode to MP4
+    Returns:
+        float32 array, one score per frame (score[0] = 0)
     """
-    cam = camera_state['daheng_cam']
+    stride = max(int(pixel_stride) // 2 * 2, 2)  # Even, so every sample is a green site
     
-    if not cam:
+    # Strided views of each contiguous run of the ring buffer: no full-frame copies
+    green = np.concatenate([frame_buffer[start:stop, 0::stride, 1::stride]
+                            for start, stop in get_contiguous_runs(ordered_indices)])
+    
+    scores = np.zeros(len(green), dtype=np.float32)
+    for start in range(1, len(green), chunk_frames):
+        stop = min(start + chunk_frames, len(green))
+        diff = np.abs(green[start:stop].astype(np.int16) - green[start - 1:stop - 1].astype(np.int16))
+        scores[start:stop] = (diff > pixel_threshold).mean(axis=(1, 2))
+    return scores
+
+
+def find_daheng_motion_window(ordered_indices, frame_times, trim=None):
+    """
+    Find the active window of the ring buffer from frame differencing
+    
+    Args:
+        ordered_indices: Buffer indices, oldest -> newest
+        frame_times: Capture times (seconds) of those frames
+        trim: Options overriding DAHENG_TRIM_DEFAULTS (True = defaults)
+    
+    Returns:
+        dict with 'start'/'end' positions into ordered_indices (end exclusive)
+        plus the window times and savings
+    """
+    options = dict(DAHENG_TRIM_DEFAULTS)
+    if isinstance(trim, dict):
+        options.update({key: value for key, value in trim.items() if key in options})
+    
+    analysis_start = time.time()
+    scores = compute_motion_scores(
+        camera_state['daheng_frame_buffer'], ordered_indices,
+        options['pixel_stride'], options['pixel_threshold'], options['chunk_frames']
+    )
+    threshold = max(options['min_changed_fraction'], float(np.median(scores)) * options['noise_factor'])
+    active = np.flatnonzero(scores > threshold)
+    total = len(ordered_indices)
+    
+    if len(active) == 0:
+        start, end = 0, total
+    else:
+        # Pad by time (not frames) so dropped frames don't shorten the padding
+        first_t = frame_times[active[0]] - options['padding_s']
+        last_t = frame_times[active[-1]] + options['padding_s']
+        start = int(np.searchsorted(frame_times, first_t, side='left'))
+        end = int(np.searchsorted(frame_times, last_t, side='right'))
+    
+    kept = end - start
+    return {
+        'motion_found': len(active) > 0,
+        'start': start,
+        'end': end,
+        'start_s': round(float(frame_times[start]), 4),
+        'end_s': round(float(frame_times[end - 1]), 4),
+        'frames_kept': kept,
+        'frames_total': total,
+        'saved_fraction': round(1 - kept / total, 4) if total else 0.0,
+        'threshold': round(threshold, 5),
+        'peak_score': round(float(scores.max()), 5) if total else 0.0,
+        'analysis_ms': round((time.time() - analysis_start) * 1000, 1)
+    }
+
+
+def save_daheng_preview(fps, preview=None, workers=None, frame_range=None):
+    """
+    Encode a small preview clip from the ring buffer
+    
+    Every Nth frame, downscaled, fastest preset: ready within seconds so
+    the kiosk can show something while the full-quality file is encoded.
+    Playback speed matches the full file (output fps is divided by N).
+    
+    Args:
+        fps: Capture rate of the ring buffer
+        preview: Options overriding DAHENG_PREVIEW_DEFAULTS (True = defaults)
+        workers: Demosaic threads for the OpenCV writer
+        frame_range: Optional (start, end) positions in capture order
+    
+    Returns:
+        (preview path or None, number of frames)
+    """
+    options = dict(DAHENG_PREVIEW_DEFAULTS)
+    if isinstance(preview, dict):
+        options.update({key: value for key, value in preview.items() if key in options})
+    
+    decimate = max(int(options['decimate']), 1)
+    ordered_indices = get_daheng_ordered_indices()
+    if frame_range:
+        ordered_indices = ordered_indices[frame_range[0]:frame_range[1]]
+    ordered_indices = ordered_indices[::decimate]
+    if len(ordered_indices) < 2:
+        print("Not enough frames for a preview.")
+        return None, 0
+    
+    out_path = os.path.splitext(get_daheng_output_path())[0] + '_preview.mp4'
+    print(f"🎞️ Encoding preview: {len(ordered_indices)} frames, {options['width']}px wide...")
+    
+    # The preview must not replace the stats of the full-quality encode
+    encode_stats = camera_state['last_encode_stats']
+    out_path = encode_bayer_frames_to_mp4(
+        camera_state['daheng_frame_buffer'], ordered_indices, fps / decimate, out_path, workers,
+        {'preset': options['preset'], 'crf': options['crf'], 'scale_width': options['width'],
+         'frame_timing': options['frame_timing']},
+        frame_times=get_daheng_frame_times(ordered_indices)[0]
+    )
+    camera_state['last_encode_stats'] = encode_stats
+    return out_path, len(ordered_indices)
+
+
+# Raw archive (.hwraw): fixed 16-byte preamble (magic + header length),
+# JSON header, then page-aligned contiguous sections:
+#   frames (N, H, W) uint8 Bayer | host ts float64[N] | frame ids int64[N] | device ts int64[N]
+# Section offsets are in the header, so any tool can np.memmap the frames.
+RAW_ARCHIVE_MAGIC = b'HWRAW001'
+RAW_ARCHIVE_ALIGN = 4096
+RAW_ARCHIVE_WRITE_CHUNK = 64 * 1024 * 1024  # Large sequential writes
+
+
+def get_raw_archive_layout(frame_count, height, width):
+    """Section offsets of a raw archive with the given frame geometry"""
+    def align(offset):
+        return (offset + RAW_ARCHIVE_ALIGN - 1) // RAW_ARCHIVE_ALIGN * RAW_ARCHIVE_ALIGN
+    
+    frames_offset = RAW_ARCHIVE_ALIGN
+    ts_offset = align(frames_offset + frame_count * height * width)
+    id_offset = align(ts_offset + frame_count * 8)
+    dev_ts_offset = align(id_offset + frame_count * 8)
+    return {
+        'frames_offset': frames_offset,
+        'ts_offset': ts_offset,
+        'id_offset': id_offset,
+        'dev_ts_offset': dev_ts_offset,
+        'file_size': dev_ts_offset + frame_count * 8
+    }
+
+
+def write_array_sequential(f, array, offset):
+    """Write an array at offset in chunks of RAW_ARCHIVE_WRITE_CHUNK bytes, without copies"""
+    f.seek(offset)
+    data = memoryview(np.ascontiguousarray(array)).cast('B')
+    for start in range(0, len(data), RAW_ARCHIVE_WRITE_CHUNK):
+        f.write(data[start:start + RAW_ARCHIVE_WRITE_CHUNK])
+
+
+def save_daheng_buffer_to_raw(fps=None, capture_report=None):
+    """
+    Save the Daheng ring buffer to a raw archive instead of encoding
+    
+    Frames are written oldest -> newest as at most two contiguous slices of
+    the ring buffer (before/after the wrap point), so the file is written
+    with a few large sequential writes and no demosaic.
+    
+    Args:
+        fps: Capture rate stored in the header (used when encoding later)
+        capture_report: Stored in the header so the archive is self-describing
+    
+    Returns:
+        Path to the .hwraw file, or None on failure
+    """
+    frame_buffer = camera_state['daheng_frame_buffer']
+    frame_count = camera_state['daheng_frame_count']
+    
+    if frame_buffer is None or frame_count == 0:
+        print("No frames to save.")
+        return None
+    
+    buffer_size, height, width = frame_buffer.shape
+    total_frames = min(frame_count, buffer_size)
+    head = camera_state['daheng_head'] if frame_count > buffer_size else 0
+    
+    # Chronological order as contiguous slices (no gather copy of the frames)
+    if head:
+        slices = [slice(head, buffer_size), slice(0, head)]
+    else:
+        slices = [slice(0, total_frames)]
+    ordered_indices = get_daheng_ordered_indices()
+    
+    layout = get_raw_archive_layout(total_frames, height, width)
+    header = {
+        'version': 1,
+        'frame_count': int(total_frames),
+        'height': int(height),
+        'width': int(width),
+        'dtype': 'uint8',
+        'bayer_pattern': 'RGGB',  # OpenCV COLOR_BAYER_BG2BGR, ffmpeg bayer_rggb8
+        'fps': fps,
+        'tick_hz': camera_state['daheng_tick_hz'],
+        'camera_model': 'daheng_imx273',
+        'created': datetime.now().isoformat(),
+        'capture_report': capture_report,
+        **layout
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    if 16 + len(header_bytes) > layout['frames_offset']:
+        header['capture_report'] = None  # Keep the header inside its page
+        header_bytes = json.dumps(header).encode('utf-8')
+    
+    raw_path = os.path.splitext(get_daheng_output_path())[0] + '.hwraw'
+    save_start = time.time()
+    
+    try:
+        with open(raw_path, 'wb', buffering=0) as f:
+            f.write(RAW_ARCHIVE_MAGIC + len(header_bytes).to_bytes(8, 'little') + header_bytes)
+            
+            offset = layout['frames_offset']
+            for part in slices:
+                write_array_sequential(f, frame_buffer[part], offset)
+                offset += (part.stop - part.start) * height * width
+            
+            write_array_sequential(f, camera_state['daheng_ts_buffer'][ordered_indices], layout['ts_offset'])
+            write_array_sequential(f, camera_state['daheng_id_buffer'][ordered_indices], layout['id_offset'])
+            write_array_sequential(f, camera_state['daheng_dev_ts_buffer'][ordered_indices], layout['dev_ts_offset'])
+            f.truncate(layout['file_size'])
+    except Exception as e:
+        print(f"❌ Failed to write raw archive: {e}")
+        return None
+    
+    save_seconds = time.time() - save_start
+    size_mb = layout['file_size'] / (1024 * 1024)
+    camera_state['last_encode_stats'] = {
+        'frames': int(total_frames),
+        'encoder': 'raw',
+        'seconds': round(save_seconds, 3),
+        'mb_per_second': round(size_mb / save_seconds, 1) if save_seconds > 0 else None
+    }
+    print(f"💾 Raw archive saved: {raw_path} ({size_mb:.1f} MB in {save_seconds:.2f}s)")
+    return raw_path
+
+
+def read_raw_archive(raw_path):
+    """
+    Open a raw archive without decoding anything
+    
+    Returns:
+        Dict with 'header' and memory-mapped 'frames' (N, H, W),
+        'timestamps', 'frame_ids' and 'device_timestamps'
+    """
+    with open(raw_path, 'rb') as f:
+        preamble = f.read(16)
+        if preamble[:8] != RAW_ARCHIVE_MAGIC:
+            raise ValueError(f"Not a raw archive: {raw_path}")
+        header = json.loads(f.read(int.from_bytes(preamble[8:16], 'little')))
+    
+    count = header['frame_count']
+    return {
+        'header': header,
+        'frames': np.memmap(raw_path, dtype=np.uint8, mode='r', offset=header['frames_offset'],
+                            shape=(count, header['height'], header['width'])),
+        'timestamps': np.memmap(raw_path, dtype=np.float64, mode='r', offset=header['ts_offset'], shape=(count,)),
+        'frame_ids': np.memmap(raw_path, dtype=np.int64, mode='r', offset=header['id_offset'], shape=(count,)),
+        'device_timestamps': np.memmap(raw_path, dtype=np.int64, mode='r', offset=header['dev_ts_offset'],
+                                       shape=(count,))
+    }
+
+
+def encode_raw_archive(raw_path, workers=None, encode=None, control=None):
+    """
+    Encode a raw archive to MP4 next to it (<archive>.mp4)
+    
+    Returns:
+        MP4 path, or None if encoding failed
+    """
+    archive = read_raw_archive(raw_path)
+    header = archive['header']
+    if header['frame_count'] < 2:
+        print("Not enough frames to make a video.")
+        return None
+    
+    fps = round(header['fps'] or 220.0)
+    out_path = os.path.splitext(raw_path)[0] + '.mp4'
+    print(f"🎬 Encoding raw archive {raw_path} ({header['frame_count']} frames @ {fps} fps)...")
+    
+    frame_times, _ = get_frame_times(archive['timestamps'], archive['device_timestamps'], header['tick_hz'])
+    out_path = encode_bayer_frames_to_mp4(archive['frames'], np.arange(header['frame_count']), fps,
+                                          out_path, workers, encode, control, frame_times)
+    if out_path:
+        save_capture_report(out_path, header.get('capture_report'))
+    return out_path
+
+
+# Background encode queue: ELP re-encodes and Daheng raw -> MP4 jobs,
+# persisted to <recording_path>/encode_queue.json so they survive restarts
+ENCODE_PRIORITY_CURRENT = 10  # Jobs from the race that just finished
+ENCODE_PRIORITY_BACKLOG = 0   # Older jobs (and jobs resumed after a restart)
+ENCODE_QUEUE_HISTORY = 50     # Finished jobs kept for status/throughput
+
+
+class EncodeQueue:
+    """
+    Persistent, prioritised encode job queue with a bounded worker pool
+    
+    Jobs run highest priority first, newest first within a priority, so
+    the current race is encoded before older backlog. Every state change
+    is written to disk; jobs that were running when the client stopped are
+    re-queued as backlog on the next start.
+    """
+    
+    def __init__(self, queue_file, workers=1):
+        self.queue_file = queue_file
+        self.max_workers = max(int(workers), 1)
+        self.jobs = []
+        self.controls = {}  # job id -> EncodeControl for running jobs
+        self.threads = []
+        self.condition = threading.Condition()
+        self.load()
+    
+    def load(self):
+        """Load persisted jobs, re-queueing interrupted ones as backlog"""
+        if not os.path.exists(self.queue_file):
+            return
+        try:
+            with open(self.queue_file) as f:
+                self.jobs = json.load(f).get('jobs', [])
+        except Exception as e:
+            print(f"⚠️ Failed to load encode queue: {e}")
+            self.jobs = []
+        for job in self.jobs:
+            if job['status'] == 'running':
+                job['status'] = 'queued'
+                job['priority'] = ENCODE_PRIORITY_BACKLOG
+        print(f"📋 Encode queue loaded: {len(self.pending())} pending job(s)")
+    
+    def save(self):
+        """Persist the queue (atomic replace); call with the condition held"""
+        finished = [job for job in self.jobs if job['status'] in ('done', 'failed', 'cancelled')]
+        for job in finished[:-ENCODE_QUEUE_HISTORY]:
+            self.jobs.remove(job)
+        try:
+            os.makedirs(os.path.dirname(self.queue_file), exist_ok=True)
+            tmp_file = self.queue_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({'jobs': self.jobs}, f, indent=2)
+            os.replace(tmp_file, self.queue_file)
+        except Exception as e:
+            print(f"⚠️ Failed to save encode queue: {e}")
+    
+    def pending(self):
+        return [job for job in self.jobs if job['status'] == 'queued']
+    
+    def find(self, job_id):
+        return next((job for job in self.jobs if job['id'] == job_id), None)
+    
+    def enqueue(self, kind, input_file, output_file=None, priority=ENCODE_PRIORITY_CURRENT, params=None):
+        """
+        Add a job and wake a worker
+        
+        Args:
+            kind: 'daheng_raw' (.hwraw -> MP4) or 'elp_reencode' (MJPEG -> H.264 MP4)
+            input_file: Source file
+            output_file: MP4 path (default: input with .mp4 extension)
+            priority: Higher runs first
+            params: Extra encoder options (e.g. {'encode': {...}})
+        
+        Returns:
+            Copy of the job dict
+        """
+        if kind not in ENCODE_JOB_RUNNERS:
+            raise ValueError(f"Unknown encode job kind: {kind}")
+        
+        with self.condition:
+            job = {
+                'id': f"enc_{int(time.time() * 1000)}_{len(self.jobs)}",
+                'kind': kind,
+                'input_file': input_file,
+                'output_file': output_file or os.path.splitext(input_file)[0] + '.mp4',
+                'priority': priority,
+                'params': params or {},
+                'status': 'queued',
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'input_bytes': os.path.getsize(input_file) if os.path.exists(input_file) else 0,
+                'error': None
+            }
+            self.jobs.append(job)
+            self.save()
+            queued = dict(job)
+            self.condition.notify()
+        
+        self.start()
+        print(f"📋 Encode job queued: {job['id']} ({kind}, priority {priority})")
+        return queued
+    
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns the job or None"""
+        with self.condition:
+            job = self.find(job_id)
+            if not job or job['status'] not in ('queued', 'running'):
+                return None
+            if job['status'] == 'running':
+                self.controls[job_id].cancel()  # Worker records the result
+            else:
+                job['status'] = 'cancelled'
+                job['finished'] = time.time()
+            self.save()
+            return dict(job)
+    
+    def set_workers(self, workers):
+        """Change the worker pool size (extra workers exit when idle)"""
+        with self.condition:
+            self.max_workers = max(int(workers), 1)
+            self.condition.notify_all()
+        self.start()
+    
+    def start(self):
+        """Start workers up to the pool size"""
+        with self.condition:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            while len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker, name=f'encode-worker-{len(self.threads)}',
+                                          daemon=True)
+                self.threads.append(thread)
+                thread.start()
+    
+    def _next_job(self):
+        pending = self.pending()
+        if not pending:
+            return None
+        return max(pending, key=lambda job: (job['priority'], job['created']))
+    
+    def _worker(self):
+        pin_to_worker_cpus()  # Keep encoding off the capture core
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None:
+                    self.condition.wait()
+                    if self.threads.index(threading.current_thread()) >= self.max_workers:
+                        return
+                    job = self._next_job()
+                
+                if self.threads.index(threading.current_thread()) >= self.max_workers:
+                    self.condition.notify()
+                    return
+                
+                control = EncodeControl()
+                self.controls[job['id']] = control
+                job['status'] = 'running'
+                job['started'] = time.time()
+                self.save()
+            
+            print(f"🎬 Encode job {job['id']} started ({job['kind']}: {job['input_file']})")
+            try:
+                ok, error = ENCODE_JOB_RUNNERS[job['kind']](job, control)
+            except Exception as e:
+                ok, error = False, str(e)
+            
+            with self.condition:
+                del self.controls[job['id']]
+                job['finished'] = time.time()
+                if control.cancelled:
+                    job['status'] = 'cancelled'
+                elif ok:
+                    job['status'] = 'done'
+                    camera_state['last_recording'] = job['output_file']
+                    auto_enqueue_upload(job['output_file'], ENCODE_JOB_CAMERA_MODELS.get(job['kind']))
+                else:
+                    job['status'] = 'failed'
+                    job['error'] = error
+                self.save()
+            print(f"📋 Encode job {job['id']} {job['status']} in {job['finished'] - job['started']:.1f}s")
+    
+    def status(self):
+        """Queue depth, running jobs and throughput of finished jobs"""
+        with self.condition:
+            done = [job for job in self.jobs if job['status'] == 'done']
+            busy_seconds = sum(job['finished'] - job['started'] for job in done)
+            input_mb = sum(job['input_bytes'] for job in done) / (1024 * 1024)
+            hour_ago = time.time() - 3600
+            
+            counts = {}
+            for job in self.jobs:
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            
+            return {
+                'depth': len(self.pending()),
+                'workers': self.max_workers,
+                'running': [dict(job) for job in self.jobs if job['status'] == 'running'],
+                'queued': [dict(job) for job in sorted(self.pending(), key=lambda job: (job['priority'], job['created']),
+                                                       reverse=True)],
+                'counts': counts,
+                'throughput': {
+                    'jobs_done': len(done),
+                    'jobs_last_hour': sum(1 for job in done if job['finished'] >= hour_ago),
+                    'busy_seconds': round(busy_seconds, 1),
+                    'mb_per_second': round(input_mb / busy_seconds, 1) if busy_seconds > 0 else None,
+                    'avg_job_seconds': round(busy_seconds / len(done), 1) if done else None
+                }
+            }
+
+
+def run_daheng_raw_job(job, control):
+    """Encode a Daheng raw archive; returns (ok, error)"""
+    params = job['params']
+    out_path = encode_raw_archive(job['input_file'], workers=params.get('encode_workers'),
+                                  encode=params.get('encode'), control=control)
+    if out_path and out_path != job['output_file']:
+        os.replace(out_path, job['output_file'])
+    return bool(out_path), None if out_path else 'Failed to encode raw archive'
+
+
+def run_elp_reencode_job(job, control):
+    """Re-encode an ELP MJPEG capture; returns (ok, error)"""
+    returncode, stderr = transcode_elp_raw(job['input_file'], job['output_file'], control,
+                                           profile=job['params'].get('output_profile'))
+    if returncode == 0:
+        return True, None
+    return False, f"Encoding failed: {stderr.decode(errors='replace')[-2000:]}"
+
+
+ENCODE_JOB_RUNNERS = {
+    'daheng_raw': run_daheng_raw_job,
+    'elp_reencode': run_elp_reencode_job
+}
+ENCODE_JOB_CAMERA_MODELS = {
+    'daheng_raw': 'daheng_imx273',
+    'elp_reencode': 'elp_imx577'
+}
+
+def get_encode_queue():
+    """
+    Shared encode queue (created on first use in the recording directory)
+    
+    Kept in core.services so reloading this module never starts a second
+    queue on the same encode_queue.json.
+    """
+    return services.get_or_create('camera.encode_queue', lambda: EncodeQueue(
+        os.path.join(camera_state['recording_path'], 'encode_queue.json')))
+
+
+def stop_recording_daheng_imx273(camera_index=None, data=None):
+    """
+    Stop Daheng IMX273 recording and encode to MP4
+    
+    Args:
+        camera_index: Camera index (optional, for compatibility)
+        data: Additional data (optional, for compatibility)
+    
+    Process:
+    1. Stop camera streaming (device stays open for the next recording
+       unless data['release_camera'] is set)
+    2. Demosaic Bayer frames from RAM 
+    3. Encode to MP4
+    """
+    data = data or {}
+    cam = camera_state['daheng_cam']
+    
+    if not cam:
         return {
             'success': False,
             'type': 'recording_error',
@@ -1148,6 +5797,8 @@ def stop_recording_daheng_imx273(camera_index=None, data=None):
         }
     
     try:
+        stop_time = time.time()
+        
         # Signal recording to stop
         camera_state['daheng_stop_flag'] = True
         
@@ -1158,38 +5809,118 @@ def stop_recording_daheng_imx273(camera_index=None, data=None):
         except Exception as e:
             print(f"⚠️ gxipy re-init warning: {e}")
         
-        # Stop camera streaming
-        try:
-            cam.stream_off()
-            print("🛑 Daheng camera streaming stopped")
-        except Exception as e:
-            print(f"⚠️ Warning stopping stream: {e}")
-            # Don't fail the function, just log it
-        
-        try:
-            cam.close_device()
-            print("🔒 Daheng camera closed")
-        except Exception as e:
-            print(f"⚠️ Warning closing camera: {e}")
-            # Don't fail the function, just log it
+        # Stop camera streaming, keep the session open for the next race
+        if data.get('release_camera', False):
+            release_daheng_session()
+        else:
+            stop_daheng_stream()
         
         # Save frame count before cleanup
         final_frame_count = camera_state['daheng_frame_count']
         
+        # Timing report from frame IDs and device timestamps
+        capture_report = build_daheng_capture_report()
+        report_file = None
+        if capture_report:
+            print(f"📊 Capture report: {capture_report['frames']} frames, "
+                  f"{capture_report['dropped_frames']} dropped, "
+                  f"{capture_report['measured_fps']} fps ({capture_report['timestamp_source']} timestamps)")
+        
+        background_encode = data.get('background_encode', False)
+        save_raw = data.get('save_raw', False) or background_encode
+        
+        # Motion auto-trim: find the active window before anything is encoded.
+        # Raw archives and live encodes keep every frame, so they are not analysed
+        trim_result = None
+        frame_range = None
+        keeps_every_frame = save_raw or camera_state['daheng_live_encoder'] is not None
+        if data.get('auto_trim') and keeps_every_frame:
+            print("✂️ Auto-trim skipped: raw archives and live encodes keep every frame")
+        elif data.get('auto_trim') and final_frame_count > 1:
+            ordered_indices = get_daheng_ordered_indices()
+            trim_result = find_daheng_motion_window(ordered_indices, get_daheng_frame_times(ordered_indices)[0],
+                                                    data['auto_trim'])
+            frame_range = (trim_result['start'], trim_result['end'])
+            print(f"✂️ Auto-trim: keeping {trim_result['start_s']}-{trim_result['end_s']}s "
+                  f"({trim_result['frames_kept']}/{trim_result['frames_total']} frames, "
+                  f"analysis {trim_result['analysis_ms']} ms)")
+        
+        # Quick preview first so the kiosk can show something within seconds
+        preview_result = None
+        if data.get('preview'):
+            preview_path, preview_frames = save_daheng_preview(
+                capture_report['measured_fps'] if capture_report else 220.0,
+                data['preview'],
+                workers=data.get('encode_workers'),
+                frame_range=frame_range
+            )
+            preview_result = {
+                'file': preview_path,
+                'frames': preview_frames,
+                'ready_ms': round((time.time() - stop_time) * 1000, 1) if preview_path else None,
+                'upload': None,
+                'uploaded_ms': None
+            }
+            print(f"⏱️ Preview ready: {preview_result['ready_ms']} ms after stop")
+            
+            if preview_path and data.get('upload_preview', False):
+                preview_result['upload'] = upload_video_to_server(
+                    preview_path, data.get('server_ip', '192.168.1.2'), data.get('raspi_id'),
+                    'daheng_imx273', variant='preview'
+                )
+                preview_result['uploaded_ms'] = round((time.time() - stop_time) * 1000, 1)
+                print(f"⏱️ Preview uploaded: {preview_result['uploaded_ms']} ms after stop")
+        
         # Encode captured frames to MP4 video (real video file!)
-        print(f"🎬 Processing {final_frame_count} captured frames...")
-        out_path = save_daheng_buffer_to_mp4()
+        live_encoder = camera_state['daheng_live_encoder']
+        camera_state['daheng_live_encoder'] = None
+        if live_encoder:
+            # Most frames are already encoded, only the tail is left
+            print(f"🎬 Finishing live encode ({final_frame_count - live_encoder.frames_written} frames left)...")
+            out_path = live_encoder.finish()
+            camera_state['last_encode_stats'] = live_encoder.stats()
+            # The file holds every frame since the start, not just those left in the ring buffer
+            capture_report = live_encoder.capture_report() or capture_report
+        elif save_raw:
+            # Defer encoding: dump the buffer to a raw archive (encode_raw later)
+            print(f"💾 Saving {final_frame_count} captured frames to raw archive...")
+            out_path = save_daheng_buffer_to_raw(
+                fps=capture_report['measured_fps'] if capture_report else None,
+                capture_report=capture_report
+            )
+        else:
+            print(f"🎬 Processing {final_frame_count} captured frames...")
+            previous_affinity = pin_to_worker_cpus()  # Keep encoding off the capture core
+            try:
+                out_path = save_daheng_buffer_to_mp4(
+                    measured_fps=capture_report['measured_fps'] if capture_report else None,
+                    workers=data.get('encode_workers'),
+                    encode=data.get('encode'),
+                    frame_range=frame_range
+                )
+            finally:
+                restore_cpu_affinity(previous_affinity)
+        stop_to_file_ms = round((time.time() - stop_time) * 1000, 1)
+        print(f"⏱️ Stop-to-file: {stop_to_file_ms} ms")
+        
+        encode_fps = (camera_state['last_encode_stats'] or {}).get('fps')
+        if trim_result and frame_range and encode_fps:
+            trim_result['encode_seconds_saved'] = round(
+                (trim_result['frames_total'] - trim_result['frames_kept']) / encode_fps, 2)
         
         if not out_path:
             print(f"❌ Failed to encode video - no file created")
             # Still return success for the recording part, but note encoding failure
             out_path = "encoding_failed"
+        else:
+            report_file = save_capture_report(out_path, capture_report)
         
         # Clean up camera state
         camera_state['daheng_cam'] = None
         camera_state['daheng_frame_buffer'] = None
         camera_state['daheng_ts_buffer'] = None
         camera_state['daheng_id_buffer'] = None
+        camera_state['daheng_dev_ts_buffer'] = None
         camera_state['daheng_head'] = 0
         camera_state['daheng_frame_count'] = 0
         camera_state['daheng_capture_thread'] = None
@@ -1197,259 +5928,940 @@ def stop_recording_daheng_imx273(camera_index=None, data=None):
         camera_state['recording'] = False
         
         if out_path and out_path != "encoding_failed":
-            # Update last recording path for optional upload
-            camera_state['last_recording'] = out_path
+            raw_file = None
+            encode_job = None
+            if out_path.endswith('.hwraw'):
+                raw_file, out_path = out_path, None
+                if background_encode:
+                    encode_job = get_encode_queue().enqueue(
+                        'daheng_raw', raw_file,
+                        params={'encode': data.get('encode'), 'encode_workers': data.get('encode_workers')}
+                    )
+            else:
+                # Update last recording path for optional upload
+                camera_state['last_recording'] = out_path
             
             return {
                 'success': True,
                 'type': 'recording_stopped',
                 'camera_model': 'daheng_imx273',
                 'encoded_file': out_path,
+                'raw_file': raw_file,
+                'encode_job': encode_job,
+                'upload': auto_enqueue_upload(out_path, 'daheng_imx273'),
                 'frame_count': final_frame_count,
-                'message': 'Recording stopped and MP4 encoded',
+                'capture_report': capture_report,
+                'report_file': report_file,
+                'encode_stats': camera_state['last_encode_stats'],
+                'stop_to_file_ms': stop_to_file_ms,
+                'preview': preview_result,
+                'trim': trim_result,
+                'camera_released': camera_state['daheng_session']['cam'] is None,
+                'message': ('Recording stopped, encode queued' if encode_job else
+                            'Recording stopped and raw archive saved' if raw_file else
+                            'Recording stopped and MP4 encoded'),
+                'timestamp': time.time()
+            }
+        else:
+            return {
+                'success': False,
+                'type': 'recording_error',
+                'error': 'Failed to encode MP4',
+                'capture_report': capture_report,
+                'timestamp': time.time()
+            }
+    
+    except Exception as e:
+        return {
+            'success': False,
+            'type': 'recording_error',
+            'error': str(e),
+            'timestamp': time.time()
+        }
+    
+    finally:
+        # Clean up state
+        camera_state['daheng_cam'] = None
+        camera_state['daheng_capture_thread'] = None
+        camera_state['daheng_frame_buffer'] = None
+        camera_state['daheng_ts_buffer'] = None
+        camera_state['daheng_id_buffer'] = None
+        camera_state['daheng_dev_ts_buffer'] = None
+        camera_state['daheng_head'] = 0
+        camera_state['daheng_frame_count'] = 0
+        camera_state['daheng_stop_flag'] = False
+        # Update last recording path
+        if 'out_path' in locals() and out_path and os.path.exists(out_path):
+            camera_state['last_recording'] = out_path
+
+
+def handle_stop_recording(data):
+    """
+    Stop recording
+    
+    Params (Daheng):
+        release_camera: bool (close the camera instead of keeping it warm, default False)
+        encode_workers: int (demosaic threads for the OpenCV writer)
+        encode: dict (encoder settings, see DAHENG_ENCODE_DEFAULTS)
+        save_raw: bool (save a raw archive instead of encoding, see encode_raw; refused
+                  for a live_encode recording)
+        background_encode: bool (save a raw archive and encode it in the encode queue; refused
+                           for a live_encode recording)
+        preview: bool or dict (encode a quick preview clip first, see DAHENG_PREVIEW_DEFAULTS)
+        upload_preview: bool (upload the preview before the full encode starts)
+        auto_trim: bool or dict (encode only the window with motion, see DAHENG_TRIM_DEFAULTS;
+                   raw archives and live encodes keep every frame and are not trimmed)
+        server_ip, raspi_id: str (preview upload target, as for upload_video)
+    """
+    if not camera_state['recording']:
+        return {
+            'success': False,
+            'type': 'error',
+            'error': 'Not recording',
+            'timestamp': time.time()
+        }
+    
+    # Route to camera-specific stop function
+    model = camera_state['camera_model']
+    
+    if model == 'daheng_imx273' and camera_state['daheng_live_encoder'] and \
+            (data.get('save_raw') or data.get('background_encode')):
+        # The live encode already holds every frame, the ring buffer only the last ones.
+        # Nothing is stopped, so the client can stop again without these options.
+        return {
+            'success': False,
+            'type': 'recording_error',
+            'error': 'save_raw/background_encode cannot be combined with live_encode',
+            'timestamp': time.time()
+        }
+    
+    if model == 'elp_imx577':
+        result = stop_recording_elp_imx577()
+    elif model == 'daheng_imx273':
+        result = stop_recording_daheng_imx273(data=data)
+    else:
+        result = {
+            'success': True,
+            'type': 'recording_stopped',
+            'message': 'Unknown camera model',
+            'timestamp': time.time()
+        }
+    
+    camera_state['recording'] = False
+    
+    return result
+
+
+def upload_video_to_server(video_path, server_ip='192.168.1.2', raspi_id=None, camera_model=None, variant='full',
+                           **kwargs):
+    """
+    uploads.upload_video_to_server with progress on the process supervisor's event stream
+    
+    A successful upload large enough to be a throughput sample feeds the
+    measured link speed into the ELP delivery estimate (link_mb_per_s).
+    Takes the same arguments (segment, chunked, settings, limiter, control).
+    """
+    result = uploads.upload_video_to_server(video_path, server_ip, raspi_id, camera_model, variant,
+                                            events=process_supervisor, **kwargs)
+    upload_seconds = result.get('upload_seconds', 0)
+    if result.get('success') and result['file_size'] >= DELIVERY_MIN_UPLOAD_BYTES and upload_seconds > 0:
+        record_delivery_stat('link_mb_per_s', result['file_size'] / (1024 * 1024) / upload_seconds)
+    return result
+
+
+def create_upload_queue(queue_file):
+    """UploadQueue capped while a capture runs, progress on the process supervisor's event stream"""
+    return UploadQueue(queue_file, upload=upload_video_to_server, events=process_supervisor,
+                       is_recording=lambda: camera_state['recording'])
+
+
+def get_upload_queue():
+    """
+    Shared upload queue (created on first use in the recording directory)
+    
+    Kept in core.services like the encode queue, so a reload never starts
+    a second upload worker on the same upload_queue.json.
+    """
+    return services.get_or_create('camera.upload_queue', lambda: create_upload_queue(
+        os.path.join(camera_state['recording_path'], 'upload_queue.json')))
+
+
+def auto_enqueue_upload(video_path, camera_model=None):
+    """Queue a finished encode for upload when the queue's auto_upload is on"""
+    if not video_path or not os.path.exists(video_path):
+        return None
+    queue = get_upload_queue()
+    if not queue.config['auto_upload']:
+        return None
+    return queue.enqueue(video_path, camera_model=camera_model)
+
+
+def handle_upload_video(data):
+    """
+    Upload recorded video to server
+    
+    Params:
+        video_path: str (path to video file, optional - uses last recording)
+        server_ip: str (default: 192.168.1.2)
+        raspi_id: str (default: raspi_main)
+        chunked: bool (resumable chunked upload, default True)
+        background: bool (add to the upload queue and return at once, default False)
+        priority: int (background, default UPLOAD_PRIORITY_CURRENT)
+        chunk_size, connect_timeout, read_timeout, max_retries, backoff_initial, backoff_max:
+            overrides for UPLOAD_DEFAULTS
+    """
+    try:
+        print(f"📤 Starting video upload...")
+        print(f"🔧 Upload data: {data}")
+        
+        video_path = data.get('video_path', camera_state.get('last_recording'))
+        server_ip = data.get('server_ip', '192.168.1.2')
+        raspi_id = data.get('raspi_id')
+        if not raspi_id:
+            raspi_id = detect_raspi_id()
+        
+        print(f"📁 Video path: {video_path}")
+        print(f"🌐 Server IP: {server_ip}")
+        print(f"🔖 Raspi ID: {raspi_id}")
+        print(f"📦 Camera state last_recording: {camera_state.get('last_recording')}")
+        
+        # Get camera model from last recording info or current camera state
+        camera_model = None
+        if camera_state.get('last_recording') and isinstance(camera_state['last_recording'], dict):
+            camera_model = camera_state['last_recording'].get('camera_model')
+        if not camera_model:
+            camera_model = camera_state.get('camera_model')
+        
+        print(f"📹 Camera model: {camera_model}")
+        
+        if not video_path:
+            print(f"❌ No video path found!")
+            return {
+                'success': False,
+                'type': 'upload_error',
+                'error': 'No video file specified or recorded',
+                'timestamp': time.time()
+            }
+        
+        settings = {key: data[key] for key in UPLOAD_DEFAULTS if data.get(key) is not None}
+        if data.get('background'):
+            item = get_upload_queue().enqueue(video_path, camera_model=camera_model,
+                                              priority=data.get('priority', UPLOAD_PRIORITY_CURRENT),
+                                              server_ip=server_ip, raspi_id=raspi_id, settings=settings)
+            return {
+                'success': True,
+                'type': 'upload_queued',
+                'upload': item,
+                'video_path': video_path,
+                'timestamp': time.time()
+            }
+        
+        print(f"📤 Starting upload: {video_path} to {server_ip}")
+        result = upload_video_to_server(video_path, server_ip, raspi_id, camera_model,
+                                        chunked=data.get('chunked', True), settings=settings)
+        print(f"📤 Upload result: {result}")
+        
+        result['type'] = 'video_upload'
+        result['timestamp'] = time.time()
+        result['video_path'] = video_path
+        
+        print(f"📤 Final upload response: {result}")
+        return result
+        
+    except Exception as e:
+        print(f"❌ Upload handler crashed: {e}")
+        import traceback
+        traceback.print_exc()
+        return {
+            'success': False,
+            'type': 'upload_error',
+            'error': f'Upload handler crashed: {str(e)}',
+            'timestamp': time.time()
+        }
+
+
+def handle_camera_status(data):
+    """Get current camera status"""
+    upload_queue = services.get('camera.upload_queue')
+    status = {
+        'success': True,
+        'type': 'camera_status',
+        'recording': camera_state['recording'],
+        'camera_index': camera_state['camera_index'],
+        'camera_model': camera_state['camera_model'],
+        'last_recording': camera_state.get('last_recording'),
+        'cv2_available': CV2_AVAILABLE,
+        'gx_available': GX_AVAILABLE,
+        'simulation': camera_sim_config['enabled'],
+        'daheng_session_open': camera_state['daheng_session']['cam'] is not None,
+        'daheng_settings': camera_state['daheng_session']['settings'],
+        'encoder_backend': get_auto_encoder_backend(),
+        'processes': process_supervisor.status()['running'],
+        'upload_queue_depth': len(upload_queue.pending()) if upload_queue else 0,
+        'timestamp': time.time()
+    }
+    
+    return status
+
+
+def handle_warm_camera(data):
+    """
+    Open and configure the Daheng camera ahead of a race
+    
+    Params:
+        exposure, gain, gamma, contrast, fps: Daheng settings (optional)
+        stream: bool (start streaming now, default True)
+    
+    Measures start-to-first-frame latency so warm vs cold starts can be compared.
+    """
+    if not GX_AVAILABLE:
+        return {
+            'success': False,
+            'type': 'camera_error',
+            'error': 'Daheng gxipy library not installed',
+            'timestamp': time.time()
+        }
+    
+    if camera_state['recording']:
+        return {
+            'success': False,
+            'type': 'camera_error',
+            'error': 'Cannot warm camera while recording',
+            'timestamp': time.time()
+        }
+    
+    request_time = time.time()
+    
+    try:
+        session_reused = camera_state['daheng_session']['cam'] is not None
+        cam = open_daheng_session()
+        if cam is None:
+            return {
+                'success': False,
+                'type': 'camera_error',
+                'error': 'No Daheng cameras found',
+                'timestamp': time.time()
+            }
+        
+        settings_applied = apply_daheng_settings(cam, get_daheng_settings(data))
+        capture_mode = get_daheng_capture_mode(cam)
+        open_latency = time.time() - request_time
+        
+        first_frame_latency = None
+        if data.get('stream', True):
+            start_daheng_stream(cam)
+            raw_image = cam.data_stream[0].get_image(timeout=1000)
+            if raw_image is not None:
+                first_frame_latency = time.time() - request_time
+            # Don't hold USB bandwidth until the race starts
+            stop_daheng_stream()
+        
+        return {
+            'success': True,
+            'type': 'camera_warm',
+            'camera_model': 'daheng_imx273',
+            'session_reused': session_reused,
+            'settings_applied': settings_applied,
+            'capture_mode': capture_mode,
+            'mode_fps': camera_state['daheng_mode_stats'],  # fps achieved in past recordings per mode
+            'open_latency_ms': round(open_latency * 1000, 1),
+            'first_frame_latency_ms': round(first_frame_latency * 1000, 1) if first_frame_latency is not None else None,
+            'timestamp': time.time()
+        }
+    
+    except Exception as e:
+        release_daheng_session()
+        return {
+            'success': False,
+            'type': 'camera_error',
+            'error': str(e),
+            'timestamp': time.time()
+        }
+
+
+def handle_encode_raw(data):
+    """
+    Encode a raw archive saved with stop_recording save_raw to MP4
+    
+    Params:
+        raw_file: str (path to .hwraw archive)
+        encode: dict (encoder settings, see DAHENG_ENCODE_DEFAULTS)
+        encode_workers: int (demosaic threads for the OpenCV writer)
+        background: bool (add to the encode queue instead of encoding now)
+        priority: int (queue priority, default ENCODE_PRIORITY_BACKLOG)
+    """
+    raw_file = data.get('raw_file')
+    if not raw_file or not os.path.exists(raw_file):
+        return {
+            'success': False,
+            'type': 'error',
+            'error': f'Raw archive not found: {raw_file}',
+            'timestamp': time.time()
+        }
+    
+    try:
+        if data.get('background', False):
+            job = get_encode_queue().enqueue(
+                'daheng_raw', raw_file,
+                priority=data.get('priority', ENCODE_PRIORITY_BACKLOG),
+                params={'encode': data.get('encode'), 'encode_workers': data.get('encode_workers')}
+            )
+            return {
+                'success': True,
+                'type': 'encode_queued',
+                'raw_file': raw_file,
+                'encode_job': job,
+                'timestamp': time.time()
+            }
+        
+        previous_affinity = pin_to_worker_cpus()  # Keep encoding off the capture core
+        try:
+            out_path = encode_raw_archive(raw_file, workers=data.get('encode_workers'), encode=data.get('encode'))
+        finally:
+            restore_cpu_affinity(previous_affinity)
+        
+        if not out_path:
+            return {
+                'success': False,
+                'type': 'encode_error',
+                'error': 'Failed to encode raw archive',
+                'timestamp': time.time()
+            }
+        
+        camera_state['last_recording'] = out_path
+        return {
+            'success': True,
+            'type': 'raw_encoded',
+            'raw_file': raw_file,
+            'encoded_file': out_path,
+            'upload': auto_enqueue_upload(out_path, 'daheng_imx273'),
+            'encode_stats': camera_state['last_encode_stats'],
+            'timestamp': time.time()
+        }
+    
+    except Exception as e:
+        return {
+            'success': False,
+            'type': 'encode_error',
+            'error': str(e),
+            'timestamp': time.time()
+        }
+
+
+def handle_encode_queue(data):
+    """
+    Inspect and manage the background encode queue
+    
+    Params:
+        action: str ('status' (default), 'enqueue', 'cancel', 'set_workers')
+        job_id: str (cancel)
+        kind: str (enqueue: 'daheng_raw' or 'elp_reencode')
+        input_file: str (enqueue)
+        output_file: str (enqueue, optional)
+        priority: int (enqueue, default ENCODE_PRIORITY_BACKLOG)
+        encode: dict (enqueue, Daheng encoder settings)
+        workers: int (set_workers)
+    """
+    action = data.get('action', 'status')
+    queue = get_encode_queue()
+    
+    try:
+        if action == 'enqueue':
+            input_file = data.get('input_file')
+            if not input_file or not os.path.exists(input_file):
+                return {
+                    'success': False,
+                    'type': 'error',
+                    'error': f'Input file not found: {input_file}',
+                    'timestamp': time.time()
+                }
+            job = queue.enqueue(
+                data.get('kind', 'daheng_raw'), input_file,
+                output_file=data.get('output_file'),
+                priority=data.get('priority', ENCODE_PRIORITY_BACKLOG),
+                params={'encode': data.get('encode')}
+            )
+            return {
+                'success': True,
+                'type': 'encode_queued',
+                'encode_job': job,
+                'timestamp': time.time()
+            }
+        
+        if action == 'cancel':
+            job = queue.cancel(data.get('job_id'))
+            if not job:
+                return {
+                    'success': False,
+                    'type': 'error',
+                    'error': f"No queued or running job: {data.get('job_id')}",
+                    'timestamp': time.time()
+                }
+            return {
+                'success': True,
+                'type': 'encode_cancelled',
+                'encode_job': job,
+                'timestamp': time.time()
+            }
+        
+        if action == 'set_workers':
+            queue.set_workers(data.get('workers', 1))
+        elif action != 'status':
+            return {
+                'success': False,
+                'type': 'error',
+                'error': f'Unknown action: {action}',
+                'timestamp': time.time()
+            }
+        
+        return {
+            'success': True,
+            'type': 'encode_queue_status',
+            **queue.status(),
+            'timestamp': time.time()
+        }
+    
+    except Exception as e:
+        return {
+            'success': False,
+            'type': 'error',
+            'error': str(e),
+            'timestamp': time.time()
+        }
+
+
+def handle_upload_queue(data):
+    """
+    Inspect and manage the background upload queue
+    
+    Params:
+        action: str ('status' (default), 'enqueue', 'prioritise', 'pause', 'resume', 'cancel', 'configure')
+        item_id: str (prioritise, cancel; pause/resume: without it the whole queue)
+        file: str (enqueue, default last recording)
+        priority: int (enqueue: default UPLOAD_PRIORITY_BACKLOG; prioritise: default ahead of all)
+        max_attempts: int (enqueue: retry policy of this item)
+        server_ip, raspi_id, variant: str (enqueue)
+        Any UPLOAD_QUEUE_DEFAULTS key (configure), e.g. max_mb_per_s, recording_mb_per_s, auto_upload
+    """
+    action = data.get('action', 'status')
+    queue = get_upload_queue()
+    
+    try:
+        if action == 'enqueue':
+            video_path = data.get('file') or camera_state.get('last_recording')
+            if not isinstance(video_path, str) or not os.path.exists(video_path):
+                raise FileNotFoundError(f'Video file not found: {video_path}')
+            item = queue.enqueue(video_path, camera_model=data.get('camera_model', camera_state.get('camera_model')),
+                                 variant=data.get('variant', 'full'),
+                                 priority=data.get('priority', UPLOAD_PRIORITY_BACKLOG),
+                                 server_ip=data.get('server_ip'), raspi_id=data.get('raspi_id'),
+                                 max_attempts=data.get('max_attempts'))
+            return {
+                'success': True,
+                'type': 'upload_queued',
+                'upload': item,
+                'timestamp': time.time()
+            }
+        
+        if action in ('prioritise', 'cancel') or (action in ('pause', 'resume') and data.get('item_id')):
+            if action == 'prioritise':
+                item = queue.prioritise(data.get('item_id'), data.get('priority'))
+            else:
+                item = getattr(queue, action)(data.get('item_id'))
+            if not item:
+                return {
+                    'success': False,
+                    'type': 'error',
+                    'error': f"No upload to {action}: {data.get('item_id')}",
+                    'timestamp': time.time()
+                }
+            return {
+                'success': True,
+                'type': f'upload_{action}',
+                'upload': item,
                 'timestamp': time.time()
             }
-        else:
+        
+        if action == 'pause':
+            queue.pause()
+        elif action == 'resume':
+            queue.resume()
+        elif action == 'configure':
+            queue.configure(**{key: data[key] for key in UPLOAD_QUEUE_DEFAULTS if key in data})
+        elif action != 'status':
             return {
                 'success': False,
-                'type': 'recording_error',
-                'error': 'Failed to encode MP4',
+                'type': 'error',
+                'error': f'Unknown action: {action}',
                 'timestamp': time.time()
             }
-    
-    except Exception as e:
+        
         return {
-            'success': False,
-            'type': 'recording_error',
-            'error': str(e),
+            'success': True,
+            'type': 'upload_queue_status',
+            **queue.status(),
             'timestamp': time.time()
         }
     
-    finally:
-        # Clean up state
-        camera_state['daheng_cam'] = None
-        camera_state['daheng_capture_thread'] = None
-        camera_state['daheng_frame_buffer'] = None
-        camera_state['daheng_ts_buffer'] = None
-        camera_state['daheng_id_buffer'] = None
-        camera_state['daheng_head'] = 0
-        camera_state['daheng_frame_count'] = 0
-        camera_state['daheng_stop_flag'] = False
-        # Update last recording path
-        if out_path and os.path.exists(out_path):
-            camera_state['last_recording'] = out_path
-
-
-def handle_stop_recording(data):
-    """Stop recording"""
-    if not camera_state['recording']:
+    except Exception as e:
         return {
             'success': False,
             'type': 'error',
-            'error': 'Not recording',
+            'error': str(e),
             'timestamp': time.time()
         }
+
+
+def handle_process_status(data):
+    """
+    Supervised child processes: running ones with live progress, and recent exits
     
-    # Route to camera-specific stop function
-    model = camera_state['camera_model']
+    Params:
+        kill: str (process id to kill, optional)
+    """
+    if data.get('kill'):
+        supervised = process_supervisor.processes.get(data['kill'])
+        if not supervised:
+            return {
+                'success': False,
+                'type': 'error',
+                'error': f"No running process: {data['kill']}",
+                'timestamp': time.time()
+            }
+        supervised.kill()
     
-    if model == 'elp_imx577':
-        result = stop_recording_elp_imx577()
-    elif model == 'daheng_imx273':
-        result = stop_recording_daheng_imx273()
-    else:
-        result = {
-            'success': True,
-            'type': 'recording_stopped',
-            'message': 'Unknown camera model',
-            'timestamp': time.time()
-        }
+    return {
+        'success': True,
+        'type': 'process_status',
+        **process_supervisor.status(),
+        'timestamp': time.time()
+    }
+
+
+def handle_subscribe_progress(data):
+    """
+    Long-poll for process progress events
     
-    camera_state['recording'] = False
+    Returns as soon as there are events newer than since, or after wait
+    seconds. Pass the returned seq as since in the next call to follow a
+    capture or encode live.
     
-    return result
+    Params:
+        since: int (last seq received, default 0 = everything buffered)
+        wait: float (max seconds to wait for a new event, default 10, max 25)
+        id: str (only events of this process, optional)
+    """
+    since = int(data.get('since', 0))
+    wait = min(float(data.get('wait', 10)), 25.0)  # Stay below the client's 30 s socket timeout
+    events, seq = process_supervisor.subscribe(since, wait)
+    if data.get('id'):
+        events = [event for event in events if event['id'] == data['id']]
+    return {
+        'success': True,
+        'type': 'process_progress',
+        'events': events,
+        'seq': seq,
+        'timestamp': time.time()
+    }
 
 
-def upload_video_to_server(video_path, server_ip='192.168.1.2', raspi_id=None, camera_model=None):
+def get_mjpeg_file_param(data):
+    """MJPEG capture named by the 'file' param (default: the last ELP capture)"""
+    mjpeg_file = data.get('file') or camera_state.get('last_mjpeg_file')
+    if not mjpeg_file or not os.path.exists(mjpeg_file):
+        raise FileNotFoundError(f'MJPEG capture not found: {mjpeg_file}')
+    return mjpeg_file
+
+
+def handle_read_frame(data):
     """
-    Upload video file to server via raw HTTP binary transfer
-    
-    Args:
-        video_path: Path to video file
-        server_ip: Server IP address
-        raspi_id: Raspberry Pi identifier
-        camera_model: Camera model name (for server identification)
+    Read a single still from an MJPEG capture through its frame index
     
-    Returns:
-        dict with upload result
+    Params:
+        file: str (MJPEG .mkv, default last ELP capture)
+        frame: int (frame number, negative counts from the end)
+        time: float (seconds from the first frame, used when frame is not given)
+        output: str (write the JPEG here; otherwise it is returned base64-encoded)
     """
-    if not os.path.exists(video_path):
+    try:
+        mjpeg_file = get_mjpeg_file_param(data)
+        index = load_mjpeg_index(mjpeg_file)
+        frame = find_mjpeg_frame(index, data.get('frame'), data.get('time'))
+        jpeg = next(read_mjpeg_frames(mjpeg_file, index, [frame]))
+        
+        response = {
+            'success': True,
+            'type': 'frame',
+            'file': mjpeg_file,
+            'frame': frame,
+            'pts': round(index['pts'][frame] - index['pts'][0], 6),
+            'size': len(jpeg),
+            'timestamp': time.time()
+        }
+        if data.get('output'):
+            with open(data['output'], 'wb') as f:
+                f.write(jpeg)
+            response['output'] = data['output']
+        else:
+            response['jpeg_base64'] = base64.b64encode(jpeg).decode('ascii')
+        return response
+    except Exception as e:
         return {
             'success': False,
-            'error': 'Video file not found',
-            'path': video_path
+            'type': 'error',
+            'error': str(e),
+            'timestamp': time.time()
         }
+
+
+def handle_read_frame_range(data):
+    """
+    Copy a time (or frame) window of an MJPEG capture without decoding it
     
+    Params:
+        file: str (MJPEG .mkv, default last ELP capture)
+        start / end: float (seconds from the first frame)
+        start_frame / end_frame: int (inclusive, instead of start / end)
+        format: 'mkv' (stream-copied MJPEG clip, default) or 'jpeg' (one file per frame)
+        output: str (clip path or JPEG directory, default next to the capture)
+    """
     try:
-        # Auto-detect raspi_id if not provided
-        if not raspi_id:
-            import socket
-            hostname = socket.gethostname().lower()
-            if 'sensor' in hostname:
-                raspi_id = 'raspi_sensor'
-            elif 'main' in hostname:
-                raspi_id = 'raspi_main'
-            else:
-                raspi_id = 'raspi_unknown'
-            print(f"⚠️ No raspi_id provided, using hostname-based: {raspi_id}")
-        
-        url = f'http://{server_ip}:3001/api/upload-video'
-        headers = {
-            'X-Raspi-ID': raspi_id,
-            'X-Camera-Model': camera_model or 'unknown',
-            'Content-Type': 'video/mp4'
-        }
+        mjpeg_file = get_mjpeg_file_param(data)
+        index = load_mjpeg_index(mjpeg_file)
+        if data.get('start_frame') is not None or data.get('end_frame') is not None:
+            first = find_mjpeg_frame(index, data.get('start_frame', 0))
+            last = find_mjpeg_frame(index, data.get('end_frame', -1))
+        else:
+            first = find_mjpeg_frame(index, time_s=data.get('start', 0))
+            last = find_mjpeg_frame(index, time_s=data['end']) if data.get('end') is not None else index['frames'] - 1
+        if last < first:
+            raise ValueError(f'Empty range: frames {first}-{last}')
+        if last - first + 1 > MJPEG_MAX_RANGE_FRAMES:
+            raise ValueError(f'Range of {last - first + 1} frames exceeds {MJPEG_MAX_RANGE_FRAMES}')
         
-        file_size = os.path.getsize(video_path)
-        print(f"📦 Upload details:")
-        print(f"   📁 File: {video_path}")
-        print(f"   📊 Size: {file_size / (1024*1024):.2f} MB")
-        print(f"   🌐 URL: {url}")
-        print(f"   📋 Headers: {headers}")
-        
-        with open(video_path, 'rb') as video_file:
-            response = requests.post(
-                url,
-                data=video_file,
-                headers=headers,
-                # No timeout - wait indefinitely for upload
-                stream=True   # Enable streaming for large files
-            )
+        frames = range(first, last + 1)
+        pts = index['pts']
+        base = f"{os.path.splitext(mjpeg_file)[0]}_f{first}-{last}"
+        output_format = data.get('format', 'mkv')
         
-        if response.status_code == 200:
-            result = response.json()
-            return {
-                'success': True,
-                'message': result.get('message', 'Upload successful'),
-                'queue_position': result.get('queuePosition', 0),
-                'file_size': result.get('fileSize', file_size)
-            }
-        elif response.status_code == 413:
-            return {
-                'success': False,
-                'error': 'File too large (max 500MB)',
-                'file_size': file_size
-            }
+        if output_format == 'jpeg':
+            output = data.get('output') or base
+            os.makedirs(output, exist_ok=True)
+            for frame, jpeg in zip(frames, read_mjpeg_frames(mjpeg_file, index, frames)):
+                with open(os.path.join(output, f'frame_{frame:06d}.jpg'), 'wb') as f:
+                    f.write(jpeg)
+        elif output_format == 'mkv':
+            output = data.get('output') or base + '.mkv'
+            span = pts[last] - pts[first]
+            fps = round((last - first) / span, 3) if span > 0 else 30
+            mux_mjpeg_frames(read_mjpeg_frames(mjpeg_file, index, frames), fps, output, len(frames))
         else:
-            return {
-                'success': False,
-                'error': f'Upload failed with status {response.status_code}',
-                'response': response.text
-            }
+            raise ValueError(f'Unknown format: {output_format}')
+        
+        return {
+            'success': True,
+            'type': 'frame_range',
+            'file': mjpeg_file,
+            'output': output,
+            'format': output_format,
+            'start_frame': first,
+            'end_frame': last,
+            'frames': len(frames),
+            'start': round(pts[first] - pts[0], 6),
+            'end': round(pts[last] - pts[0], 6),
+            'timestamp': time.time()
+        }
+    except Exception as e:
+        return {
+            'success': False,
+            'type': 'error',
+            'error': str(e),
+            'timestamp': time.time()
+        }
+
+
+def handle_delivery_estimate(data):
+    """
+    Estimate whether transcode-then-upload or offloading the MJPEG master delivers faster
     
+    Params:
+        file: str (MJPEG .mkv, default last ELP capture)
+        frames, size: int (instead of file: frame count and master size in bytes)
+        remux: bool (include remuxing the master to MP4 before offloading)
+        Any ELP_DELIVERY_DEFAULTS key overrides the measured / default value
+    """
+    try:
+        if data.get('frames') and data.get('size'):
+            frames, raw_size = int(data['frames']), int(data['size'])
+        else:
+            mjpeg_file = get_mjpeg_file_param(data)
+            frames, raw_size = load_mjpeg_index(mjpeg_file)['frames'], os.path.getsize(mjpeg_file)
+        overrides = {key: data[key] for key in ELP_DELIVERY_DEFAULTS if data.get(key) is not None}
+        return {
+            'success': True,
+            'type': 'delivery_estimate',
+            **estimate_elp_delivery(raw_size, frames, overrides, data.get('remux', False)),
+            'timestamp': time.time()
+        }
+    except Exception as e:
+        return {
+            'success': False,
+            'type': 'error',
+            'error': str(e),
+            'timestamp': time.time()
+        }
+
+
+def handle_measure_playback(data):
+    """
+    Measure first-frame time and seek latency of a recording
     
-    except requests.exceptions.ConnectionError:
+    Params:
+        file: str (MP4 path, default last recording)
+        seeks: int (random seeks to time, default 10)
+    """
+    mp4_path = data.get('file') or camera_state.get('last_recording')
+    if not mp4_path or not os.path.exists(mp4_path):
         return {
             'success': False,
-            'error': f'Cannot connect to server at {server_ip}:3001'
+            'type': 'error',
+            'error': f'Video file not found: {mp4_path}',
+            'timestamp': time.time()
         }
     
+    try:
+        return {
+            'success': True,
+            'type': 'playback_measurement',
+            'file': mp4_path,
+            **measure_playback(mp4_path, int(data.get('seeks', 10))),
+            'timestamp': time.time()
+        }
     except Exception as e:
         return {
             'success': False,
-            'error': f'Upload failed: {str(e)}'
+            'type': 'error',
+            'error': str(e),
+            'timestamp': time.time()
         }
 
 
-def handle_upload_video(data):
+def handle_encoder_benchmark(data):
     """
-    Upload recorded video to server
+    Benchmark the encoder backends and cache the fastest one for 'auto'
     
     Params:
-        video_path: str (path to video file, optional - uses last recording)
-        server_ip: str (default: 192.168.1.2)
-        raspi_id: str (default: raspi_main)
+        frames: int (synthetic frames per backend, default 60)
+        width, height: int (default 1440x1080, the Daheng resolution)
+        fps: float (playback rate used for the size target, default 220)
+        min_psnr: float (quality target in dB, default 30)
+        max_mb_per_s: float (size target, MB per second of video, optional)
+        backends: list (subset of ENCODER_BACKENDS, default all)
+        probe_only: bool (only report which backends work, default False)
     """
+    if camera_state['recording']:
+        return {
+            'success': False,
+            'type': 'error',
+            'error': 'Cannot benchmark encoders while recording',
+            'timestamp': time.time()
+        }
+    
     try:
-        print(f"📤 Starting video upload...")
-        print(f"🔧 Upload data: {data}")
-        
-        video_path = data.get('video_path', camera_state.get('last_recording'))
-        server_ip = data.get('server_ip', '192.168.1.2')
-        raspi_id = data.get('raspi_id')
-        if not raspi_id:
-            # Try to detect raspi_id from hostname
-            import socket
-            hostname = socket.gethostname().lower()
-            if 'sensor' in hostname:
-                raspi_id = 'raspi_sensor'
-            elif 'main' in hostname:
-                raspi_id = 'raspi_main'
-            else:
-                raspi_id = 'raspi_unknown'
-            print(f"⚠️ No raspi_id provided, using hostname-based: {raspi_id}")
-        
-        print(f"📁 Video path: {video_path}")
-        print(f"🌐 Server IP: {server_ip}")
-        print(f"🔖 Raspi ID: {raspi_id}")
-        print(f"📦 Camera state last_recording: {camera_state.get('last_recording')}")
-        
-        # Get camera model from last recording info or current camera state
-        camera_model = None
-        if camera_state.get('last_recording') and isinstance(camera_state['last_recording'], dict):
-            camera_model = camera_state['last_recording'].get('camera_model')
-        if not camera_model:
-            camera_model = camera_state.get('camera_model')
-        
-        print(f"📹 Camera model: {camera_model}")
-        
-        if not video_path:
-            print(f"❌ No video path found!")
+        if data.get('probe_only'):
             return {
-                'success': False,
-                'type': 'upload_error',
-                'error': 'No video file specified or recorded',
+                'success': True,
+                'type': 'encoder_probe',
+                'backends': probe_encoder_backends(force=True),
+                'encoder_backend': get_auto_encoder_backend(),
                 'timestamp': time.time()
             }
         
-        print(f"📤 Starting upload: {video_path} to {server_ip}")
-        result = upload_video_to_server(video_path, server_ip, raspi_id, camera_model)
-        print(f"📤 Upload result: {result}")
-        
-        result['type'] = 'video_upload'
-        result['timestamp'] = time.time()
-        result['video_path'] = video_path
-        
-        print(f"📤 Final upload response: {result}")
-        return result
-        
+        benchmark = run_encoder_benchmark(
+            frames=int(data.get('frames', 60)),
+            width=int(data.get('width', 1440)),
+            height=int(data.get('height', 1080)),
+            fps=float(data.get('fps', 220)),
+            min_psnr=float(data.get('min_psnr', 30.0)),
+            max_mb_per_s=data.get('max_mb_per_s'),
+            backends=data.get('backends')
+        )
+        return {
+            'success': benchmark['chosen'] is not None,
+            'type': 'encoder_benchmark',
+            **benchmark,
+            'encoder_backend': get_auto_encoder_backend(),
+            'error': None if benchmark['chosen'] else 'No encoder backend met the targets',
+            'timestamp': time.time()
+        }
+    
     except Exception as e:
-        print(f"❌ Upload handler crashed: {e}")
-        import traceback
-        traceback.print_exc()
         return {
             'success': False,
-            'type': 'upload_error',
-            'error': f'Upload handler crashed: {str(e)}',
+            'type': 'error',
+            'error': str(e),
             'timestamp': time.time()
         }
 
 
-def handle_camera_status(data):
-    """Get current camera status"""
-    status = {
+def handle_release_camera(data):
+    """Close the cached Daheng camera session"""
+    if camera_state['recording'] and camera_state['camera_model'] == 'daheng_imx273':
+        return {
+            'success': False,
+            'type': 'camera_error',
+            'error': 'Cannot release camera while recording',
+            'timestamp': time.time()
+        }
+    
+    released = release_daheng_session()
+    
+    return {
         'success': True,
-        'type': 'camera_status',
-        'recording': camera_state['recording'],
-        'camera_index': camera_state['camera_index'],
-        'camera_model': camera_state['camera_model'],
-        'last_recording': camera_state.get('last_recording'),
-        'cv2_available': CV2_AVAILABLE,
-        'gx_available': GX_AVAILABLE,
+        'type': 'camera_released',
+        'released': released,
+        'message': 'Daheng camera closed' if released else 'No open Daheng camera session',
         'timestamp': time.time()
     }
+
+
+def handle_camera_simulation(data):
+    """
+    Enable or disable the simulated camera backends
     
-    return status
+    Params:
+        enabled: bool (default True)
+        daheng: bool (simulate the Daheng camera, default True)
+        elp: bool (simulate the ELP camera, default True)
+        fps: float (simulated Daheng frame rate)
+        drop_rate: float (probability of dropping each frame, 0.0 - 1.0)
+    """
+    try:
+        if data.get('enabled', True):
+            enable_camera_simulation(
+                daheng=data.get('daheng', True),
+                elp=data.get('elp', True),
+                fps=data.get('fps'),
+                drop_rate=data.get('drop_rate')
+            )
+        else:
+            disable_camera_simulation()
+        
+        return {
+            'success': True,
+            'type': 'camera_simulation',
+            'simulation': dict(camera_sim_config),
+            'gx_available': GX_AVAILABLE,
+            'timestamp': time.time()
+        }
+    
+    except Exception as e:
+        return {
+            'success': False,
+            'type': 'camera_error',
+            'error': str(e),
+            'timestamp': time.time()
+        }
 
 
 def handle_get_camera_controls(data):
@@ -1497,7 +6909,7 @@ def reset_camera_controls(camera_index):
     
     for control, value, desc in reset_commands:
         try:
-            result = subprocess.run(
+            result = process_supervisor.run(
                 ['v4l2-ctl', '-d', device, f'--set-ctrl={control}={value}'],
                 check=False, capture_output=True, text=True
             )
@@ -1544,7 +6956,7 @@ def diagnose_unknown_camera(camera_index):
     
     # Command 1: List controls
     try:
-        result = subprocess.run(
+        result = process_supervisor.run(
             ['v4l2-ctl', '-d', device, '--list-ctrls'],
             capture_output=True, text=True, check=True, timeout=10
         )
@@ -1557,7 +6969,7 @@ def diagnose_unknown_camera(camera_index):
     
     # Command 2: Get all camera info
     try:
-        result = subprocess.run(
+        result = process_supervisor.run(
             ['v4l2-ctl', '-d', device, '--all'],
             capture_output=True, text=True, check=True, timeout=10
         )
@@ -1570,7 +6982,7 @@ def diagnose_unknown_camera(camera_index):
     
     # Command 3: USB device info
     try:
-        result = subprocess.run(
+        result = process_supervisor.run(
             ['lsusb'], capture_output=True, text=True, check=True, timeout=10
         )
         diagnostics['results']['usb_devices'] = result.stdout
@@ -1582,7 +6994,7 @@ def diagnose_unknown_camera(camera_index):
     
     # Command 4: Device attributes
     try:
-        result = subprocess.run(
+        result = process_supervisor.run(
             ['udevadm', 'info', '-a', '-n', device],
             capture_output=True, text=True, check=True, timeout=10
         )
@@ -1633,9 +7045,49 @@ COMMAND_HANDLERS = {
     'list_cameras': handle_list_cameras,
     'start_recording': handle_start_recording,
     'stop_recording': handle_stop_recording,
+    'encode_raw': handle_encode_raw,
+    'encode_queue': handle_encode_queue,
+    'upload_queue': handle_upload_queue,
+    'encoder_benchmark': handle_encoder_benchmark,
+    'measure_playback': handle_measure_playback,
+    'delivery_estimate': handle_delivery_estimate,
+    'read_frame': handle_read_frame,
+    'read_frame_range': handle_read_frame_range,
+    'process_status': handle_process_status,
+    'subscribe_progress': handle_subscribe_progress,
     'camera_status': handle_camera_status,
     'upload_video': handle_upload_video,
     'get_camera_controls': handle_get_camera_controls,
     'reset_camera_controls': handle_reset_camera_controls,
-    'diagnose_unknown_camera': handle_diagnose_unknown_camera
+    'diagnose_unknown_camera': handle_diagnose_unknown_camera,
+    'warm_camera': handle_warm_camera,
+    'release_camera': handle_release_camera,
+    'camera_simulation': handle_camera_simulation
 }
+
+
+# Start in simulation mode when requested (e.g. HW_CAMERA_SIM=1 or HW_CAMERA_SIM=daheng)
+if os.environ.get('HW_CAMERA_SIM'):
+    _sim_backends = os.environ['HW_CAMERA_SIM'].lower()
+    _sim_all = _sim_backends in ('1', 'true', 'yes', 'all')
+    enable_camera_simulation(
+        daheng=_sim_all or 'daheng' in _sim_backends,
+        elp=_sim_all or 'elp' in _sim_backends
+    )
+
+
+def init_handler():
+    """
+    Resume encode jobs and uploads left over from a previous run
+    
+    Called by SafeHandlerLoader after every (re)load, never at import: the
+    queues are per-process services, so a reload finds the running ones.
+    """
+    if os.path.exists(os.path.join(camera_state['recording_path'], 'encode_queue.json')):
+        queue = get_encode_queue()
+        if queue.pending():
+            queue.start()
+    if os.path.exists(os.path.join(camera_state['recording_path'], 'upload_queue.json')):
+        queue = get_upload_queue()
+        if queue.pending():
+            queue.start()
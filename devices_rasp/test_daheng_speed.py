@@ -3,6 +3,8 @@
 Daheng High-Speed Performance Test
 
 Tests the server functions at maximum speed to verify 200+ fps performance.
+
+Set HW_CAMERA_SIM=1 to run against the simulated Daheng camera (no hardware).
 """
 
 import sys
@@ -13,6 +15,7 @@ import json
 # Add handler path
 sys.path.insert(0, '/home/user/Desktop/HOTWHEELS-main/devices_rasp/raspi_client/handlers')
 sys.path.insert(0, '/home/user/Desktop/listener/devices_rasp/raspi_client/handlers')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'raspi_client', 'handlers'))
 
 print("🚀 DAHENG HIGH-SPEED PERFORMANCE TEST")
 print("====================================")
@@ -6,6 +6,8 @@
 
 const fs = require('fs');
 const path = require('path');
+const crypto = require('crypto');
+const { spawn } = require('child_process');
 const { createModuleLogger } = require('../config/logger.js');
 const logger = createModuleLogger('VIDEO');
 
@@ -13,6 +15,134 @@ const logger = createModuleLogger('VIDEO');
 let videoQueue = [];
 let queueProcessor = null;
 let isProcessing = false; // prevent race conditions in queue processing
+let lastFullUpload = {}; // raspiId -> arrival time of the last full-quality video (clients without recording ids)
+let fullRecordings = {}; // raspiId -> ids of the latest recordings a full-quality video was received for
+let masterTranscodes = Promise.resolve(); // MJPEG masters are transcoded one at a time
+
+const FULL_RECORDINGS_KEPT = 50; // Recording ids remembered per Pi
+
+/**
+ * Remember that a full-quality video (full upload or transcoded master) was received
+ * @param {Object} video - Upload entry with raspiId, recordingId and timestamp
+ */
+function markFullVideo(video) {
+    lastFullUpload[video.raspiId] = Math.max(lastFullUpload[video.raspiId] || 0, video.timestamp);
+    if (!video.recordingId) return;
+    const recordings = fullRecordings[video.raspiId] || (fullRecordings[video.raspiId] = []);
+    if (!recordings.includes(video.recordingId)) {
+        recordings.push(video.recordingId);
+        recordings.splice(0, Math.max(recordings.length - FULL_RECORDINGS_KEPT, 0));
+    }
+}
+
+/**
+ * Drop preview uploads that a full-quality video of the same recording has superseded.
+ * Previews are matched by the Pi's recording id, so a preview that arrives after its
+ * full video is dropped whatever the arrival order; clients that send no recording id
+ * fall back to comparing arrival times.
+ * @param {Array} batch - Queued uploads
+ * @returns {Array} Uploads to save
+ */
+function dropSupersededPreviews(batch) {
+    batch.forEach(video => {
+        if (video.variant !== 'preview') {
+            markFullVideo(video);
+        }
+    });
+
+    return batch.filter(video => {
+        if (video.variant !== 'preview') return true;
+        const superseded = video.recordingId
+            ? (fullRecordings[video.raspiId] || []).includes(video.recordingId)
+            : video.timestamp < (lastFullUpload[video.raspiId] || 0);
+        if (superseded) {
+            logger.info(`⏭️ Skipping preview from ${video.raspiId}: full video already received`);
+            fs.unlink(video.tempPath, () => {});
+            return false;
+        }
+        return true;
+    });
+}
+
+/**
+ * Save one segment of a segmented recording and rewrite its concat manifest,
+ * so the race can be played (or assembled) while later segments arrive
+ * @param {Object} video - Upload entry with recordingId and segmentIndex
+ */
+function saveSegment(video) {
+    const segmentDir = path.join(__dirname, '../../../public/video/segments', video.raspiId, video.recordingId);
+    fs.mkdirSync(segmentDir, { recursive: true });
+
+    const fileName = `segment_${String(video.segmentIndex).padStart(3, '0')}.mp4`;
+    fs.rename(video.tempPath, path.join(segmentDir, fileName), (err) => {
+        if (err) {
+            logger.error(`❌ Failed to save segment ${fileName} from ${video.raspiId}: ${err.message}`);
+            return;
+        }
+
+        const segments = fs.readdirSync(segmentDir).filter(name => /^segment_\d+\.mp4$/.test(name)).sort();
+        const manifest = ['ffconcat version 1.0', ...segments.map(name => `file ${name}`)].join('\n') + '\n';
+        fs.writeFileSync(path.join(segmentDir, 'playlist.ffconcat'), manifest);
+        logger.info(`🧩 Segment saved: /public/video/segments/${video.raspiId}/${video.recordingId}/${fileName} (${segments.length} so far)`);
+    });
+}
+
+/**
+ * Store an MJPEG master offloaded by a Pi (it skipped on-device encoding) and
+ * transcode it to H.264 as [pi_id].mp4, so it replaces the video like a full upload
+ * @param {Object} video - Upload entry with tempPath, raspiId, recordingId, extension and timestamp
+ */
+function saveMaster(video) {
+    const masterDir = path.join(__dirname, '../../../public/video/masters');
+    fs.mkdirSync(masterDir, { recursive: true });
+    const masterPath = path.join(masterDir, `${video.raspiId}${video.extension}`);
+
+    fs.rename(video.tempPath, masterPath, (err) => {
+        if (err) {
+            logger.error(`❌ Failed to save master from ${video.raspiId}: ${err.message}`);
+            return;
+        }
+        logger.info(`🎞️ MJPEG master saved: /public/video/masters/${video.raspiId}${video.extension}`);
+
+        masterTranscodes = masterTranscodes.then(() => new Promise((resolve) => {
+            const finalPath = path.join(__dirname, '../../../public/video', `${video.raspiId}.mp4`);
+            const partialPath = finalPath.replace(/\.mp4$/, '.transcoding.mp4');
+            const started = Date.now();
+            const ffmpeg = spawn('ffmpeg', [
+                '-y', '-loglevel', 'error', '-i', masterPath,
+                '-c:v', 'libx264', '-preset', 'fast', '-crf', '23', '-pix_fmt', 'yuv420p',
+                '-movflags', '+faststart', partialPath
+            ]);
+            let stderr = '';
+            ffmpeg.stderr.on('data', (chunk) => { stderr += chunk; });
+            ffmpeg.on('error', (spawnErr) => {
+                logger.error(`❌ Cannot start ffmpeg for ${video.raspiId}: ${spawnErr.message}`);
+                resolve();
+            });
+            ffmpeg.on('close', (code) => {
+                if (code !== 0) {
+                    logger.error(`❌ Master transcode failed for ${video.raspiId} (code ${code}): ${stderr.slice(-500)}`);
+                    fs.unlink(partialPath, () => {});
+                    resolve();
+                    return;
+                }
+
+                // Only replace [pi_id].mp4 once the transcode is complete
+                fs.rename(partialPath, finalPath, (renameErr) => {
+                    if (renameErr) {
+                        // The master stays in /public/video/masters, so it can be transcoded again
+                        logger.error(`❌ Failed to replace ${video.raspiId}.mp4 with the transcoded master: ${renameErr.message}`);
+                        fs.unlink(partialPath, () => {});
+                    } else {
+                        markFullVideo(video);
+                        logger.info(`✅ Master transcoded: /public/video/${video.raspiId}.mp4 (${((Date.now() - started) / 1000).toFixed(1)}s)`);
+                    }
+                    resolve();
+                });
+            });
+        }));
+    });
+}
 
 /**
  * Process video upload queue - one video file per Pi (overwrite previous)
@@ -24,9 +154,14 @@ function processVideoQueue() {
     isProcessing = true;
 
     // Take a snapshot of the queue and clear it so new arrivals go into a new batch
-    const batch = videoQueue;
+    const batch = dropSupersededPreviews(videoQueue);
     videoQueue = [];
 
+    if (batch.length === 0) {
+        isProcessing = false;
+        return;
+    }
+
     // Use existing video directory
     const videoDir = path.join(__dirname, '../../../public/video');
     if (!fs.existsSync(videoDir)) {
@@ -65,6 +200,97 @@ function processVideoQueue() {
     });
 }
 
+const MAX_SIZE = 500 * 1024 * 1024; // 500 MB
+const CHUNK_MAX_SIZE = 16 * 1024 * 1024; // Pi clients send 4 MB chunks by default
+const PARTIAL_MAX_AGE = 24 * 60 * 60 * 1000; // Unfinished chunked uploads are dropped after a day
+
+/**
+ * Hand a completely received upload to the segment / master / queue paths
+ * @param {Object} upload - tempPath, raspiId, cameraModel, variant, recordingId, segmentIndex,
+ *                          timestamp, size and contentType of the received file
+ * @returns {Object} Response body for the Pi
+ */
+function acceptUpload(upload) {
+    const { tempPath, raspiId, cameraModel, variant, recordingId, segmentIndex, timestamp, size } = upload;
+
+    logger.info(`Video upload received from ${raspiId} (${variant}, ${(size / 1024 / 1024).toFixed(2)} MB)`);
+
+    // Segments are stored as they arrive, they never replace [pi_id].mp4
+    if (variant === 'segment') {
+        saveSegment({ tempPath, raspiId, recordingId: recordingId || 'recording', segmentIndex });
+        return {
+            success: true,
+            message: `Segment ${segmentIndex} received from ${raspiId}`,
+            fileSize: size
+        };
+    }
+
+    // MJPEG masters are transcoded here instead of on the Pi
+    if (variant === 'master') {
+        const extension = upload.contentType === 'video/x-matroska' ? '.mkv' : '.mp4';
+        saveMaster({ tempPath, raspiId, recordingId, extension, timestamp });
+        return {
+            success: true,
+            message: `MJPEG master received from ${raspiId}, transcoding`,
+            fileSize: size
+        };
+    }
+
+    // Add to queue
+    videoQueue.push({ tempPath, raspiId, cameraModel, variant, recordingId, timestamp, size });
+    logger.debug(`Queue length: ${videoQueue.length}`);
+
+    return {
+        success: true,
+        message: `Video queued from ${raspiId}`,
+        queuePosition: videoQueue.length,
+        fileSize: size
+    };
+}
+
+/**
+ * Upload metadata sent as X-* headers (same for single and chunked uploads)
+ * @param {Object} req - Express request
+ * @returns {Object} raspiId, cameraModel, variant, recordingId and segmentIndex
+ */
+function getUploadHeaders(req) {
+    return {
+        raspiId: req.headers['x-raspi-id'] || 'unknown',
+        cameraModel: req.headers['x-camera-model'] || 'unknown',
+        variant: req.headers['x-video-variant'] || 'full', // 'preview' never replaces a full video, 'master' is transcoded here
+        recordingId: req.headers['x-recording-id'] ? path.basename(req.headers['x-recording-id']) : null, // groups segments, supersedes previews
+        segmentIndex: parseInt(req.headers['x-segment-index'] || '0', 10)
+    };
+}
+
+/**
+ * Partial file of a chunked upload (null for an invalid id)
+ * @param {string} tempDir - Upload temp directory
+ * @param {string} uploadId - Client-chosen upload id
+ * @returns {string|null} Path of the partial file
+ */
+function getPartialPath(tempDir, uploadId) {
+    if (!/^[A-Za-z0-9_-]{8,64}$/.test(uploadId)) return null;
+    return path.join(tempDir, `chunked_${uploadId}.part`);
+}
+
+/**
+ * Remove chunked uploads that were never finished
+ * @param {string} tempDir - Upload temp directory
+ */
+function cleanupStalePartials(tempDir) {
+    const now = Date.now();
+    fs.readdirSync(tempDir)
+        .filter(name => name.startsWith('chunked_') && name.endsWith('.part'))
+        .forEach(name => {
+            const partialPath = path.join(tempDir, name);
+            if (now - fs.statSync(partialPath).mtimeMs > PARTIAL_MAX_AGE) {
+                logger.info(`🧹 Removing stale partial upload ${name}`);
+                fs.unlink(partialPath, () => {});
+            }
+        });
+}
+
 /**
  * Initialize video upload system (raw streaming, no multer)
  */
@@ -77,15 +303,13 @@ function HW_VIDEO_UPLOAD_INIT(GLOBALS) {
 
     // Upload endpoint: raw request body is the video file
     GLOBALS.Express.post('/api/upload-video', (req, res) => {
-        const raspiId = req.headers['x-raspi-id'] || 'unknown';
-        const cameraModel = req.headers['x-camera-model'] || 'unknown';
+        const { raspiId, cameraModel, variant, recordingId, segmentIndex } = getUploadHeaders(req);
         const timestamp = Date.now();
 
         const tempPath = path.join(tempDir, `video_${raspiId}_${cameraModel}_${timestamp}.mp4`);
         const writeStream = fs.createWriteStream(tempPath);
 
         let bytesReceived = 0;
-        const MAX_SIZE = 500 * 1024 * 1024; // 500 MB
         let responded = false;
 
         const safeRespond = (status, body) => {
@@ -140,34 +364,102 @@ function HW_VIDEO_UPLOAD_INIT(GLOBALS) {
                 return;
             }
 
-            logger.info(
-                `Video upload received from ${raspiId} (${(bytesReceived / 1024 / 1024).toFixed(2)} MB)`
-            );
-
-            // Add to queue
-            const entry = {
+            safeRespond(200, acceptUpload({
                 tempPath,
                 raspiId,
                 cameraModel,
+                variant,
+                recordingId,
+                segmentIndex,
                 timestamp,
-                size: bytesReceived
-            };
-            videoQueue.push(entry);
-
-            logger.debug(`Queue length: ${videoQueue.length}`);
-
-            safeRespond(200, {
-                success: true,
-                message: `Video queued from ${raspiId}`,
-                queuePosition: videoQueue.length,
-                fileSize: bytesReceived
-            });
+                size: bytesReceived,
+                contentType: req.headers['content-type']
+            }));
         });
 
         // Start piping the request body into the file
         req.pipe(writeStream);
     });
 
+    // Chunked, resumable upload: GET returns the acknowledged offset, POST appends one chunk.
+    // A chunk is only appended at the expected offset and with a matching SHA-256, so a
+    // client can always resume from the offset it gets back.
+    cleanupStalePartials(tempDir);
+
+    GLOBALS.Express.get('/api/upload-chunk/:uploadId', (req, res) => {
+        const partialPath = getPartialPath(tempDir, req.params.uploadId);
+        if (!partialPath) {
+            return res.status(400).json({ success: false, error: 'Invalid upload id' });
+        }
+        const offset = fs.existsSync(partialPath) ? fs.statSync(partialPath).size : 0;
+        res.json({ success: true, offset });
+    });
+
+    GLOBALS.Express.post('/api/upload-chunk/:uploadId', (req, res) => {
+        const partialPath = getPartialPath(tempDir, req.params.uploadId);
+        const offset = parseInt(req.headers['x-chunk-offset'], 10);
+        const totalSize = parseInt(req.headers['x-total-size'], 10);
+        if (!partialPath || isNaN(offset) || isNaN(totalSize)) {
+            return res.status(400).json({ success: false, error: 'Missing upload id, offset or total size' });
+        }
+        if (totalSize > MAX_SIZE) {
+            return res.status(413).json({ success: false, error: 'File too large', maxBytes: MAX_SIZE });
+        }
+
+        const parts = [];
+        let chunkSize = 0;
+        req.on('data', (data) => {
+            chunkSize += data.length;
+            if (chunkSize > CHUNK_MAX_SIZE) {
+                res.status(413).json({ success: false, error: 'Chunk too large', maxBytes: CHUNK_MAX_SIZE });
+                req.destroy();
+                return;
+            }
+            parts.push(data);
+        });
+
+        req.on('end', () => {
+            if (res.headersSent) return;
+            const chunk = Buffer.concat(parts);
+            const current = fs.existsSync(partialPath) ? fs.statSync(partialPath).size : 0;
+
+            // Out of order (e.g. a retried chunk that already arrived): tell the client where we are
+            if (offset !== current) {
+                return res.status(409).json({ success: false, error: 'Unexpected offset', offset: current });
+            }
+            const checksum = crypto.createHash('sha256').update(chunk).digest('hex');
+            if (checksum !== req.headers['x-chunk-sha256']) {
+                logger.warn(`Chunk checksum mismatch from ${req.headers['x-raspi-id']} at ${offset}`);
+                return res.status(422).json({ success: false, error: 'Checksum mismatch', offset: current });
+            }
+            if (offset + chunk.length > totalSize) {
+                return res.status(400).json({ success: false, error: 'Chunk beyond total size', offset: current });
+            }
+
+            fs.appendFileSync(partialPath, chunk);
+            const received = offset + chunk.length;
+            if (received < totalSize) {
+                return res.json({ success: true, offset: received, complete: false });
+            }
+
+            const upload = getUploadHeaders(req);
+            const timestamp = Date.now();
+            const tempPath = path.join(tempDir, `video_${upload.raspiId}_${upload.cameraModel}_${timestamp}.mp4`);
+            fs.renameSync(partialPath, tempPath);
+            res.json({
+                ...acceptUpload({
+                    ...upload,
+                    tempPath,
+                    timestamp,
+                    size: received,
+                    contentType: req.headers['x-upload-type']
+                }),
+                offset: received,
+                complete: true
+            });
+        });
+    });
+
     // Start queue processor
     if (!queueProcessor) {
         queueProcessor = setInterval(processVideoQueue, 2000); // Process every 2 seconds
@@ -180,5 +472,8 @@ function HW_VIDEO_UPLOAD_INIT(GLOBALS) {
 }
 
 module.exports = {
-    HW_VIDEO_UPLOAD_INIT
+    HW_VIDEO_UPLOAD_INIT,
+    __TEST__: {
+        getVideoQueue: () => videoQueue
+    }
 };
\ No newline at end of file
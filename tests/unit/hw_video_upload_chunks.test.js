@@ -0,0 +1,174 @@
+jest.mock('../../src/server/config/logger.js', () => ({
+  createModuleLogger: () => ({
+    info: jest.fn(),
+    warn: jest.fn(),
+    error: jest.fn(),
+    debug: jest.fn()
+  })
+}));
+
+const crypto = require('crypto');
+const EventEmitter = require('events');
+const fs = require('fs');
+const path = require('path');
+
+const videoUpload = require('../../src/server/controllers/HW_VIDEO_UPLOAD');
+
+const TEMP_DIR = path.join(__dirname, '../../src/temp/video_uploads');
+const UPLOAD_ID = 'jestchunkupload01';
+const RASPI_ID = 'jest_pi';
+
+const createExpressStub = () => {
+  const posts = {};
+  const gets = {};
+  return {
+    post: jest.fn((route, handler) => {
+      posts[route] = handler;
+    }),
+    get: jest.fn((route, handler) => {
+      gets[route] = handler;
+    }),
+    __posts: posts,
+    __gets: gets
+  };
+};
+
+const createResponseStub = () => {
+  const res = {};
+  res.statusCode = 200;
+  res.payload = null;
+  res.headersSent = false;
+  res.status = jest.fn((code) => {
+    res.statusCode = code;
+    return res;
+  });
+  res.json = jest.fn((body) => {
+    res.payload = body;
+    res.headersSent = true;
+    return res;
+  });
+  return res;
+};
+
+const sha256 = (data) => crypto.createHash('sha256').update(data).digest('hex');
+
+const partialPath = () => path.join(TEMP_DIR, `chunked_${UPLOAD_ID}.part`);
+
+const receivedFiles = () => fs.readdirSync(TEMP_DIR).filter(name => name.startsWith(`video_${RASPI_ID}_`));
+
+describe('/api/upload-chunk/:uploadId', () => {
+  let app;
+
+  const getOffset = () => {
+    const res = createResponseStub();
+    app.__gets['/api/upload-chunk/:uploadId']({ params: { uploadId: UPLOAD_ID }, headers: {} }, res);
+    return res;
+  };
+
+  const postChunk = (chunk, offset, totalSize, headers = {}) => {
+    const req = new EventEmitter();
+    req.params = { uploadId: UPLOAD_ID };
+    req.headers = {
+      'x-raspi-id': RASPI_ID,
+      'x-camera-model': 'daheng_imx273',
+      'x-video-variant': 'full',
+      'x-recording-id': 'daheng_imx273_capture_20260101_120000',
+      'x-upload-type': 'video/mp4',
+      'x-chunk-offset': String(offset),
+      'x-total-size': String(totalSize),
+      'x-chunk-sha256': sha256(chunk),
+      ...headers
+    };
+    req.destroy = jest.fn();
+    const res = createResponseStub();
+    app.__posts['/api/upload-chunk/:uploadId'](req, res);
+    req.emit('data', chunk);
+    req.emit('end');
+    return res;
+  };
+
+  const cleanup = () => {
+    if (fs.existsSync(partialPath())) fs.unlinkSync(partialPath());
+    receivedFiles().forEach(name => fs.unlinkSync(path.join(TEMP_DIR, name)));
+    videoUpload.__TEST__.getVideoQueue().length = 0;
+  };
+
+  beforeAll(() => {
+    jest.useFakeTimers(); // The queue processor must not move files into public/video
+    app = createExpressStub();
+    videoUpload.HW_VIDEO_UPLOAD_INIT({ Express: app });
+  });
+
+  afterEach(cleanup);
+
+  afterAll(() => {
+    jest.useRealTimers();
+  });
+
+  test('reports offset 0 for a new upload and the received size when resuming', () => {
+    expect(getOffset().payload).toEqual({ success: true, offset: 0 });
+
+    const res = postChunk(Buffer.from('first-chunk'), 0, 32);
+    expect(res.statusCode).toBe(200);
+    expect(res.payload).toEqual({ success: true, offset: 11, complete: false });
+
+    expect(getOffset().payload).toEqual({ success: true, offset: 11 });
+  });
+
+  test('rejects an invalid upload id', () => {
+    const res = createResponseStub();
+    app.__gets['/api/upload-chunk/:uploadId']({ params: { uploadId: '../x' }, headers: {} }, res);
+
+    expect(res.statusCode).toBe(400);
+  });
+
+  test('answers 409 with the expected offset when a chunk arrives out of order', () => {
+    postChunk(Buffer.from('first-chunk'), 0, 32);
+
+    const replay = postChunk(Buffer.from('first-chunk'), 0, 32);
+    expect(replay.statusCode).toBe(409);
+    expect(replay.payload).toMatchObject({ success: false, offset: 11 });
+
+    const ahead = postChunk(Buffer.from('later'), 20, 32);
+    expect(ahead.statusCode).toBe(409);
+    expect(ahead.payload.offset).toBe(11);
+    expect(fs.statSync(partialPath()).size).toBe(11);
+  });
+
+  test('answers 422 and keeps the offset when the SHA-256 does not match', () => {
+    const res = postChunk(Buffer.from('corrupted'), 0, 32, { 'x-chunk-sha256': sha256('original') });
+
+    expect(res.statusCode).toBe(422);
+    expect(res.payload).toMatchObject({ success: false, offset: 0 });
+    expect(getOffset().payload.offset).toBe(0);
+  });
+
+  test('hands the completed file to the upload queue on the final chunk', () => {
+    const first = Buffer.from('0123456789');
+    const last = Buffer.from('abcdef');
+
+    expect(postChunk(first, 0, 16).payload.complete).toBe(false);
+    const res = postChunk(last, 10, 16);
+
+    expect(res.statusCode).toBe(200);
+    expect(res.payload).toMatchObject({
+      success: true,
+      message: `Video queued from ${RASPI_ID}`,
+      fileSize: 16,
+      offset: 16,
+      complete: true
+    });
+    expect(fs.existsSync(partialPath())).toBe(false);
+
+    const queue = videoUpload.__TEST__.getVideoQueue();
+    expect(queue).toHaveLength(1);
+    expect(queue[0]).toMatchObject({
+      raspiId: RASPI_ID,
+      cameraModel: 'daheng_imx273',
+      variant: 'full',
+      recordingId: 'daheng_imx273_capture_20260101_120000',
+      size: 16
+    });
+    expect(fs.readFileSync(queue[0].tempPath).toString()).toBe('0123456789abcdef');
+  });
+});